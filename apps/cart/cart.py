@@ -0,0 +1,184 @@
+from django_redis import get_redis_connection
+
+
+CART_KEY = 'cart_%d'  # 购物车 {sku_id: 数量}
+CART_TOTAL_KEY = 'cart_total_%d'  # 购物车中商品的总件数，随购物车的修改增量更新
+GUEST_CART_KEY = 'cart_guest_%s'  # 未登录用户的购物车，按session key保存
+GUEST_CART_TOTAL_KEY = 'cart_guest_total_%s'
+GUEST_CART_TIMEOUT = 24 * 3600  # 未登录用户的购物车最后一次修改后保留的时间(秒)
+GUEST_CART_MAX_ITEMS = 30  # 未登录用户的购物车最多的商品条目数
+
+# 修改购物车的结果
+STOCK_SHORT = -1  # 库存不足
+CART_FULL = -2  # 购物车中的商品条目数已达上限
+
+# 有过期时间时刷新购物车的过期时间
+REFRESH_TIMEOUT = """
+if tonumber(ARGV[5]) > 0 then
+    redis.call('EXPIRE', KEYS[1], ARGV[5])
+    redis.call('EXPIRE', KEYS[2], ARGV[5])
+end
+"""
+
+# 总件数不存在时(旧的购物车)根据购物车重新计算
+ENSURE_TOTAL = """
+if redis.call('EXISTS', KEYS[2]) == 0 then
+    local total = 0
+    for _, count in ipairs(redis.call('HVALS', KEYS[1])) do
+        total = total + tonumber(count)
+    end
+    redis.call('SET', KEYS[2], total)
+end
+"""
+
+# 购物车中还没有这个商品且条目数已达上限时返回-2
+CHECK_FULL = """
+local limit = tonumber(ARGV[4])
+if limit > 0 and redis.call('HEXISTS', KEYS[1], ARGV[1]) == 0 and redis.call('HLEN', KEYS[1]) >= limit then
+    return -2
+end
+"""
+
+# KEYS: 购物车, 总件数  ARGV: sku_id, 增加的数量, 库存, 条目数上限(0不限制), 过期时间(0不过期)
+# 库存不足返回-1，购物车已满返回-2，否则返回购物车中的商品条目数
+ADD_SCRIPT = ENSURE_TOTAL + CHECK_FULL + """
+local old = tonumber(redis.call('HGET', KEYS[1], ARGV[1]) or 0)
+local new = old + tonumber(ARGV[2])
+if new > tonumber(ARGV[3]) then
+    return -1
+end
+redis.call('HSET', KEYS[1], ARGV[1], new)
+redis.call('INCRBY', KEYS[2], new - old)
+""" + REFRESH_TIMEOUT + """
+return redis.call('HLEN', KEYS[1])
+"""
+
+# KEYS: 购物车, 总件数  ARGV: sku_id, 数量, 库存, 条目数上限(0不限制), 过期时间(0不过期)
+# 库存不足返回-1，购物车已满返回-2，否则返回购物车中商品的总件数
+SET_SCRIPT = ENSURE_TOTAL + CHECK_FULL + """
+local new = tonumber(ARGV[2])
+if new > tonumber(ARGV[3]) then
+    return -1
+end
+local old = tonumber(redis.call('HGET', KEYS[1], ARGV[1]) or 0)
+redis.call('HSET', KEYS[1], ARGV[1], new)
+local total = redis.call('INCRBY', KEYS[2], new - old)
+""" + REFRESH_TIMEOUT + """
+return total
+"""
+
+# KEYS: 购物车, 总件数  ARGV: sku_id...
+# 返回购物车中商品的总件数
+DELETE_SCRIPT = ENSURE_TOTAL + """
+local removed = 0
+for i = 1, #ARGV do
+    local old = redis.call('HGET', KEYS[1], ARGV[i])
+    if old then
+        removed = removed + tonumber(old)
+        redis.call('HDEL', KEYS[1], ARGV[i])
+    end
+end
+return redis.call('DECRBY', KEYS[2], removed)
+"""
+
+# KEYS: 用户购物车, 用户购物车总件数, 未登录时的购物车, 未登录时的购物车总件数
+# 把未登录时的购物车合并到用户购物车，相同商品的数量累加，返回用户购物车中的商品条目数
+MERGE_SCRIPT = ENSURE_TOTAL + """
+local items = redis.call('HGETALL', KEYS[3])
+local added = 0
+for i = 1, #items, 2 do
+    redis.call('HINCRBY', KEYS[1], items[i], items[i + 1])
+    added = added + tonumber(items[i + 1])
+end
+redis.call('INCRBY', KEYS[2], added)
+redis.call('DEL', KEYS[3], KEYS[4])
+return redis.call('HLEN', KEYS[1])
+"""
+
+# KEYS: 购物车, 总件数
+TOTAL_SCRIPT = ENSURE_TOTAL + """
+return redis.call('GET', KEYS[2])
+"""
+
+
+class Cart(object):
+    """
+    用户购物车
+    每个修改操作都是一次lua脚本调用，同时维护商品的总件数，查询条目数和总件数都是O(1)
+    """
+    max_items = 0  # 商品条目数上限，0表示不限制
+    timeout = 0  # 过期时间(秒)，0表示不过期
+
+    def __init__(self, user_id, conn=None):
+        self._init([CART_KEY % user_id, CART_TOTAL_KEY % user_id], conn)
+
+    def _init(self, keys, conn):
+        self.conn = conn or get_redis_connection('default')
+        self.keys = keys
+        self._add = self.conn.register_script(ADD_SCRIPT)
+        self._set = self.conn.register_script(SET_SCRIPT)
+        self._delete = self.conn.register_script(DELETE_SCRIPT)
+        self._merge = self.conn.register_script(MERGE_SCRIPT)
+        self._total = self.conn.register_script(TOTAL_SCRIPT)
+
+    def add(self, sku_id, count, stock):
+        """ 增加商品的数量，返回购物车中的商品条目数，失败时返回STOCK_SHORT或CART_FULL """
+        return self._add(keys=self.keys, args=[sku_id, count, stock, self.max_items, self.timeout])
+
+    def set(self, sku_id, count, stock):
+        """ 设置商品的数量，返回购物车中商品的总件数，失败时返回STOCK_SHORT或CART_FULL """
+        return self._set(keys=self.keys, args=[sku_id, count, stock, self.max_items, self.timeout])
+
+    def merge(self, other):
+        """ 把另一个购物车(未登录时的购物车)合并进来并删除，返回商品条目数 """
+        return self._merge(keys=self.keys + other.keys)
+
+    def delete(self, *sku_ids):
+        """ 删除商品，返回购物车中商品的总件数 """
+        return self._delete(keys=self.keys, args=list(sku_ids))
+
+    def items(self):
+        """ 购物车中的商品 {sku_id: 数量} """
+        return {int(sku_id): int(count) for sku_id, count in self.conn.hgetall(self.keys[0]).items()}
+
+    def counts(self, sku_ids):
+        """ 一次获取多个商品的数量，不在购物车中的为None """
+        counts = self.conn.hmget(self.keys[0], sku_ids)
+        return [None if count is None else int(count) for count in counts]
+
+    def kinds(self):
+        """ 购物车中的商品条目数 """
+        return self.conn.hlen(self.keys[0])
+
+    def total(self):
+        """ 购物车中商品的总件数 """
+        total = self.conn.get(self.keys[1])
+        if total is None:
+            total = self._total(keys=self.keys)
+        return int(total)
+
+
+class GuestCart(Cart):
+    """ 未登录用户的购物车，按session保存，有过期时间和条目数上限 """
+    max_items = GUEST_CART_MAX_ITEMS
+    timeout = GUEST_CART_TIMEOUT
+
+    def __init__(self, session_key, conn=None):
+        self._init([GUEST_CART_KEY % session_key, GUEST_CART_TOTAL_KEY % session_key], conn)
+
+
+def get_cart(request, create=False):
+    """
+    获取当前请求的购物车，已登录时返回用户的购物车，未登录时返回session对应的购物车
+    未登录且还没有session时，create为True则创建session，否则返回None
+    """
+    if request.user.is_authenticated:
+        return Cart(request.user.id)
+    session = request.session
+    if session.session_key is None:
+        if not create:
+            return None
+        # 修改session让SessionMiddleware设置cookie
+        session['guest_cart'] = True
+        session.save()
+    return GuestCart(session.session_key)
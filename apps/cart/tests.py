@@ -1,3 +1,33 @@
 from django.test import TestCase
+from django.urls import reverse
 
-# Create your tests here.
+from cart.cart import Cart
+from goods.testdata import create_skus, clear_caches
+from user.models import User
+from utils.testing import RedisTestMixin, count_queries
+
+
+class CartInfoViewQueryTest(RedisTestMixin, TestCase):
+    """ 购物车页面的sql语句数和购物车中的商品数无关 """
+    def setUp(self):
+        super(CartInfoViewQueryTest, self).setUp()
+        self.user = User.objects.create_user('cart_test', 'cart_test@example.com', 'password')
+        self.client.force_login(self.user)
+        goods_type, self.skus = create_skus(20, prefix='cart_test')
+
+    def fill_cart(self, count):
+        cart = Cart(self.user.id)
+        for sku in self.skus[:count]:
+            cart.add(sku.id, 1, sku.stock)
+        # 每次都从冷缓存开始，商品和分类菜单都需要查询数据库
+        clear_caches()
+
+    def test_queries_constant(self):
+        self.fill_cart(1)
+        queries = count_queries(self.client.get, reverse('cart:show'))
+
+        self.fill_cart(20)
+        with self.assertNumQueries(queries):
+            response = self.client.get(reverse('cart:show'))
+        self.assertEqual(len(response.context['skus']), 20)
+        self.assertEqual(response.context['total_count'], 20)
@@ -2,8 +2,22 @@ from django.shortcuts import render
 from django.views.generic import View
 from django.http import JsonResponse
 from goods.models import GoodsSKU
-from django_redis import get_redis_connection
-from utils.mixin import LoginRequiredMixin
+from order.stock import StockReservation
+from .cart import get_cart, STOCK_SHORT, CART_FULL
+
+
+def get_sku_state(sku_id):
+    """
+    从redis中的商品索引获取商品的状态和可用库存 (status, stock)，不再每次都查询mysql
+    商品不存在时返回None
+    """
+    try:
+        sku_id = int(sku_id)
+    except ValueError:
+        return None
+    if sku_id <= 0:
+        return None
+    return StockReservation().check(sku_id)
 
 
 class CartAddView(View):
@@ -14,12 +28,7 @@ class CartAddView(View):
     前端需要传递的参数:商品id(sku_id),商品数量(count)
     """
     def post(self, request):
-        user = request.user
-
-        # 判断用户是否登录(因为是ajax请求所以不能用继承LoginRequiredMixin的方式)
-        if not user.is_authenticated:
-            return JsonResponse({'res': 0, 'errmsg': '请先登录'})
-
+        # 未登录时添加到session对应的购物车，登录时合并到用户的购物车
         # 接收数据
         sku_id = request.POST.get('sku_id', '')
         count = request.POST.get('count', '')
@@ -35,65 +44,51 @@ class CartAddView(View):
             return JsonResponse({'res': 2, 'errmsg': '商品数目出错'})
 
         # 效验商品是否存在
-        try:
-            sku = GoodsSKU.objects.get(id=sku_id)
-        except GoodsSKU.DoesNotExist:
+        state = get_sku_state(sku_id)
+        if state is None or state[0] != 1:
             return JsonResponse({'res': 3, 'errmsg': '商品不存在'})
+        status, stock = state
 
         # 业务处理:添加购物车记录
-        conn = get_redis_connection('default')
-        cart_key = 'cart_%d' % user.id
-        # 尝试获取sku_id的值，不存在则添加，存在则累加
-        cart_count = conn.hget(cart_key, sku_id)
-        if cart_count:
-            # 存在则累加
-            count += int(cart_count)
-
-        # 效验商品库存
-        if count > sku.stock:
+        # 累加数量、校验库存、计算购物车商品条目数在一次redis调用中完成
+        total_count = get_cart(request, create=True).add(int(sku_id), count, stock)
+        if total_count == STOCK_SHORT:
             return JsonResponse({'res':4, 'errmsg': '商品库存不足'})
-
-        # 设置hash中sku_id对应的值
-        # hset->如果sku_id已经存在，更新数据， 如果sku_id不存在，添加数据
-        conn.hset(cart_key, sku_id, count)
-
-        # 计算用户购物车商品条目数
-        total_count = conn.hlen(cart_key)
+        if total_count == CART_FULL:
+            return JsonResponse({'res': 6, 'errmsg': '购物车已满，请先登录'})
 
         return JsonResponse({'res': 5, 'total_count': total_count, 'errmsg': '添加成功'})
 
 
-class CartInfoView(LoginRequiredMixin, View):
+class CartInfoView(View):
     """
     /cart/
-    购物车页面展示
+    购物车页面展示，未登录时显示session对应的购物车
     """
     def get(self, request):
-        user = request.user
-        conn = get_redis_connection('default')
-
         # 获取用户购物车中商品的信息
-        cart_key = 'cart_%d' % user.id
-        cart_dict = conn.hgetall(cart_key)
+        cart = get_cart(request)
+        cart_dict = cart.items() if cart is not None else {}
 
         # 保存用户购物车中商品的总数目和总价格
         skus = []
         total_count = 0
         total_price = 0
+        # 一次查询获取购物车中全部商品的信息
+        skus_li = GoodsSKU.objects.get_skus(cart_dict.keys(), request=request)
         # 遍历获取商品的信息
-        for sku_id, count in cart_dict.items():
-            # 根据商品的id获取商品的信息
-            sku = GoodsSKU.objects.get(pk=sku_id)
+        for sku in skus_li:
+            count = cart_dict[sku.id]
             # 计算商品的小计
-            amount = int(count) * sku.price
+            amount = count * sku.price
             # 动态给sku对象添加一个小计属性
             sku.amount = amount
             # 动态给sku对象添加一个count属性
-            sku.count = count.decode()
+            sku.count = count
             skus.append(sku)
 
             # 累计计算商品的总价和总数
-            total_count += int(count)
+            total_count += count
             total_price += amount
 
         context = {
@@ -111,11 +106,6 @@ class CartUpdateView(View):
     前端需要传递的参数:商品id(sku_id) 更新的商品数量(count)
     """
     def post(self, request):
-        user = request.user
-        if not user.is_authenticated:
-            # 用户未登录
-            return JsonResponse({'res': 0, 'errmsg': '请先登录'})
-
         # 接收数据
         sku_id = request.POST.get('sku_id', '')
         count = request.POST.get('count', '')
@@ -132,28 +122,18 @@ class CartUpdateView(View):
             return JsonResponse({'res': 2, 'errmsg': '商品数目出错'})
 
         # 校验商品是否存在
-        try:
-            sku = GoodsSKU.objects.get(id=sku_id)
-        except GoodsSKU.DoesNotExist:
-            # 商品不存在
+        state = get_sku_state(sku_id)
+        if state is None or state[0] != 1:
+            # 商品不存在或已下线
             return JsonResponse({'res': 3, 'errmsg': '商品不存在'})
+        status, stock = state
 
-        # 业务处理:更新购物车记录
-        conn = get_redis_connection('default')
-        cart_key = 'cart_%d' % user.id
-
-        # 校验商品的库存
-        if count > sku.stock:
+        # 业务处理:更新购物车记录，同时返回增量维护的商品总件数
+        total_count = get_cart(request, create=True).set(int(sku_id), count, stock)
+        if total_count == STOCK_SHORT:
             return JsonResponse({'res': 4, 'errmsg': '商品库存不足'})
-
-        # 更新
-        conn.hset(cart_key, sku_id, count)
-
-        # 计算用户购物车中商品的总件数 {'1':5, '2':3}
-        total_count = 0
-        vals = conn.hvals(cart_key)
-        for val in vals:
-            total_count += int(val)
+        if total_count == CART_FULL:
+            return JsonResponse({'res': 6, 'errmsg': '购物车已满，请先登录'})
 
         # 返回应答
         return JsonResponse({'res': 5, 'total_count': total_count, 'message': '更新成功'})
@@ -164,11 +144,6 @@ class CartDeleteView(View):
     删除购物车记录
     """
     def post(self, request):
-        user = request.user
-        if not user.is_authenticated:
-            # 用户未登录
-            return JsonResponse({'res': 0, 'errmsg': '请先登录'})
-
         # 接收参数
         sku_id = request.POST.get('sku_id', '')
 
@@ -176,24 +151,13 @@ class CartDeleteView(View):
         if not sku_id:
             return JsonResponse({'res': 1, 'errmsg': '无效的商品id'})
 
-        # 校验商品是否存在
-        try:
-            sku = GoodsSKU.objects.get(id=sku_id)
-        except GoodsSKU.DoesNotExist:
+        # 校验商品是否存在，已下线的商品也可以删除
+        if get_sku_state(sku_id) is None:
             # 商品不存在
             return JsonResponse({'res': 2, 'errmsg': '商品不存在'})
 
-        # 业务处理:删除购物车记录
-        conn = get_redis_connection('default')
-        cart_key = 'cart_%d' % user.id
-
-        # 删除 hdel
-        conn.hdel(cart_key, sku_id)
-
-        # 计算用户购物车中商品的总件数 {'1':5, '2':3}
-        total_count = 0
-        vals = conn.hvals(cart_key)
-        for val in vals:
-            total_count += int(val)
+        # 业务处理:删除购物车记录，同时返回增量维护的商品总件数
+        cart = get_cart(request)
+        total_count = cart.delete(int(sku_id)) if cart is not None else 0
 
         return JsonResponse({'res': 3, 'total_count': total_count, 'message': '删除成功'})
\ No newline at end of file
@@ -1,5 +1,6 @@
 from django.contrib import admin
-from django.core.cache import cache
+from django.db import transaction
+from utils import static_page
 from goods.models import GoodsType, IndexGoodsBanner, IndexPromotionBanner, IndexTypeGoodsBanner, GoodsSKU, Goods
 
 
@@ -7,19 +8,20 @@ class BaseModelAdmin(admin.ModelAdmin):
     # 在后台每次更新数据都会自动更新静态首页和首页缓存数据
     def save_model(self, request, obj, form, change):
         super(BaseModelAdmin, self).save_model(request, obj, form, change)
-        from celery_tasks.tasks import generate_static_index_html
-        generate_static_index_html.delay()
+        self.refresh_index()
 
-        # 清除首页缓存数据
-        cache.delete('index_page_data')
-    
     def delete_model(self, request, obj):
         super(BaseModelAdmin, self).delete_model(request, obj)
-        from celery_tasks.tasks import generate_static_index_html
-        generate_static_index_html.delay()
+        self.refresh_index()
 
-        # 清除首页缓存数据
-        cache.delete('index_page_data')
+    def refresh_index(self):
+        from celery_tasks.tasks import generate_static_index_html, refresh_index_page_cache
+        # 短时间内的多次修改只生成一次静态首页，事务提交后才投递
+        static_page.schedule(generate_static_index_html, 'index')
+
+        # 后台重新生成首页缓存数据，不直接删除缓存，避免大量请求同时重新生成
+        # 后台的保存在事务中，提交后再投递任务，否则任务可能读到修改前的数据并缓存
+        transaction.on_commit(lambda: refresh_index_page_cache.delay())
 
 
 class GoodsTypeAdmin(BaseModelAdmin):
@@ -38,6 +40,7 @@ class IndexPromotionBannerAdmin(BaseModelAdmin):
     pass
 
 class GoodsSkuAdmin(BaseModelAdmin):
+    # redis中的库存和状态由GoodsSKU的post_save信号同步
     pass
 
 
@@ -1,5 +1,31 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_init, post_save, post_delete
 
 
 class GoodsConfig(AppConfig):
-    name = 'apps.goods'
+    name = 'goods'
+
+    def ready(self):
+        from goods.models import GoodsType, GoodsSKU, Goods
+
+        # 商品数据修改或删除时让对象缓存失效
+        from goods.cache import model_caches, model_saved, model_deleted
+        for model in model_caches:
+            post_save.connect(model_saved, sender=model)
+            post_delete.connect(model_deleted, sender=model)
+
+        # 商品种类修改后清除进程内缓存的分类菜单
+        from goods.templatetags.goods_tags import clear_type_menu
+        post_save.connect(clear_type_menu, sender=GoodsType)
+        post_delete.connect(clear_type_menu, sender=GoodsType)
+
+        # 商品修改后重新生成对应的静态详情页
+        from goods.utils import sku_changed, goods_changed
+        post_save.connect(sku_changed, sender=GoodsSKU)
+        post_save.connect(goods_changed, sender=Goods)
+
+        # 商品修改或删除后同步redis中的库存和状态
+        from order.stock import sku_loaded, sku_saved, sku_deleted
+        post_init.connect(sku_loaded, sender=GoodsSKU)
+        post_save.connect(sku_saved, sender=GoodsSKU)
+        post_delete.connect(sku_deleted, sender=GoodsSKU)
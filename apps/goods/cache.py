@@ -0,0 +1,184 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import cache
+from django.db import transaction
+from django_redis import get_redis_connection
+
+from goods.models import GoodsType, Goods, GoodsSKU
+
+
+STATS_KEY = 'cache_stats_%s'  # 全部进程汇总的命中计数 {lru_hits, redis_hits, misses}
+STATS_FIELDS = ('lru_hits', 'redis_hits', 'misses')
+
+
+class ModelCache(object):
+    """
+    模型对象缓存
+    对象保存在redis缓存(default)中，进程内再用一个小的LRU缓存最近使用的对象
+    每个模型有一个版本号，数据保存或删除时版本号加1，旧版本的缓存全部失效
+    其他进程最多每隔version_check秒读取一次版本号，LRU命中时不访问redis
+    """
+    def __init__(self, model, timeout=3600, lru_size=256, version_check=5):
+        self.model = model
+        self.timeout = timeout
+        self.lru_size = lru_size
+        self.version_check = version_check
+        self.name = model._meta.label_lower
+        self.version_key = 'cache_version_%s' % self.name
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+        self._version = None
+        self._checked = 0
+        # 命中计数
+        self.lru_hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+        self._flushed = dict.fromkeys(STATS_FIELDS, 0)
+        self._flush_time = 0
+
+    def _key(self, version, pk):
+        return 'model_%s_%s_%s' % (self.name, version, pk)
+
+    def version(self, fresh=False):
+        """
+        获取模型当前的版本号，最多每隔version_check秒从redis读取一次
+        fresh为True时总是读取(下单等不能使用旧数据的地方)
+        """
+        now = time.time()
+        if not fresh and self._version is not None and now - self._checked < self.version_check:
+            return self._version
+        version = cache.get(self.version_key)
+        if version is None:
+            cache.add(self.version_key, 1, None)
+            version = cache.get(self.version_key)
+        self._version, self._checked = version, now
+        if now - self._flush_time >= self.version_check:
+            self._flush_stats()
+            self._flush_time = now
+        return version
+
+    def _lru_get(self, key):
+        with self._lock:
+            obj = self._lru.get(key)
+            if obj is not None:
+                self._lru.move_to_end(key)
+            return obj
+
+    def _lru_set(self, key, obj):
+        with self._lock:
+            self._lru[key] = obj
+            self._lru.move_to_end(key)
+            while len(self._lru) > self.lru_size:
+                self._lru.popitem(last=False)
+
+    def get_many(self, pks, fresh=False):
+        """ 获取多个对象，返回{pk: obj}，不存在的对象不返回，fresh同version() """
+        version = self.version(fresh)
+        keys = {self._key(version, pk): int(pk) for pk in pks}
+        result = {}
+
+        # 进程内LRU
+        for key, pk in list(keys.items()):
+            obj = self._lru_get(key)
+            if obj is not None:
+                result[pk] = obj
+                del keys[key]
+        self.lru_hits += len(result)
+
+        # redis缓存
+        if keys:
+            cached = cache.get_many(keys.keys())
+            for key, obj in cached.items():
+                result[keys.pop(key)] = obj
+                self._lru_set(key, obj)
+            self.redis_hits += len(cached)
+
+        # 数据库
+        if keys:
+            self.misses += len(keys)
+            objs = self.model.objects.in_bulk(keys.values())
+            data = {}
+            for key, pk in keys.items():
+                if pk in objs:
+                    result[pk] = data[key] = objs[pk]
+                    self._lru_set(key, objs[pk])
+            cache.set_many(data, self.timeout)
+
+        # 返回副本，调用方给对象动态添加属性时不会影响缓存中的对象
+        return {pk: copy.deepcopy(obj) for pk, obj in result.items()}
+
+    def get(self, pk):
+        """ 获取一个对象，不存在时和objects.get一样抛出DoesNotExist """
+        obj = self.get_many([pk]).get(int(pk))
+        if obj is None:
+            raise self.model.DoesNotExist
+        return obj
+
+    def invalidate(self, instance=None):
+        """ 数据修改后版本号加1，传入instance时把新数据写入缓存，当前进程立即使用新版本 """
+        self.version(fresh=True)
+        version = cache.incr(self.version_key)
+        self._version, self._checked = version, time.time()
+        if instance is not None:
+            cache.set(self._key(version, instance.pk), instance, self.timeout)
+
+    def stats(self):
+        """ 当前进程的命中统计 """
+        return {
+            'model': self.name,
+            'lru_hits': self.lru_hits,
+            'redis_hits': self.redis_hits,
+            'misses': self.misses,
+            'lru_size': len(self._lru),
+        }
+
+    def _flush_stats(self):
+        """ 把上次汇总后新增的命中计数累加到redis，供cache_stats命令查看全部进程的统计 """
+        counts = {field: getattr(self, field) for field in STATS_FIELDS}
+        delta = {field: counts[field] - self._flushed[field] for field in STATS_FIELDS}
+        if not any(delta.values()):
+            return
+        pl = get_redis_connection('default').pipeline()
+        for field, count in delta.items():
+            if count:
+                pl.hincrby(STATS_KEY % self.name, field, count)
+        pl.execute()
+        self._flushed = counts
+
+    def shared_stats(self):
+        """ 全部进程汇总的命中统计，包括当前进程还没有汇总的计数 """
+        self._flush_stats()
+        stats = get_redis_connection('default').hgetall(STATS_KEY % self.name)
+        result = {'model': self.name}
+        for field in STATS_FIELDS:
+            result[field] = int(stats.get(field.encode(), 0))
+        return result
+
+    def reset_stats(self):
+        get_redis_connection('default').delete(STATS_KEY % self.name)
+        self._flushed = {field: getattr(self, field) for field in STATS_FIELDS}
+
+
+type_cache = ModelCache(GoodsType)
+goods_cache = ModelCache(Goods)
+sku_cache = ModelCache(GoodsSKU, lru_size=1024)
+
+model_caches = {
+    GoodsType: type_cache,
+    Goods: goods_cache,
+    GoodsSKU: sku_cache,
+}
+
+
+def model_saved(sender, instance, **kwargs):
+    # 事务提交后再写入新数据，提交前其他进程读到的还是旧数据，不能让它们用新版本号缓存旧数据
+    # 写入保存时的数据，之后事务中对instance的修改不会写入缓存
+    obj = copy.deepcopy(instance)
+    transaction.on_commit(lambda: model_caches[sender].invalidate(obj))
+
+
+def model_deleted(sender, instance, **kwargs):
+    transaction.on_commit(lambda: model_caches[sender].invalidate())
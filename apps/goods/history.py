@@ -0,0 +1,66 @@
+import time
+
+from django_redis import get_redis_connection
+
+from goods.models import GoodsSKU
+
+
+HISTORY_KEY = 'history_%d'  # 用户的浏览记录 有序集合 成员为sku_id score为浏览时间(毫秒)
+HISTORY_SIZE = 10  # 每个用户最多保存的浏览记录数
+HISTORY_TIMEOUT = 30 * 24 * 3600  # 用户这段时间内没有浏览商品时删除浏览记录
+
+# 旧版本的浏览记录是列表，转成有序集合，保持原来的顺序
+CONVERT_LIST = """
+if redis.call('TYPE', KEYS[1]).ok == 'list' then
+    local old = redis.call('LRANGE', KEYS[1], 0, -1)
+    redis.call('DEL', KEYS[1])
+    for i, sku_id in ipairs(old) do
+        redis.call('ZADD', KEYS[1], tonumber(ARGV[1]) - i, sku_id)
+    end
+end
+"""
+
+# KEYS: 浏览记录  ARGV: 当前时间, sku_id, 保存的记录数, 过期时间
+# 返回最近浏览的sku_id
+ADD_SCRIPT = CONVERT_LIST + """
+redis.call('ZADD', KEYS[1], ARGV[1], ARGV[2])
+redis.call('ZREMRANGEBYRANK', KEYS[1], 0, -tonumber(ARGV[3]) - 1)
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+return redis.call('ZREVRANGE', KEYS[1], 0, -1)
+"""
+
+# KEYS: 浏览记录  ARGV: 当前时间, 获取的记录数
+GET_SCRIPT = CONVERT_LIST + """
+return redis.call('ZREVRANGE', KEYS[1], 0, tonumber(ARGV[2]) - 1)
+"""
+
+
+class History(object):
+    """
+    用户的浏览记录
+    按浏览时间保存在有序集合中，添加、去重、截断、续期在一次lua脚本调用中完成
+    """
+    def __init__(self, user_id, conn=None):
+        self.conn = conn or get_redis_connection('default')
+        self.keys = [HISTORY_KEY % user_id]
+        self._add = self.conn.register_script(ADD_SCRIPT)
+        self._get = self.conn.register_script(GET_SCRIPT)
+
+    @staticmethod
+    def _now():
+        return int(time.time() * 1000)
+
+    def add(self, sku_id):
+        """ 添加浏览记录，返回最近浏览的sku_id，最新的在前 """
+        sku_ids = self._add(keys=self.keys, args=[self._now(), int(sku_id), HISTORY_SIZE, HISTORY_TIMEOUT])
+        return [int(sku_id) for sku_id in sku_ids]
+
+    def sku_ids(self, count=HISTORY_SIZE):
+        """ 最近浏览的sku_id，最新的在前 """
+        return [int(sku_id) for sku_id in self._get(keys=self.keys, args=[self._now(), count])]
+
+    @staticmethod
+    def skus(sku_ids, count, exclude=None, request=None):
+        """ 一次获取浏览过的商品，exclude为不需要显示的商品(当前正在浏览的) """
+        sku_ids = [sku_id for sku_id in sku_ids if sku_id != exclude][:count]
+        return GoodsSKU.objects.get_skus(sku_ids, request=request)
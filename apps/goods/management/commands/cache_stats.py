@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from goods.cache import model_caches
+
+
+class Command(BaseCommand):
+    help = '查看商品对象缓存(GoodsSKU、Goods、GoodsType)全部进程汇总的命中统计'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='清空统计')
+
+    def handle(self, *args, **options):
+        for model_cache in model_caches.values():
+            if options['reset']:
+                model_cache.reset_stats()
+                continue
+            stats = model_cache.shared_stats()
+            total = stats['lru_hits'] + stats['redis_hits'] + stats['misses']
+            hit_rate = 100.0 * (total - stats['misses']) / total if total else 0
+            self.stdout.write('%-16s lru=%d redis=%d miss=%d 命中率=%.1f%%' % (
+                stats['model'], stats['lru_hits'], stats['redis_hits'], stats['misses'], hit_rate))
+        if options['reset']:
+            self.stdout.write(self.style.SUCCESS('已清空统计'))
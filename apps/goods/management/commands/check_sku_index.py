@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from order.stock import StockReservation
+
+
+class Command(BaseCommand):
+    help = '对比redis中的商品库存、状态索引和df_goods_sku，列出不一致的商品'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true', help='以mysql为准修正redis')
+        parser.add_argument('--chunk-size', type=int, default=500, help='每次从mysql读取的商品数')
+
+    def handle(self, *args, **options):
+        reservation = StockReservation()
+        diffs = reservation.diff(chunk_size=options['chunk_size'])
+        for sku_id, field, cached, expected in diffs:
+            self.stdout.write('sku %s %s: redis=%s mysql=%s' % (sku_id, field, cached, expected))
+        if not diffs:
+            self.stdout.write(self.style.SUCCESS('redis和mysql一致'))
+            return
+        if options['fix']:
+            fixed = reservation.reconcile()
+            self.stdout.write(self.style.SUCCESS('已修正%d个商品' % len(fixed)))
+        else:
+            self.stdout.write(self.style.WARNING('%d处不一致，使用--fix修正' % len(diffs)))
@@ -0,0 +1,79 @@
+import time
+from decimal import Decimal
+
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.sessions.backends.cache import SessionStore
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from goods.models import Goods, GoodsSKU
+from goods.testdata import create_skus, delete_skus
+from goods.utils import LIST_ORDERINGS, get_list_cursor
+from goods.views import ListView
+from utils.benchmark import summarize
+
+
+PER_PAGE = 2  # 和ListView每页的商品数相同
+
+
+class Command(BaseCommand):
+    help = '在一个有大量商品的种类中测试列表页第1页、第N页和最后一页的延迟，对比OFFSET分页和游标分页'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=1000000, help='种类中的商品数')
+        parser.add_argument('--page', type=int, default=500, help='和第1页对比的页码')
+        parser.add_argument('--repeat', type=int, default=20, help='每一页请求的次数')
+
+    def handle(self, *args, **options):
+        goods_type, skus = create_skus(0, prefix='list_bench')
+        try:
+            self.create(goods_type, options['count'])
+            num_pages = (options['count'] + PER_PAGE - 1) // PER_PAGE
+            pages = sorted({1, min(options['page'], num_pages), num_pages})
+            view = ListView.as_view()
+            for sort in LIST_ORDERINGS:
+                for page in pages:
+                    self.measure(view, goods_type, sort, page, None, options['repeat'])
+                    if page > 1:
+                        self.measure(view, goods_type, sort, page, self.cursor(goods_type, sort, page),
+                                     options['repeat'])
+        finally:
+            delete_skus(goods_type)
+
+    def create(self, goods_type, count, batch_size=5000):
+        start = time.perf_counter()
+        goods = Goods.objects.get(name=goods_type.name)
+        for offset in range(0, count, batch_size):
+            GoodsSKU.objects.bulk_create([
+                GoodsSKU(type=goods_type, goods=goods, name='list_bench_%d' % i, desc='list_bench',
+                         price=Decimal(i % 1000) + Decimal('0.99'), unite='500g', image='goods/list_bench.jpg',
+                         stock=100, sales=i * 7919 % 10000, status=1)
+                for i in range(offset, min(offset + batch_size, count))
+            ])
+        self.stdout.write('生成%d个商品，用时%.1fs' % (count, time.perf_counter() - start))
+
+    def cursor(self, goods_type, sort, page):
+        """ 从上一页翻到page页时链接中的游标 """
+        skus = GoodsSKU.objects.filter(type=goods_type).order_by(*LIST_ORDERINGS[sort])
+        last = skus[(page - 1) * PER_PAGE - 1]
+        return get_list_cursor(last, sort)
+
+    def measure(self, view, goods_type, sort, page, cursor, repeat):
+        factory = RequestFactory()
+        params = {'sort': sort}
+        if cursor:
+            params['cursor'] = cursor
+        latencies = []
+        for i in range(repeat):
+            request = factory.get(reverse('goods:list', args=(goods_type.id, page)), params)
+            request.user = AnonymousUser()
+            request.session = SessionStore()
+            with CaptureQueriesContext(connection) as context:
+                start = time.perf_counter()
+                view(request, type_id=goods_type.id, page=page)
+                latencies.append((time.perf_counter() - start) * 1000)
+        self.stdout.write('sort=%-7s 第%d页 %s sql语句%d条 %s' % (
+            sort, page, '游标' if cursor else 'OFFSET', len(context.captured_queries), summarize(latencies)))
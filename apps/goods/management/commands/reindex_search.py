@@ -0,0 +1,106 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+from datetime import datetime
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections as db_connections
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime, parse_date
+from haystack import connections
+
+from goods.models import GoodsSKU
+from utils.search_backend import SegmentSearchBackend
+from utils.segment_index import write_segment
+
+
+def _init_worker():
+    # spawn方式启动的子进程需要重新初始化django
+    django.setup()
+
+
+def _filter_since(queryset, since):
+    # 商品详情在SPU中，SPU修改后也需要重建索引
+    return queryset.filter(Q(update_time__gte=since) | Q(goods__update_time__gte=since))
+
+
+def build_segment(args):
+    """ 在子进程中把id在[first_id, last_id]之间的商品写成一个段 """
+    using, first_id, last_id, since, path = args
+    backend = connections[using].get_backend()
+    index = connections[using].get_unified_index().get_index(GoodsSKU)
+    queryset = index.index_queryset(using=using).filter(id__gte=first_id, id__lte=last_id)
+    if since is not None:
+        queryset = _filter_since(queryset, since)
+    docs = [backend.prepare(index, sku) for sku in queryset.iterator()]
+    write_segment(path, docs)
+    return path, len(docs)
+
+
+class Command(BaseCommand):
+    help = '按主键分批读取商品，用多个进程并行分词写成段，最后合并成一个段并切换索引'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--using', default='default', help='haystack连接')
+        parser.add_argument('--chunk-size', type=int, default=2000, help='每个段的商品数')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='进程数')
+        parser.add_argument('--since', help='只重建这个时间(update_time)之后修改过的商品，如 2018-12-01 或 "2018-12-01 10:00:00"')
+
+    def parse_since(self, value):
+        since = parse_datetime(value)
+        if since is None:
+            date = parse_date(value)
+            if date is None:
+                raise CommandError('--since的格式不正确: %s' % value)
+            since = datetime(date.year, date.month, date.day)
+        return since
+
+    def chunks(self, queryset, size):
+        """ 按主键顺序分批，每批返回 (第一个id, 最后一个id)，不会一次加载全部商品 """
+        last_id = 0
+        while True:
+            ids = list(queryset.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:size])
+            if not ids:
+                return
+            yield ids[0], ids[-1]
+            last_id = ids[-1]
+
+    def handle(self, *args, **options):
+        using = options['using']
+        backend = connections[using].get_backend()
+        if not isinstance(backend, SegmentSearchBackend):
+            raise CommandError('只支持SegmentEngine，其他搜索引擎请使用rebuild_index')
+        since = self.parse_since(options['since']) if options['since'] else None
+
+        queryset = GoodsSKU.objects.all()
+        if since is not None:
+            queryset = _filter_since(queryset, since)
+
+        start = time.time()
+        # 段先写到索引目录下的临时目录，提交时移动到段目录
+        os.makedirs(backend.index.path, exist_ok=True)
+        staging = tempfile.mkdtemp(prefix='staging_', dir=backend.index.path)
+        try:
+            tasks = [(using, first_id, last_id, since, os.path.join(staging, '%012d' % first_id))
+                     for first_id, last_id in self.chunks(queryset, options['chunk_size'])]
+
+            if options['workers'] > 1 and len(tasks) > 1:
+                # 子进程不能共用父进程的数据库连接
+                db_connections.close_all()
+                with multiprocessing.Pool(options['workers'], initializer=_init_worker) as pool:
+                    results = pool.map(build_segment, tasks, chunksize=1)
+            else:
+                results = [build_segment(task) for task in tasks]
+
+            count = sum(count for path, count in results)
+            paths = [path for path, count in results if count]
+            # 全量重建时丢弃原来的段，增量时只替换修改过的商品，最后合并成一个段
+            backend.commit(segments=paths, replace=since is None, merge=True)
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+
+        self.stdout.write(self.style.SUCCESS('索引了%d个商品，%d个段，用时%.1f秒' % (
+            count, len(tasks), time.time() - start)))
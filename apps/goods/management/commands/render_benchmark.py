@@ -0,0 +1,64 @@
+import time
+import uuid
+
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.sessions.backends.cache import SessionStore
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.template import engines
+from django.template.loader import get_template
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+
+from goods.testdata import clear_caches
+from user.models import User
+from utils.benchmark import summarize
+
+
+BASE_TEMPLATE = 'base_detail_list.html'
+# 缓存分类菜单之前，每次渲染都查询全部商品种类
+UNCACHED_MENU = """{% get_goods_type as type_list %}
+{% for type in type_list %}
+    <li><a href="{% url 'goods:list' type.id 1 %}?sort=default" class="{{ type.logo }}">{{ type.name }}</a></li>
+{% endfor %}"""
+
+
+class Command(BaseCommand):
+    help = '测试列表页和详情页的基础模板的渲染时间，对比分类菜单不缓存和缓存在进程内'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=500, help='每种模板渲染的次数')
+
+    def handle(self, *args, **options):
+        source = get_template(BASE_TEMPLATE).template.source
+        if '{% get_goods_type_menu %}' not in source:
+            self.stderr.write('%s中没有使用get_goods_type_menu' % BASE_TEMPLATE)
+            return
+        before = engines['django'].from_string(source.replace('{% get_goods_type_menu %}', UNCACHED_MENU))
+        after = get_template(BASE_TEMPLATE)
+
+        name = 'bench_%s' % uuid.uuid4().hex[:8]
+        user = User.objects.create_user(username=name, email='%s@example.com' % name, password=uuid.uuid4().hex)
+        try:
+            for label, current_user in (('未登录', AnonymousUser()), ('已登录', user)):
+                clear_caches()
+                self.measure('%s 不缓存菜单' % label, before, current_user, options['repeat'])
+                clear_caches()
+                self.measure('%s 缓存菜单' % label, after, current_user, options['repeat'])
+        finally:
+            user.delete()
+
+    def measure(self, name, template, user, repeat):
+        factory = RequestFactory()
+        latencies = []
+        with CaptureQueriesContext(connection) as context:
+            for i in range(repeat):
+                # 每次渲染都是新的请求，请求内的购物车数量不会被复用
+                request = factory.get('/')
+                request.user = user
+                request.session = SessionStore()
+                start = time.perf_counter()
+                template.render({}, request)
+                latencies.append((time.perf_counter() - start) * 1000)
+            queries = len(context.captured_queries)
+        self.stdout.write('%s 平均每次sql语句%.2f条 %s' % (name, queries / repeat, summarize(latencies)))
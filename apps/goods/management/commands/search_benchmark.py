@@ -0,0 +1,85 @@
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from haystack import connections
+from haystack.query import SearchQuerySet
+
+from goods.search import search_sku_ids, suggest, normalize_query
+from utils.benchmark import summarize
+
+
+# 没有指定查询文件时使用的查询
+DEFAULT_QUERIES = ['草莓', '虾', '苹果', '葡萄', '新鲜', '猪肉', '鸡蛋', '白菜', '大虾 冷冻', '进口 水果']
+
+
+class Command(BaseCommand):
+    help = '测试搜索的查询延迟，对比当前的搜索引擎和whoosh，--replay按查询日志测试搜索缓存和搜索提示'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--queries', help='查询文件，每行一个查询')
+        parser.add_argument('--repeat', type=int, default=10, help='每个查询重复的次数')
+        parser.add_argument('--limit', type=int, default=20, help='每次查询获取的结果数')
+        parser.add_argument('--whoosh-path', default=os.path.join(settings.BASE_DIR, 'whoosh_index'),
+                            help='whoosh索引目录，不存在时不测试whoosh')
+        parser.add_argument('--replay', help='查询日志，每行一个查询，按顺序重放')
+
+    def handle(self, *args, **options):
+        if options['replay']:
+            return self.replay(options['replay'])
+
+        queries = DEFAULT_QUERIES
+        if options['queries']:
+            with open(options['queries'], encoding='utf-8') as f:
+                queries = [line.strip() for line in f if line.strip()]
+
+        usings = ['default']
+        if os.path.isdir(options['whoosh_path']):
+            connections.connections_info['whoosh'] = {
+                'ENGINE': 'haystack.backends.whoosh_cn_backend.WhooshEngine',
+                'PATH': options['whoosh_path'],
+            }
+            usings.append('whoosh')
+
+        for using in usings:
+            self.report(using, self.run(using, queries, options['repeat'], options['limit']))
+
+    def run(self, using, queries, repeat, limit):
+        sqs = SearchQuerySet().using(using)
+        # 先查询一次，不计入加载索引的时间
+        list(sqs.auto_query(queries[0])[:limit])
+        latencies = []
+        for i in range(repeat):
+            for query in queries:
+                start = time.perf_counter()
+                list(sqs.auto_query(query)[:limit])
+                latencies.append((time.perf_counter() - start) * 1000)
+        return latencies
+
+    def report(self, name, latencies):
+        self.stdout.write('%-8s %s' % (name, summarize(latencies)))
+
+    def replay(self, path):
+        """ 按日志顺序重放查询，分别测试不使用缓存的搜索、带缓存的搜索和搜索提示 """
+        with open(path, encoding='utf-8') as f:
+            queries = [line.strip() for line in f if line.strip()]
+        if not queries:
+            return
+
+        def timed(func, args):
+            latencies = []
+            for arg in args:
+                start = time.perf_counter()
+                func(arg)
+                latencies.append((time.perf_counter() - start) * 1000)
+            return latencies
+
+        sqs = SearchQuerySet().filter(status=1)
+        self.report('engine', timed(lambda query: list(sqs.auto_query(query)[:20]), queries))
+        self.report('cached', timed(search_sku_ids, queries))
+        distinct = len({normalize_query(query) for query in queries})
+        self.stdout.write('不同的查询%d个，缓存命中率最高%.1f%%' % (distinct, 100 - 100.0 * distinct / len(queries)))
+        # 搜索提示用每个查询的前1、2个字
+        prefixes = [query[:i] for query in queries for i in (1, 2) if len(query) >= i]
+        self.report('suggest', timed(suggest, prefixes))
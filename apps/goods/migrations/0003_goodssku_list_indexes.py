@@ -0,0 +1,23 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('goods', '0002_auto_20181118_1544'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='goodssku',
+            index=models.Index(fields=['type', 'price'], name='df_sku_type_price_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='goodssku',
+            index=models.Index(fields=['type', 'sales'], name='df_sku_type_sales_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='goodssku',
+            index=models.Index(fields=['type', 'id'], name='df_sku_type_id_idx'),
+        ),
+    ]
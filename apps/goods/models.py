@@ -1,4 +1,5 @@
 from django.db import models
+from django.db.models import Case, When, F
 from db.base_model import BaseModel
 from tinymce.models import HTMLField
 
@@ -18,6 +19,41 @@ class GoodsType(BaseModel):
         return self.name
 
 
+class GoodsSKUManager(models.Manager):
+    """ 商品SKU模型管理类 """
+    def get_skus(self, sku_ids, request=None, fresh=False):
+        """
+        根据id列表批量获取多个商品，按sku_ids的顺序返回，不存在的商品会被跳过
+        传入request时同一个请求中已经查询过的商品不会再查询
+        fresh为True时先检查缓存的版本号，保证价格等是最新的(下单时使用)
+        """
+        sku_ids = [int(sku_id) for sku_id in sku_ids]
+        if request is not None:
+            if not hasattr(request, 'sku_cache'):
+                request.sku_cache = {}
+            sku_cache = request.sku_cache
+        else:
+            sku_cache = {}
+        missing = [sku_id for sku_id in sku_ids if sku_id not in sku_cache]
+        if missing:
+            # 先从商品对象缓存中获取，缓存中没有的再查询数据库
+            from goods.cache import sku_cache as model_cache
+            sku_cache.update(model_cache.get_many(missing, fresh))
+        return [sku_cache[sku_id] for sku_id in sku_ids if sku_id in sku_cache]
+
+    def update_stock(self, counts):
+        """
+        用一条UPDATE语句批量扣减多个商品的库存并增加销量
+        counts: {sku_id: 数量}，数量为负数时归还库存并减少销量
+        """
+        counts = {int(sku_id): int(count) for sku_id, count in counts.items() if int(count)}
+        if not counts:
+            return 0
+        stock = Case(*[When(id=sku_id, then=F('stock') - count) for sku_id, count in counts.items()])
+        sales = Case(*[When(id=sku_id, then=F('sales') + count) for sku_id, count in counts.items()])
+        return self.filter(id__in=counts.keys()).update(stock=stock, sales=sales)
+
+
 class GoodsSKU(BaseModel):
     """ 商品SKU模型类 """
     status_choices = (
@@ -35,10 +71,19 @@ class GoodsSKU(BaseModel):
     sales = models.IntegerField(default=0, verbose_name='商品销量')
     status = models.SmallIntegerField(default=1, choices=status_choices, verbose_name='商品状态')
 
+    # 使用商品SKU模型管理类
+    objects = GoodsSKUManager()
+
     class Meta:
         db_table = 'df_goods_sku'
         verbose_name = '商品'
         verbose_name_plural = verbose_name
+        # 列表页按种类筛选后按价格、销量、id排序
+        indexes = [
+            models.Index(fields=['type', 'price'], name='df_sku_type_price_idx'),
+            models.Index(fields=['type', 'sales'], name='df_sku_type_sales_idx'),
+            models.Index(fields=['type', 'id'], name='df_sku_type_id_idx'),
+        ]
 
     def __str__(self):
         return self.name
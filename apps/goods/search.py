@@ -0,0 +1,183 @@
+import hashlib
+import heapq
+import time
+
+from django.core.cache import cache
+from django.db.models.signals import post_init, post_save, post_delete
+from django_redis import get_redis_connection
+from haystack import connections
+from haystack.query import SearchQuerySet
+from haystack.signals import BaseSignalProcessor
+
+from goods.models import GoodsSKU, Goods
+from utils.search_backend import get_generation, RESERVED_RE
+
+
+SEARCH_QUEUE_KEY = 'search_index_queue'  # 需要更新索引的sku_id 集合，同一个商品多次修改只更新一次
+SEARCH_PROCESSING_KEY = 'search_index_processing'  # 正在更新索引的sku_id
+SEARCH_BATCH = 500  # 每次更新索引的商品数
+
+SEARCH_CACHE_KEY = 'search_%s_%s'  # 搜索结果的缓存 索引版本号, 查询的md5
+SEARCH_CACHE_TIMEOUT = 60
+SEARCH_MAX_RESULTS = 500  # 最多缓存的搜索结果数
+
+SUGGEST_KEY = 'search_suggest_%s_%s'  # 搜索提示 有序集合 版本, 前缀  成员为商品名称 score为销量
+SUGGEST_VERSION_KEY = 'search_suggest_version'
+SUGGEST_PREFIX_LENGTH = 10  # 最长的前缀
+SUGGEST_SIZE = 10  # 每个前缀保存的商品名称数
+SUGGEST_TIMEOUT = 3 * 3600  # 每小时重建一次，旧版本的前缀过期后自动删除
+
+# 索引模板(search/indexes/goods/goodssku_text.txt)和GoodsSKUIndex的过滤、分面字段用到的字段
+# 只修改其他字段(库存、销量等)时不更新索引
+SKU_INDEX_FIELDS = ('name', 'desc', 'goods_id', 'type_id', 'price', 'status')
+GOODS_INDEX_FIELDS = ('detail',)
+
+
+def _snapshot(instance, fields):
+    # 没有加载的字段(only/defer)记为None，不能触发查询
+    return tuple(instance.__dict__.get(field) for field in fields)
+
+
+def remember_index_fields(sender, instance, **kwargs):
+    """ 对象加载时记录索引字段的值，保存时用来判断索引字段有没有修改 """
+    fields = SKU_INDEX_FIELDS if sender is GoodsSKU else GOODS_INDEX_FIELDS
+    instance._index_fields = _snapshot(instance, fields)
+
+
+def index_fields_changed(instance, fields, update_fields=None):
+    if update_fields is not None and not set(update_fields) & set(fields):
+        return False
+    old = getattr(instance, '_index_fields', None)
+    return old is None or None in old or old != _snapshot(instance, fields)
+
+
+def enqueue(sku_ids):
+    """ 需要更新索引的商品放入队列，由celery批量更新 """
+    sku_ids = list(sku_ids)
+    if sku_ids:
+        conn = get_redis_connection('default')
+        conn.sadd(SEARCH_QUEUE_KEY, *sku_ids)
+
+
+class QueuedSignalProcessor(BaseSignalProcessor):
+    """
+    商品修改或删除后不直接写搜索索引，只把sku_id放入redis队列
+    避免保存商品的请求等待索引的写锁
+    """
+    def setup(self):
+        post_init.connect(remember_index_fields, sender=GoodsSKU)
+        post_init.connect(remember_index_fields, sender=Goods)
+        post_save.connect(self.handle_save, sender=GoodsSKU)
+        post_delete.connect(self.handle_delete, sender=GoodsSKU)
+        post_save.connect(self.handle_goods_save, sender=Goods)
+
+    def teardown(self):
+        post_init.disconnect(remember_index_fields, sender=GoodsSKU)
+        post_init.disconnect(remember_index_fields, sender=Goods)
+        post_save.disconnect(self.handle_save, sender=GoodsSKU)
+        post_delete.disconnect(self.handle_delete, sender=GoodsSKU)
+        post_save.disconnect(self.handle_goods_save, sender=Goods)
+
+    def handle_save(self, sender, instance, created=False, update_fields=None, **kwargs):
+        if created or index_fields_changed(instance, SKU_INDEX_FIELDS, update_fields):
+            enqueue([instance.id])
+        instance._index_fields = _snapshot(instance, SKU_INDEX_FIELDS)
+
+    def handle_delete(self, sender, instance, **kwargs):
+        enqueue([instance.id])
+
+    def handle_goods_save(self, sender, instance, created=False, update_fields=None, **kwargs):
+        # 商品详情修改后更新这个SPU下全部SKU的索引
+        if not created and index_fields_changed(instance, GOODS_INDEX_FIELDS, update_fields):
+            enqueue(GoodsSKU.objects.filter(goods_id=instance.id).values_list('id', flat=True))
+        instance._index_fields = _snapshot(instance, GOODS_INDEX_FIELDS)
+
+
+def update_batch(count=SEARCH_BATCH, using='default'):
+    """
+    取出队列中的商品批量更新索引，返回处理的商品数
+    一批商品只获取一次索引的写锁，已删除的商品从索引中删除
+    同一时间只能有一个进程调用
+    """
+    conn = get_redis_connection('default')
+    # 上次处理时进程中断的商品重新处理
+    if not conn.exists(SEARCH_PROCESSING_KEY):
+        if not conn.exists(SEARCH_QUEUE_KEY):
+            return 0
+        conn.rename(SEARCH_QUEUE_KEY, SEARCH_PROCESSING_KEY)
+    sku_ids = [int(sku_id) for sku_id in conn.srandmember(SEARCH_PROCESSING_KEY, count)]
+
+    backend = connections[using].get_backend()
+    index = connections[using].get_unified_index().get_index(GoodsSKU)
+    skus = list(index.index_queryset(using=using).filter(id__in=sku_ids).select_related('goods'))
+    if skus:
+        backend.update(index, skus)
+    exist_ids = {sku.id for sku in skus}
+    for sku_id in sku_ids:
+        if sku_id not in exist_ids:
+            backend.remove('goods.goodssku.%s' % sku_id)
+
+    conn.srem(SEARCH_PROCESSING_KEY, *sku_ids)
+    return len(sku_ids)
+
+
+def normalize_query(query):
+    """ 统一查询的写法，只有空白、大小写、词的顺序不同的查询使用同一个缓存 """
+    words = RESERVED_RE.sub(' ', query).lower().split()
+    return ' '.join(sorted(set(words)))
+
+
+def search_sku_ids(query):
+    """ 搜索上线的商品，返回按相关度排序的sku_id，结果按索引的版本号缓存，索引修改后自动失效 """
+    query = normalize_query(query)
+    if not query:
+        return []
+    key = SEARCH_CACHE_KEY % (get_generation(), hashlib.md5(query.encode()).hexdigest())
+    sku_ids = cache.get(key)
+    if sku_ids is None:
+        results = SearchQuerySet().filter(status=1).auto_query(query)[:SEARCH_MAX_RESULTS]
+        sku_ids = [int(result.pk) for result in results]
+        cache.set(key, sku_ids, SEARCH_CACHE_TIMEOUT)
+    return sku_ids
+
+
+def refresh_suggestions(batch=1000):
+    """ 重建搜索提示: 上线商品名称的每个前缀对应销量最高的SUGGEST_SIZE个名称，写入新版本后再切换 """
+    names = {}
+    for name, sales in GoodsSKU.objects.filter(status=1).values_list('name', 'sales').iterator():
+        name = name.strip()
+        names[name] = max(names.get(name, 0), sales)
+
+    prefixes = {}
+    for name, sales in names.items():
+        lower = name.lower()
+        for i in range(1, min(len(lower), SUGGEST_PREFIX_LENGTH) + 1):
+            prefixes.setdefault(lower[:i], []).append((sales, name))
+
+    conn = get_redis_connection('default')
+    version = int(time.time())
+    pl = conn.pipeline(transaction=False)
+    for i, (prefix, items) in enumerate(prefixes.items()):
+        key = SUGGEST_KEY % (version, prefix)
+        args = []
+        for sales, name in heapq.nlargest(SUGGEST_SIZE, items):
+            args += [sales, name]
+        pl.zadd(key, *args)
+        pl.expire(key, SUGGEST_TIMEOUT)
+        if i % batch == batch - 1:
+            pl.execute()
+    pl.set(SUGGEST_VERSION_KEY, version)
+    pl.execute()
+
+
+def suggest(prefix, count=SUGGEST_SIZE):
+    """ 以prefix开头的商品名称，按销量排序 """
+    prefix = prefix.strip().lower()[:SUGGEST_PREFIX_LENGTH]
+    if not prefix:
+        return []
+    conn = get_redis_connection('default')
+    version = conn.get(SUGGEST_VERSION_KEY)
+    if version is None:
+        return []
+    names = conn.zrevrange(SUGGEST_KEY % (version.decode(), prefix), 0, count - 1)
+    return [name.decode() for name in names]
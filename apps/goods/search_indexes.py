@@ -9,11 +9,19 @@ from .models import GoodsSKU
 class GoodsSKUIndex(indexes.SearchIndex, indexes.Indexable):
     # 索引字段 use_template=True指定根据表中的哪些字段建立索引文件的说明放在一个文件中
     text = indexes.CharField(document=True, use_template=True)
+    # 用于筛选和分面统计的字段
+    type_id = indexes.IntegerField(model_attr='type_id', faceted=True)
+    price = indexes.DecimalField(model_attr='price')
+    status = indexes.IntegerField(model_attr='status', faceted=True)
 
     def get_model(self):
         # 返回你的模型类
         return GoodsSKU
 
-    # 建立索引的数据
+    # 建立索引的数据，索引模板中用到了商品SPU的详情
     def index_queryset(self, using=None):
-        return self.get_model().objects.all()
\ No newline at end of file
+        return self.get_model().objects.select_related('goods', 'type')
+
+    # update_index --age 根据这个字段只更新最近修改过的商品
+    def get_updated_field(self):
+        return 'update_time'
\ No newline at end of file
@@ -1,23 +1,65 @@
+import threading
+import time
+
 from django import template
-from django_redis import get_redis_connection
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+from cart.cart import Cart, get_cart
 from goods.models import GoodsType
+from goods.cache import type_cache
 
 register = template.Library()
 
-@register.simple_tag()
-def get_goods_number(user):
+# 进程内缓存的商品分类菜单，商品种类修改后由信号清除，其他进程最多每隔TYPE_MENU_CHECK秒检查一次版本号
+TYPE_MENU_CHECK = 30
+_type_menu = {'version': None, 'html': None, 'checked': 0}
+_type_menu_lock = threading.Lock()
+
+
+def get_cart_count(request, user):
+    """ 获取用户购物车中的商品的数目，未登录时为session对应的购物车，同一个请求中只查询一次redis """
+    if request is None:
+        return Cart(user.id).kinds() if user.is_authenticated else 0
+    if hasattr(request, 'cart_count'):
+        return request.cart_count
+    cart = get_cart(request)
+    cart_count = cart.kinds() if cart is not None else 0
+    request.cart_count = cart_count
+    return cart_count
+
+
+def clear_type_menu(**kwargs):
+    """ 商品种类修改或删除后清除分类菜单 """
+    with _type_menu_lock:
+        _type_menu['html'] = None
+
+
+@register.simple_tag(takes_context=True)
+def get_goods_number(context, user):
 	# 获取用户购物车中的商品的数目
-    cart_count = 0
-    if user.is_authenticated:
-        conn = get_redis_connection('default')
-        cart_key = 'cart_%d' % user.id
-        cart_count = conn.hlen(cart_key)
-        return cart_count
-    else:
-    	return cart_count
+    return get_cart_count(context.get('request'), user)
 
 
 @register.simple_tag()
 def get_goods_type():
 	types = GoodsType.objects.all()
-	return types
\ No newline at end of file
+	return types
+
+
+@register.simple_tag()
+def get_goods_type_menu():
+    # 商品分类菜单，渲染好的html缓存在进程内
+    now = time.time()
+    with _type_menu_lock:
+        html = _type_menu['html']
+        if html is not None and now - _type_menu['checked'] < TYPE_MENU_CHECK:
+            return mark_safe(html)
+
+    version = type_cache.version()
+    with _type_menu_lock:
+        if _type_menu['html'] is None or _type_menu['version'] != version:
+            types = GoodsType.objects.all()
+            _type_menu['html'] = render_to_string('goods_type_menu.html', {'types': types})
+            _type_menu['version'] = version
+        _type_menu['checked'] = now
+        return mark_safe(_type_menu['html'])
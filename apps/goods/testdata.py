@@ -0,0 +1,50 @@
+import uuid
+from decimal import Decimal
+
+from django.db import connection
+
+from goods.cache import model_caches
+from goods.models import GoodsType, Goods, GoodsSKU
+from goods.templatetags.goods_tags import clear_type_menu
+
+
+def create_skus(count, prefix='bench', **fields):
+    """
+    创建测试和性能测试用的商品种类、SPU和count个SKU，返回 (种类, 按id排序的SKU列表)
+    SKU用bulk_create写入，不触发信号，不会生成静态页面和搜索索引
+    """
+    tag = '%s_%s' % (prefix, uuid.uuid4().hex[:6])
+    goods_type = GoodsType.objects.create(name=tag, logo=tag, image='type/%s.jpg' % tag)
+    goods = Goods.objects.create(name=tag, detail='')
+    values = {
+        'desc': tag,
+        'price': Decimal('10.00'),
+        'unite': '500g',
+        'image': 'goods/%s.jpg' % tag,
+        'stock': 100,
+        'sales': 0,
+        'status': 1,
+    }
+    values.update(fields)
+    skus = [GoodsSKU(type=goods_type, goods=goods, name='%s_%d' % (prefix, i), **values) for i in range(count)]
+    GoodsSKU.objects.bulk_create(skus, batch_size=1000)
+    return goods_type, list(GoodsSKU.objects.filter(type=goods_type).order_by('id'))
+
+
+def delete_skus(goods_type):
+    """ 删除create_skus创建的数据，引用这些SKU的订单需要调用方先删除 """
+    # 商品数量可能很多，直接用sql删除，不逐个触发信号
+    with connection.cursor() as cursor:
+        cursor.execute('DELETE FROM df_goods_sku WHERE type_id = %s', [goods_type.id])
+    Goods.objects.filter(name=goods_type.name).delete()
+    goods_type.delete()
+
+
+def clear_caches():
+    """ 清空进程内的商品对象缓存和分类菜单，下一次请求和新进程一样从redis或mysql读取 """
+    for model_cache in model_caches.values():
+        with model_cache._lock:
+            model_cache._lru.clear()
+        model_cache._version = None
+        model_cache._checked = 0
+    clear_type_menu()
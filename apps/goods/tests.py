@@ -1,3 +1,109 @@
-from django.test import TestCase
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-# Create your tests here.
+from django.core.cache import cache
+from django.db import connection
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from goods.history import History
+from goods.models import GoodsSKU
+from goods.testdata import create_skus
+from utils.cache import cache_aside
+from user.models import User
+from utils.testing import RedisTestMixin
+
+
+class CacheAsideTest(RedisTestMixin, SimpleTestCase):
+    """ 首页等缓存数据失效时只有一个请求重新生成 """
+    key = 'test_cache_aside'
+    concurrency = 200
+
+    def stampede(self, value):
+        """ concurrency个线程同时读取缓存，返回 (生成的次数, 每个线程得到的值) """
+        builds = []
+        lock = threading.Lock()
+        barrier = threading.Barrier(self.concurrency)
+
+        def builder():
+            with lock:
+                builds.append(1)
+            # 模拟生成很慢的页面数据，其他线程在生成期间到达
+            time.sleep(0.5)
+            return value
+
+        def read(i):
+            barrier.wait()
+            return cache_aside(self.key, builder, soft_ttl=60, beta=0)
+
+        with ThreadPoolExecutor(self.concurrency) as pool:
+            results = list(pool.map(read, range(self.concurrency)))
+        return len(builds), results
+
+    def test_cold_key_built_once(self):
+        builds, results = self.stampede('new')
+        self.assertEqual(builds, 1)
+        self.assertEqual(results, ['new'] * self.concurrency)
+
+    def test_stale_key_built_once(self):
+        # 数据已过soft_ttl，拿到锁的线程重新生成，其他线程直接返回旧数据
+        cache.set(self.key, {'value': 'old', 'expires': time.time() - 1, 'delta': 0.5}, 120)
+        builds, results = self.stampede('new')
+        self.assertEqual(builds, 1)
+        self.assertEqual(set(results), {'old', 'new'})
+        self.assertEqual(cache_aside(self.key, lambda: 'again', soft_ttl=60, beta=0), 'new')
+
+
+class UpdateStockTest(RedisTestMixin, TestCase):
+    """ 一条UPDATE批量修改多个商品的库存和销量 """
+    def setUp(self):
+        super(UpdateStockTest, self).setUp()
+        goods_type, self.skus = create_skus(3, prefix='stock_test', stock=10, sales=0)
+
+    def stock(self):
+        return list(GoodsSKU.objects.filter(id__in=[sku.id for sku in self.skus]).order_by('id').values_list(
+            'stock', 'sales'))
+
+    def test_single_case_update(self):
+        first, second, third = self.skus
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(GoodsSKU.objects.update_stock({first.id: 2, str(second.id): '3'}), 2)
+        self.assertEqual(len(context.captured_queries), 1)
+        sql = context.captured_queries[0]['sql']
+        self.assertTrue(sql.startswith('UPDATE'))
+        self.assertIn('CASE', sql)
+        self.assertEqual(self.stock(), [(8, 2), (7, 3), (10, 0)])
+
+    def test_negative_counts_restore(self):
+        first, second, third = self.skus
+        GoodsSKU.objects.update_stock({first.id: 2, second.id: 3})
+        GoodsSKU.objects.update_stock({first.id: -2, second.id: -1})
+        self.assertEqual(self.stock(), [(10, 0), (8, 2), (10, 0)])
+
+    def test_zero_counts_skipped(self):
+        with self.assertNumQueries(0):
+            self.assertEqual(GoodsSKU.objects.update_stock({self.skus[0].id: 0}), 0)
+        self.assertEqual(self.stock(), [(10, 0)] * 3)
+
+
+class DetailUserViewTest(RedisTestMixin, TestCase):
+    """ 静态详情页获取用户信息的GET请求不修改浏览记录，由POST添加 """
+    def setUp(self):
+        super(DetailUserViewTest, self).setUp()
+        goods_type, self.skus = create_skus(2, prefix='detail_user_test')
+        self.user = User.objects.create_user('detail_user_test', 'detail_user_test@test.com', 'pwd')
+        self.client.force_login(self.user)
+
+    def test_get_keeps_history(self):
+        response = self.client.get(reverse('goods:detail_user', args=(self.skus[0].id,)))
+        self.assertEqual(response.json()['res'], 1)
+        self.assertEqual(History(self.user.id).sku_ids(), [])
+
+    def test_post_adds_history(self):
+        first, second = self.skus
+        self.client.post(reverse('goods:detail_user', args=(first.id,)))
+        response = self.client.post(reverse('goods:detail_user', args=(second.id,)))
+        self.assertEqual([item['name'] for item in response.json()['history']], [first.name])
+        self.assertEqual(History(self.user.id).sku_ids(), [second.id, first.id])
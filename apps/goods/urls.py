@@ -1,10 +1,13 @@
 from django.urls import path
-from .views import IndexView, DetailView, ListView
+from .views import IndexView, DetailView, DetailUserView, ListView, SearchView, SuggestView
 
 
 app_name = 'goods'
 urlpatterns = [
     path('index/', IndexView.as_view(), name='index'),  # 首页
     path('goods/<int:goods_id>/', DetailView.as_view(), name='detail'),  # 商品详情页
-    path('list/<int:type_id>/<int:page>/', ListView.as_view(), name='list')  # 列表页
+    path('goods/<int:goods_id>/user/', DetailUserView.as_view(), name='detail_user'),  # 静态详情页的用户信息
+    path('list/<int:type_id>/<int:page>/', ListView.as_view(), name='list'),  # 列表页
+    path('search/', SearchView.as_view(), name='search'),  # 商品搜索
+    path('search/suggest/', SuggestView.as_view(), name='suggest'),  # 搜索提示
 ]
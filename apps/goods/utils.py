@@ -0,0 +1,207 @@
+from decimal import Decimal, InvalidOperation
+
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.db.models import Q
+from django_redis import get_redis_connection
+
+from goods.models import GoodsType, IndexGoodsBanner, IndexPromotionBanner, IndexTypeGoodsBanner, GoodsSKU
+from goods.cache import type_cache, goods_cache, sku_cache
+from order.models import OrderGoods
+from utils import static_page
+from utils.cache import cache_aside, cache_refresh
+
+INDEX_PAGE_KEY = 'index_page_cache'
+INDEX_PAGE_TIMEOUT = 3600
+
+# 列表页的商品数目和新品推荐的缓存时间
+LIST_CACHE_TIMEOUT = 600
+
+# 列表页的排序方式
+LIST_ORDERINGS = {
+    'price': ('price', 'id'),
+    'hot': ('-sales', '-id'),
+    'default': ('-id',),
+}
+
+# 生成静态详情页的热销商品
+HOT_DETAIL_KEY = 'static_detail_skus'
+HOT_DETAIL_COUNT = 100
+
+
+def sku_data(sku):
+    """ 首页展示需要的商品信息 """
+    return {
+        'id': sku.id,
+        'name': sku.name,
+        'image': sku.image.name,
+        'price': sku.price,
+    }
+
+
+def get_index_page_data():
+    """
+    获取首页数据，首页视图和生成静态首页的celery任务共用
+    分类商品展示信息用一次查询取出后在python中按种类分组
+    返回的是普通的字典和列表，不含惰性的QuerySet，缓存体积小，反序列化快
+    """
+    # 获取商品的种类信息
+    types = []
+    type_dict = {}
+    for tp in GoodsType.objects.all():
+        type_dict[tp.id] = {
+            'id': tp.id,
+            'name': tp.name,
+            'logo': tp.logo,
+            'image': tp.image.name,
+            'image_banners': [],
+            'title_banners': [],
+        }
+        types.append(type_dict[tp.id])
+
+    # 获取首页轮播商品信息
+    goods_banners = []
+    for banner in IndexGoodsBanner.objects.select_related('sku').order_by('index'):
+        goods_banners.append({
+            'sku_id': banner.sku_id,
+            'sku': sku_data(banner.sku),
+            'image': banner.image.name,
+        })
+
+    # 获取首页促销活动信息
+    promotion_banners = []
+    for banner in IndexPromotionBanner.objects.order_by('index'):
+        promotion_banners.append({
+            'name': banner.name,
+            'url': banner.url,
+            'image': banner.image.name,
+        })
+
+    # 获取首页分类商品展示信息
+    for banner in IndexTypeGoodsBanner.objects.select_related('sku').order_by('index'):
+        tp = type_dict.get(banner.type_id)
+        if tp is None:
+            continue
+        if banner.display_type == 1:
+            tp['image_banners'].append({'sku': sku_data(banner.sku)})
+        else:
+            tp['title_banners'].append({'sku': sku_data(banner.sku)})
+
+    return {
+        'types': types,
+        'goods_banners': goods_banners,
+        'promotion_banners': promotion_banners
+    }
+
+
+def get_cached_index_page_data():
+    """ 从缓存获取首页数据，缓存过期时只有一个进程重新生成 """
+    return cache_aside(INDEX_PAGE_KEY, get_index_page_data, INDEX_PAGE_TIMEOUT)
+
+
+def refresh_index_page_data():
+    """ 重新生成首页缓存数据 """
+    return cache_refresh(INDEX_PAGE_KEY, get_index_page_data, INDEX_PAGE_TIMEOUT)
+
+
+def get_detail_page_data(sku_id):
+    """ 获取详情页数据，详情页视图和生成静态详情页的celery任务共用，商品不存在时抛出DoesNotExist """
+    sku = sku_cache.get(sku_id)
+    sku.type = type_cache.get(sku.type_id)
+    sku.goods = goods_cache.get(sku.goods_id)
+    # 获取商品的评论信息
+    sku_orders = OrderGoods.objects.filter(sku=sku).exclude(comment='')
+    # 获取新品信息
+    new_skus = get_new_skus(sku.type_id)
+    # 获取同一个spu的其他规格商品
+    same_spu_skus = GoodsSKU.objects.filter(goods=sku.goods).exclude(pk=sku_id)
+    return {
+        'sku': sku,
+        'sku_orders': sku_orders,
+        'new_skus': new_skus,
+        'same_spu_skus': same_spu_skus,
+    }
+
+
+class CountPaginator(Paginator):
+    """ 使用已知总数的分页器，不再执行COUNT(*) """
+    def __init__(self, object_list, per_page, count):
+        super(CountPaginator, self).__init__(object_list, per_page)
+        self.count = count
+
+
+def get_type_sku_count(type_id):
+    """ 种类的商品数目，缓存在redis中，商品修改后版本号变化自动失效 """
+    key = 'list_count_%s_%s' % (type_id, sku_cache.version())
+    count = cache.get(key)
+    if count is None:
+        count = GoodsSKU.objects.filter(type_id=type_id).count()
+        cache.set(key, count, LIST_CACHE_TIMEOUT)
+    return count
+
+
+def get_new_skus(type_id):
+    """ 种类的新品推荐，缓存在redis中，商品修改后版本号变化自动失效 """
+    key = 'new_skus_%s_%s' % (type_id, sku_cache.version())
+    new_skus = cache.get(key)
+    if new_skus is None:
+        new_skus = list(GoodsSKU.objects.filter(type_id=type_id).order_by('-create_time')[:2])
+        cache.set(key, new_skus, LIST_CACHE_TIMEOUT)
+    return new_skus
+
+
+def get_list_cursor(sku, sort):
+    """ 商品在列表中的位置，作为下一页的游标 """
+    if sort == 'price':
+        return '%s_%s' % (sku.price, sku.id)
+    if sort == 'hot':
+        return '%s_%s' % (sku.sales, sku.id)
+    return str(sku.id)
+
+
+def get_skus_after(skus, sort, cursor, count):
+    """
+    根据游标获取列表的下一页(keyset分页)，利用(type_id, 排序字段)索引，不需要OFFSET
+    游标无效时返回None
+    """
+    try:
+        if sort == 'price':
+            price, sku_id = cursor.split('_')
+            price, sku_id = Decimal(price), int(sku_id)
+            condition = Q(price__gt=price) | Q(price=price, id__gt=sku_id)
+        elif sort == 'hot':
+            sales, sku_id = cursor.split('_')
+            sales, sku_id = int(sales), int(sku_id)
+            condition = Q(sales__lt=sales) | Q(sales=sales, id__lt=sku_id)
+        else:
+            condition = Q(id__lt=int(cursor))
+    except (ValueError, InvalidOperation):
+        return None
+    return list(skus.filter(condition)[:count])
+
+
+def get_hot_detail_skus():
+    """ 已生成静态详情页的商品id """
+    conn = get_redis_connection('default')
+    return {int(sku_id) for sku_id in conn.smembers(HOT_DETAIL_KEY)}
+
+
+def schedule_detail_pages(sku_ids):
+    """ 商品、同SPU商品或评论修改后重新生成静态详情页，只处理热销商品 """
+    from celery_tasks.tasks import generate_static_detail_html
+    hot_skus = get_hot_detail_skus()
+    for sku_id in set(int(sku_id) for sku_id in sku_ids) & hot_skus:
+        static_page.schedule(generate_static_detail_html, 'detail_%s' % sku_id, args=(sku_id,))
+
+
+def sku_changed(sender, instance, created=False, **kwargs):
+    # 商品修改后，同SPU的商品页面中的规格列表也要更新，新增商品时同种类商品的新品推荐也要更新
+    skus = GoodsSKU.objects.filter(goods_id=instance.goods_id)
+    if created:
+        skus = skus | GoodsSKU.objects.filter(type_id=instance.type_id)
+    schedule_detail_pages([instance.id] + list(skus.values_list('id', flat=True)))
+
+
+def goods_changed(sender, instance, **kwargs):
+    # SPU的商品详情修改后更新它的全部商品
+    schedule_detail_pages(GoodsSKU.objects.filter(goods=instance).values_list('id', flat=True))
@@ -1,10 +1,25 @@
 from django.shortcuts import render, redirect, reverse
 from django.views.generic import View
-from django.core.cache import cache
-from django.core.paginator import Paginator
-from goods.models import GoodsType, IndexGoodsBanner, IndexPromotionBanner, IndexTypeGoodsBanner, GoodsSKU
-from order.models import OrderGoods
-from django_redis import get_redis_connection
+from django.http import JsonResponse
+from django.conf import settings
+from django.core.paginator import Paginator, InvalidPage
+from django.middleware.csrf import get_token
+from goods.models import GoodsType, GoodsSKU, Goods
+from goods.utils import get_cached_index_page_data, get_detail_page_data
+from goods.utils import LIST_ORDERINGS, CountPaginator, get_type_sku_count, get_new_skus, get_skus_after, get_list_cursor
+from goods.cache import type_cache
+from goods.search import search_sku_ids, suggest
+from goods.history import History
+from cart.cart import Cart, get_cart
+
+# 详情页"最近浏览"显示的商品数
+RECENT_VIEWED_COUNT = 5
+
+
+def add_history(user, goods_id, request=None):
+    """ 添加用户的浏览记录，返回除当前商品外最近浏览的商品 """
+    sku_ids = History(user.id).add(goods_id)
+    return History.skus(sku_ids, RECENT_VIEWED_COUNT, exclude=int(goods_id), request=request)
 
 
 class IndexView(View):
@@ -13,26 +28,8 @@ class IndexView(View):
     首页
     """
     def get(self, request):
-        context = cache.get('index_page_data')  # 获取缓存数据
-        if context is None:  # 没有的话就获取数据
-            types = GoodsType.objects.all()  # 获取商品的种类信息
-            goods_banners = IndexGoodsBanner.objects.all().order_by('index')  # 获取首页轮播商品信息
-            promotion_banners = IndexPromotionBanner.objects.all().order_by('index')  # 获取首页促销活动信息
-
-            # 获取首页分类商品展示信息
-            for tp in types:
-                image_banners = IndexTypeGoodsBanner.objects.filter(
-                    type=tp, display_type=1).order_by('index')
-                title_banners = IndexTypeGoodsBanner.objects.filter(
-                    type=tp, display_type=0).order_by('index')
-                tp.image_banners = image_banners
-                tp.title_banners = title_banners
-            context = {
-                'types': types,
-                'goods_banners': goods_banners,
-                'promotion_banners': promotion_banners
-            }
-            cache.set('index_page_data', context, 3600)  # 设置缓存数据（键，值，过期时间）
+        # 获取缓存数据，没有或过期的话只由一个进程重新生成，其他进程返回旧数据或等待
+        context = get_cached_index_page_data()
 
         # # 获取用户购物车中的商品的数目
         # user = request.user
@@ -53,41 +50,58 @@ class DetailView(View):
     """
     def get(self, request, goods_id):
         try:
-            sku = GoodsSKU.objects.get(pk=goods_id)
-        except GoodsSKU.DoesNotExist:
+            context = get_detail_page_data(goods_id)
+        except (GoodsSKU.DoesNotExist, GoodsType.DoesNotExist, Goods.DoesNotExist):
             # 商品不存在
             return redirect(reverse('goods:index'))
-        # 获取全部分类
-        # types = GoodsType.objects.all()
-        # 获取商品的评论信息
-        sku_orders = OrderGoods.objects.filter(sku=sku).exclude(comment='')
-        # 获取新品信息
-        new_skus = GoodsSKU.objects.filter(type=sku.type).order_by('-create_time')[:2]
-        # 获取同一个spu的其他规格商品
-        same_spu_skus = GoodsSKU.objects.filter(goods=sku.goods).exclude(pk=goods_id)
-        # # 获取用户购物车中的商品数目
+
+        # 添加用户的浏览记录，同时获取最近浏览的商品
         user = request.user
-        # cart_count = 0
         if user.is_authenticated:
-            conn = get_redis_connection('default')
-            # cart_key = 'cart_%d' % user.id
-            # cart_count = conn.hlen(cart_key)
-
-            # 添加用户的浏览记录
-            # conn = get_redis_connection('default')
-            history_key = 'history_%d' % user.id
-            conn.lrem(history_key, 0, goods_id)  # 移除旧纪录
-            conn.lpush(history_key, goods_id)  # 从列表左侧插入新纪录
-            conn.ltrim(history_key, 0, 4)
-        # 组织上下文
-        context = {'sku': sku,
-                    'sku_orders': sku_orders,
-                    'new_skus': new_skus,
-                    'same_spu_skus': same_spu_skus,
-        }
+            context = dict(context, history_skus=add_history(user, goods_id, request))
         return render(request, 'detail.html', context)
 
 
+class DetailUserView(View):
+    """
+    /goods/商品id/user
+    静态详情页中和用户相关的信息
+    静态详情页由nginx直接返回，页面加载后通过ajax获取登录状态、购物车数目、csrf token
+    已登录时页面再用POST添加浏览记录并获取最近浏览的商品，GET请求不修改数据
+    """
+    def get(self, request, goods_id):
+        user = request.user
+        if not user.is_authenticated:
+            # 未登录时返回session对应的购物车中的商品数目
+            cart = get_cart(request)
+            cart_count = cart.kinds() if cart is not None else 0
+            return JsonResponse({'res': 0, 'cart_count': cart_count, 'csrf': get_token(request)})
+
+        cart_count = Cart(user.id).kinds()
+        return JsonResponse({
+            'res': 1,
+            'username': user.username,
+            'cart_count': cart_count,
+            'csrf': get_token(request),
+        })
+
+    def post(self, request, goods_id):
+        user = request.user
+        if not user.is_authenticated:
+            return JsonResponse({'res': 0, 'errmsg': '用户未登录'})
+
+        history_skus = add_history(user, goods_id, request)
+        return JsonResponse({
+            'res': 1,
+            'history': [{
+                'url': reverse('goods:detail', args=(sku.id,)),
+                'name': sku.name,
+                'image': sku.image.url,
+                'price': str(sku.price),
+            } for sku in history_skus],
+        })
+
+
 class ListView(View):
     """
     /list/种类id/页码?sort=排序方式
@@ -95,21 +109,17 @@ class ListView(View):
     """
     def get(self, request, type_id, page):
         try:
-            type = GoodsType.objects.get(pk=type_id)
+            type = type_cache.get(type_id)
         except GoodsType.DoesNotExist:
             return redirect(reverse('goods:index'))
         # types = GoodsType.objects.all()
         sort = request.GET.get('sort', '')
-        if sort == 'price':
-            skus = GoodsSKU.objects.filter(type=type).order_by('price')
-        elif sort == 'hot':
-            skus = GoodsSKU.objects.filter(type=type).order_by('-sales')
-        else:
+        if sort not in LIST_ORDERINGS:
             sort = 'default'
-            skus = GoodsSKU.objects.filter(type=type).order_by('-id')
+        skus = GoodsSKU.objects.filter(type=type).order_by(*LIST_ORDERINGS[sort])
 
-        # 对数据进行分页
-        paginator = Paginator(skus, 2)
+        # 对数据进行分页，商品总数使用缓存
+        paginator = CountPaginator(skus, 2, get_type_sku_count(type.id))
         try:
             page = int(page)
         except Exception:
@@ -118,6 +128,18 @@ class ListView(View):
             page = 1
         skus_page = paginator.page(page)
 
+        # 从上一页翻过来时带有游标，按游标获取当前页的商品，避免OFFSET越翻越慢
+        cursor = request.GET.get('cursor', '')
+        if cursor:
+            sku_list = get_skus_after(skus, sort, cursor, paginator.per_page)
+            if sku_list is not None:
+                skus_page.object_list = sku_list
+
+        # 下一页的游标
+        next_cursor = ''
+        if skus_page.has_next():
+            next_cursor = get_list_cursor(list(skus_page)[-1], sort)
+
         # todo: 进行页码的控制，页面上最多显示5个页码
         # 1.总页数小于5页，页面上显示所有页码
         # 2.如果当前页是前3页，显示1-5页
@@ -134,7 +156,7 @@ class ListView(View):
             pages = range(page - 2, page + 3)
 
         # 获取新品信息
-        new_skus = GoodsSKU.objects.filter(type=type).order_by('-create_time')[:2]
+        new_skus = get_new_skus(type.id)
 
         # 获取用户购物车中商品的数目
         # user = request.user
@@ -148,6 +170,40 @@ class ListView(View):
                    'skus_page': skus_page,
                    'new_skus': new_skus,
                    'pages': pages,
+                   'next_cursor': next_cursor,
                    'sort': sort
         }
         return render(request, 'list.html', context)
+
+
+class SearchView(View):
+    """
+    /search?q=关键字&page=页码
+    商品搜索，搜索结果按索引版本缓存在redis中
+    """
+    def get(self, request):
+        query = request.GET.get('q', '').strip()
+        sku_ids = search_sku_ids(query)
+
+        paginator = Paginator(sku_ids, settings.HAYSTACK_SEARCH_RESULTS_PER_PAGE)
+        try:
+            page = paginator.page(request.GET.get('page', 1))
+        except InvalidPage:
+            page = paginator.page(1)
+        # 一次查询获取当前页的商品
+        page.object_list = GoodsSKU.objects.get_skus(page.object_list, request=request)
+
+        return render(request, 'search/search.html', {
+            'query': query,
+            'page': page,
+            'paginator': paginator,
+        })
+
+
+class SuggestView(View):
+    """
+    /search/suggest?q=前缀
+    搜索框的输入提示，返回以前缀开头的商品名称，按销量排序
+    """
+    def get(self, request):
+        return JsonResponse({'res': 1, 'words': suggest(request.GET.get('q', ''))})
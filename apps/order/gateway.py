@@ -0,0 +1,160 @@
+import http.client
+import logging
+import threading
+from decimal import Decimal, InvalidOperation
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from alipay import AliPay
+from alipay.exceptions import AliPayException
+
+
+logger = logging.getLogger('django')
+
+
+class KeepAliveAliPay(AliPay):
+    """
+    复用https连接的支付宝接口对象
+    每个线程保持一个到支付宝网关的长连接，不再每次请求都重新建立连接
+    查询时使用了SDK(python-alipay-sdk 1.8.0)的内部成员，升级后缺少这些成员时使用SDK原来的查询方法
+    """
+    SDK_MEMBERS = ('_gateway', 'build_body', 'sign_data', '_verify_and_return_sync_response')
+
+    def __init__(self, *args, **kwargs):
+        super(KeepAliveAliPay, self).__init__(*args, **kwargs)
+        self._local = threading.local()
+        missing = [name for name in self.SDK_MEMBERS if not hasattr(self, name)]
+        self.keep_alive = not missing
+        if missing:
+            logger.warning('支付宝SDK缺少%s，不使用长连接查询订单', ', '.join(missing))
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            host = urlsplit(self._gateway).netloc
+            conn = http.client.HTTPSConnection(host, timeout=15)
+            self._local.conn = conn
+        return conn
+
+    def _request(self, query_string):
+        """ 发送GET请求，连接被服务器关闭时重新连接一次 """
+        path = urlsplit(self._gateway).path + '?' + query_string
+        for i in range(2):
+            conn = self._connection()
+            try:
+                conn.request('GET', path)
+                return conn.getresponse().read().decode('utf-8')
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                self._local.conn = None
+                if i == 1:
+                    raise
+
+    def api_alipay_trade_query(self, out_trade_no=None, trade_no=None):
+        if not self.keep_alive:
+            return super(KeepAliveAliPay, self).api_alipay_trade_query(out_trade_no=out_trade_no, trade_no=trade_no)
+        biz_content = {}
+        if out_trade_no:
+            biz_content['out_trade_no'] = out_trade_no
+        if trade_no:
+            biz_content['trade_no'] = trade_no
+        data = self.build_body('alipay.trade.query', biz_content)
+        raw_string = self._request(self.sign_data(data))
+        return self._verify_and_return_sync_response(raw_string, 'alipay_trade_query_response')
+
+
+class PayBackend(object):
+    """ 支付方式的接口 """
+    app_id = None  # 商户在支付平台的应用id
+    errors = (OSError, http.client.HTTPException)  # 网络错误等稍后重试就可能成功的异常
+
+    def pay_url(self, order, timeout):
+        """ 返回用户支付订单的地址，timeout秒后关闭交易 """
+        raise NotImplementedError
+
+    def query(self, order_id):
+        """
+        查询订单的支付结果
+        返回 ('success', 交易号) ('wait', None) 或 ('fail', None)
+        """
+        raise NotImplementedError
+
+    def verify(self, data, signature):
+        """ 验证异步通知的签名 """
+        raise NotImplementedError
+
+    def check_notify(self, data, order):
+        """ 签名验证通过后，检查异步通知的应用id和金额和订单一致 """
+        try:
+            amount = Decimal(data.get('total_amount', ''))
+        except InvalidOperation:
+            return False
+        return data.get('app_id') == self.app_id and amount == order.total_price + order.transit_price
+
+
+class AlipayBackend(PayBackend):
+    """ 支付宝 """
+    GATEWAY = 'https://openapi.alipaydev.com/gateway.do?'
+    app_id = '2016092300580591'
+    errors = PayBackend.errors + (AliPayException,)
+
+    def __init__(self):
+        # 创建时解析密钥，之后进程内一直复用
+        self.alipay = KeepAliveAliPay(
+            appid=self.app_id,
+            app_notify_url=settings.ALIPAY_NOTIFY_URL,  # 默认回调url
+            app_private_key_string=settings.APP_PRIVATE_KEY_STRING,  # 应用的私匙
+            # 支付宝的公钥，验证支付宝回传消息使用，不是你自己的公钥,
+            alipay_public_key_string=settings.ALIPAY_PUBLIC_KEY_STRING,
+            sign_type="RSA2",  # RSA 或者 RSA2
+            debug=True,  # 默认False
+        )
+
+    def pay_url(self, order, timeout):
+        # 电脑网站支付，需要跳转到https://openapi.alipay.com/gateway.do? + order_string
+        total_pay = order.total_price + order.transit_price  # Decimal
+        order_string = self.alipay.api_alipay_trade_page_pay(
+            out_trade_no=str(order.order_id),  # 订单id
+            total_amount=str(total_pay),  # 支付总金额
+            subject='天天生鲜%s' % order.order_id,
+            return_url=None,
+            notify_url=settings.ALIPAY_NOTIFY_URL,  # 可选, 不填则使用默认notify url
+            timeout_express='%dm' % max(timeout // 60, 1),  # 超时后支付宝关闭交易，单位分钟
+        )
+        return self.GATEWAY + order_string
+
+    def query(self, order_id):
+        response = self.alipay.api_alipay_trade_query(order_id)
+        code = response.get('code')
+        if code == '10000' and response.get('trade_status') == 'TRADE_SUCCESS':
+            # 支付成功
+            return 'success', response.get('trade_no')
+        elif code == '40004' or (code == '10000' and response.get('trade_status') == 'WAIT_BUYER_PAY'):
+            # 等待买家付款
+            return 'wait', None
+        # 支付出错
+        return 'fail', None
+
+    def verify(self, data, signature):
+        return self.alipay.verify(data, signature)
+
+
+# 各支付方式(OrderInfo.PAY_METHODS)的实现，货到付款不需要在线支付，微信和银联暂未接入
+PAY_BACKENDS = {
+    '3': AlipayBackend,
+}
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+def get_backend(pay_method):
+    """ 获取支付方式的接口对象，每个进程只创建一次，不支持在线支付时返回None """
+    pay_method = str(pay_method)
+    backend = _backends.get(pay_method)
+    if backend is None and pay_method in PAY_BACKENDS:
+        with _backends_lock:
+            backend = _backends.get(pay_method)
+            if backend is None:
+                backend = _backends[pay_method] = PAY_BACKENDS[pay_method]()
+    return backend
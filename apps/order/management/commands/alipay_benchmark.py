@@ -0,0 +1,27 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from order.gateway import AlipayBackend
+from utils.snowflake import next_id
+
+
+class Command(BaseCommand):
+    help = '测试支付宝请求签名的吞吐量，对比每次请求创建接口对象(重新解析密钥)和进程内复用一个接口对象'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=1000, help='每种方式签名的次数')
+
+    def handle(self, *args, **options):
+        count = options['count']
+        shared = AlipayBackend().alipay
+        self.measure('每次创建接口对象', count, lambda: AlipayBackend().alipay)
+        self.measure('复用接口对象', count, lambda: shared)
+
+    def measure(self, name, count, get_alipay):
+        start = time.perf_counter()
+        for i in range(count):
+            alipay = get_alipay()
+            alipay.sign_data(alipay.build_body('alipay.trade.query', {'out_trade_no': str(next_id())}))
+        total = time.perf_counter() - start
+        self.stdout.write('%s 签名%.0f次/秒 平均%.3fms' % (name, count / total, total * 1000 / count))
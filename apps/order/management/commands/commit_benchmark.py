@@ -0,0 +1,107 @@
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django_redis import get_redis_connection
+
+from goods.models import GoodsSKU
+from goods.testdata import create_skus, delete_skus
+from order.models import OrderInfo, OrderGoods
+from order.pipeline import enqueue, persist_batch, ORDER_QUEUE_KEY, ORDER_STATE_KEY
+from order.stock import StockReservation, STOCK_KEY, STATUS_KEY, PENDING_KEY
+from user.models import User, Address
+from utils.benchmark import summarize
+from utils.snowflake import next_id
+
+
+def commit_per_line(order_id, user, addr, items):
+    """ 原来的写入方式: 事务中逐个商品读取、乐观锁更新库存并插入订单商品 """
+    with transaction.atomic():
+        order = OrderInfo.objects.create(order_id=order_id, user=user, addr=addr, pay_method=3, total_count=0,
+                                         total_price=0, transit_price=10)
+        total_count = 0
+        total_price = 0
+        for sku_id, count in items:
+            sku = GoodsSKU.objects.get(pk=sku_id)
+            GoodsSKU.objects.filter(id=sku.id, stock=sku.stock).update(stock=sku.stock - count,
+                                                                       sales=sku.sales + count)
+            OrderGoods.objects.create(order=order, sku=sku, count=count, price=sku.price)
+            total_count += count
+            total_price += sku.price * count
+        order.total_count = total_count
+        order.total_price = total_price
+        order.save()
+
+
+class Command(BaseCommand):
+    help = '测试1、10、50个商品的订单的写入延迟，对比逐个商品写入和redis预扣+批量写入'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='1,10,50', help='订单中的商品数，逗号分隔')
+        parser.add_argument('--repeat', type=int, default=50, help='每种订单写入的次数')
+
+    def handle(self, *args, **options):
+        conn = get_redis_connection('default')
+        if conn.llen(ORDER_QUEUE_KEY):
+            self.stderr.write('订单队列中还有未写入的订单，等celery处理完后再测试')
+            return
+        sizes = [int(size) for size in options['sizes'].split(',')]
+        repeat = options['repeat']
+
+        name = 'bench_%s' % uuid.uuid4().hex[:8]
+        user = User.objects.create_user(username=name, email='%s@example.com' % name, password=uuid.uuid4().hex)
+        goods_type, skus = create_skus(max(sizes), prefix='commit_bench', stock=len(sizes) * repeat * 2)
+        order_ids = []
+        try:
+            addr = Address.objects.create(user=user, receiver=name, addr='benchmark', phone='13800000000')
+            reservation = StockReservation(conn)
+            for size in sizes:
+                items = [(sku.id, 1) for sku in skus[:size]]
+                latencies = []
+                for i in range(repeat):
+                    order_id = next_id()
+                    order_ids.append(order_id)
+                    start = time.perf_counter()
+                    commit_per_line(order_id, user, addr, items)
+                    latencies.append((time.perf_counter() - start) * 1000)
+                self.stdout.write('%d个商品 逐个写入 %s' % (size, summarize(latencies)))
+
+                request_latencies = []
+                persist_latencies = []
+                for i in range(repeat):
+                    order_id = next_id()
+                    order_ids.append(order_id)
+                    start = time.perf_counter()
+                    reservation.reserve(order_id, items, expire=False)
+                    enqueue({
+                        'order_id': order_id,
+                        'user_id': user.id,
+                        'addr_id': addr.id,
+                        'pay_method': 3,
+                        'transit_price': '10',
+                        'total_count': size,
+                        'total_price': str(sum(sku.price for sku in skus[:size])),
+                        'items': [[sku.id, 1, str(sku.price)] for sku in skus[:size]],
+                    })
+                    middle = time.perf_counter()
+                    # celery中的写入，这里每单单独写入一次，是批量写入最慢的情况
+                    persist_batch()
+                    end = time.perf_counter()
+                    request_latencies.append((middle - start) * 1000)
+                    persist_latencies.append((end - middle) * 1000)
+                self.stdout.write('%d个商品 下单请求 %s' % (size, summarize(request_latencies)))
+                self.stdout.write('%d个商品 批量写入 %s' % (size, summarize(persist_latencies)))
+        finally:
+            OrderGoods.objects.filter(order__user=user).delete()
+            OrderInfo.objects.filter(user=user).delete()
+            user.delete()
+            sku_ids = [sku.id for sku in skus]
+            pl = conn.pipeline()
+            pl.delete(*[STOCK_KEY % sku_id for sku_id in sku_ids])
+            pl.hdel(STATUS_KEY, *sku_ids)
+            pl.hdel(PENDING_KEY, *sku_ids)
+            if order_ids:
+                pl.delete(*[ORDER_STATE_KEY % order_id for order_id in order_ids])
+            pl.execute()
+            delete_skus(goods_type)
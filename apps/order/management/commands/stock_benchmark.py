@@ -0,0 +1,136 @@
+import queue
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django_redis import get_redis_connection
+
+from goods.models import GoodsSKU
+from goods.testdata import create_skus, delete_skus
+from order.stock import StockReservation, STOCK_KEY, STATUS_KEY, PENDING_KEY, MISSING_KEY
+from utils.benchmark import summarize
+from utils.snowflake import next_id
+
+
+PERSIST_BATCH = 100  # 和celery批量写入订单时每批的数量相同
+
+
+def optimistic_deduct(sku_id, count):
+    """
+    原来下单时的mysql乐观锁: 读取库存，按读到的库存条件更新，失败重试三次，返回是否扣减成功
+    原代码在条件更新前调用了sku.save()，这里用不触发信号的update写入同样的值
+    """
+    with transaction.atomic():
+        for i in range(3):
+            sku = GoodsSKU.objects.get(pk=sku_id)
+            if count > sku.stock:
+                return False
+            origin_stock = sku.stock
+            new_stock = origin_stock - count
+            new_sales = sku.sales + count
+            GoodsSKU.objects.filter(pk=sku.id).update(stock=sku.stock, sales=sku.sales)
+            res = GoodsSKU.objects.filter(id=sku.id, stock=origin_stock).update(stock=new_stock, sales=new_sales)
+            if res:
+                return True
+    return False
+
+
+class Command(BaseCommand):
+    help = '模拟秒杀，对比mysql乐观锁和redis库存预扣的下单速度(单/秒)和超卖数量'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--skus', type=int, default=3, help='参与秒杀的商品数')
+        parser.add_argument('--stock', type=int, default=200, help='每个商品的库存')
+        parser.add_argument('--orders', type=int, default=2000, help='下单次数，每单购买一件商品')
+        parser.add_argument('--workers', type=int, default=32, help='并发下单的线程数')
+
+    def handle(self, *args, **options):
+        for name, run in (('mysql乐观锁', self.run_optimistic), ('redis预扣', self.run_reservation)):
+            goods_type, skus = create_skus(options['skus'], prefix='stock_bench', stock=options['stock'])
+            sku_ids = [sku.id for sku in skus]
+            try:
+                result = run(sku_ids, options)
+                self.report(name, sku_ids, options['stock'], *result)
+            finally:
+                self.clean(sku_ids)
+                delete_skus(goods_type)
+
+    def run_threads(self, tasks, workers, order):
+        """ 多个线程并发执行order(sku_id)，返回 (总用时, 成功的结果, 每单延迟) """
+        pending = queue.Queue()
+        for task in tasks:
+            pending.put(task)
+        results = []
+        latencies = []
+        lock = threading.Lock()
+
+        def work():
+            try:
+                while True:
+                    try:
+                        sku_id = pending.get_nowait()
+                    except queue.Empty:
+                        return
+                    start = time.perf_counter()
+                    res = order(sku_id)
+                    cost = (time.perf_counter() - start) * 1000
+                    with lock:
+                        latencies.append(cost)
+                        if res:
+                            results.append(res)
+            finally:
+                # 每个线程有自己的数据库连接
+                connection.close()
+
+        begin = time.perf_counter()
+        threads = [threading.Thread(target=work) for i in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - begin, results, latencies
+
+    def tasks(self, sku_ids, options):
+        return [sku_ids[i % len(sku_ids)] for i in range(options['orders'])]
+
+    def run_optimistic(self, sku_ids, options):
+        total, results, latencies = self.run_threads(
+            self.tasks(sku_ids, options), options['workers'], lambda sku_id: optimistic_deduct(sku_id, 1))
+        return total, len(results), latencies
+
+    def run_reservation(self, sku_ids, options):
+        reservation = StockReservation()
+
+        def order(sku_id):
+            order_id = next_id()
+            if reservation.reserve(order_id, [(sku_id, 1)], expire=False) is None:
+                return order_id
+            return None
+
+        total, order_ids, latencies = self.run_threads(self.tasks(sku_ids, options), options['workers'], order)
+        # 和celery一样分批写入mysql，写入时间也计入总用时
+        start = time.perf_counter()
+        for i in range(0, len(order_ids), PERSIST_BATCH):
+            reservation.persist_many(order_ids[i:i + PERSIST_BATCH])
+        total += time.perf_counter() - start
+        return total, len(order_ids), latencies
+
+    def report(self, name, sku_ids, stock, total, succeeded, latencies):
+        # 超卖: 成功的订单数超过库存，或者mysql中的库存和销量对不上
+        rows = GoodsSKU.objects.filter(id__in=sku_ids).values_list('stock', 'sales')
+        sold = sum(sales for stock_left, sales in rows)
+        oversold = max(0, succeeded - stock * len(sku_ids)) + sum(
+            max(0, -stock_left) for stock_left, sales in rows)
+        lost = sum(abs(stock - stock_left - sales) for stock_left, sales in rows)
+        self.stdout.write('%s %.0f次下单/秒 成功%d单 mysql销量%d 超卖%d件 库存和销量不一致%d件 延迟%s' % (
+            name, len(latencies) / total if total else 0, succeeded, sold, oversold, lost, summarize(latencies)))
+
+    def clean(self, sku_ids):
+        conn = get_redis_connection('default')
+        pl = conn.pipeline()
+        pl.delete(*[STOCK_KEY % sku_id for sku_id in sku_ids])
+        pl.delete(*[MISSING_KEY % sku_id for sku_id in sku_ids])
+        pl.hdel(STATUS_KEY, *sku_ids)
+        pl.hdel(PENDING_KEY, *sku_ids)
+        pl.execute()
@@ -0,0 +1,101 @@
+from datetime import timedelta, timezone
+
+from django.db import migrations, models
+from django_redis import get_redis_connection
+
+
+# 和utils.snowflake的id格式相同: 41位毫秒时间戳 + 10位机器号 + 12位序号
+EPOCH = 1514736000000  # 2018-01-01 00:00:00 (UTC+8)
+SEQUENCE_BITS = 12
+TIME_SHIFT = 10 + SEQUENCE_BITS
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+# USE_TZ=False，create_time保存的是TIME_ZONE(Asia/Shanghai)的时间，不能按执行迁移的机器的时区转换
+LOCAL_TZ = timezone(timedelta(hours=8))
+UNPAID = 1
+
+# 以订单id为key或成员的redis数据，和order.stock、order.payment、order.pipeline中的定义相同
+RENAME_KEYS = ['stock_reserve_%s', 'pay_result_%s', 'order_state_%s']
+ZSET_MEMBERS = ['stock_reserve_expire', 'pay_pending']
+HASH_FIELDS = ['pay_attempts', 'pay_refund']
+
+
+def remap_redis(mapping):
+    """ 把redis中以旧订单id保存的预扣记录、支付查询和处理进度改成新id """
+    conn = get_redis_connection('default')
+    for old_id, new_id in mapping.items():
+        for key in RENAME_KEYS:
+            if conn.exists(key % old_id):
+                conn.rename(key % old_id, key % new_id)
+        for key in ZSET_MEMBERS:
+            score = conn.zscore(key, old_id)
+            if score is not None:
+                conn.zadd(key, score, new_id)
+                conn.zrem(key, old_id)
+        for key in HASH_FIELDS:
+            value = conn.hget(key, old_id)
+            if value is not None:
+                conn.hset(key, new_id, value)
+                conn.hdel(key, old_id)
+
+
+def remap_legacy_ids(apps, schema_editor):
+    """
+    旧的订单id是 下单时间(YYYYmmddHHMMSS) + 用户id 的字符串，可能超过BIGINT的范围，
+    数值大小也和新id的时间顺序不一致，转换类型前按下单时间改成雪花算法格式的id
+    机器号为0，同一毫秒的订单用序号区分，时间都早于迁移时间，不会和之后生成的id重复
+    待支付的订单已经用旧id作为支付宝的out_trade_no，改id后支付结果对应不上，有这样的订单时不执行迁移
+    """
+    OrderInfo = apps.get_model('order', 'OrderInfo')
+    OrderGoods = apps.get_model('order', 'OrderGoods')
+    unpaid = OrderInfo.objects.filter(order_status=UNPAID, is_delete=False).count()
+    if unpaid:
+        raise RuntimeError('还有%d个待支付的订单，订单id改为雪花算法格式后支付宝的通知和查询无法对应，'
+                           '等这些订单支付或超时取消后再执行迁移' % unpaid)
+    last_ms = -1
+    sequence = 0
+    mapping = {}
+    # 先取出全部旧id，遍历时会插入和删除订单
+    orders = list(OrderInfo.objects.order_by('create_time', 'order_id').values_list('order_id', 'create_time'))
+    for old_id, create_time in orders:
+        ms = max(int(create_time.replace(tzinfo=LOCAL_TZ).timestamp() * 1000) - EPOCH, 0)
+        if ms <= last_ms:
+            sequence += 1
+            if sequence > MAX_SEQUENCE:
+                last_ms += 1
+                sequence = 0
+            ms = last_ms
+        else:
+            sequence = 0
+        last_ms = ms
+
+        new_id = str((ms << TIME_SHIFT) | sequence)
+        if old_id == new_id:
+            continue
+        # 主键被df_order_goods引用，不能直接修改，先插入新订单，再修改订单商品，最后删除旧订单
+        order = OrderInfo.objects.get(order_id=old_id)
+        update_time = order.update_time
+        order.order_id = new_id
+        order.save(force_insert=True)
+        # 插入时create_time和update_time会被设为当前时间，改回原来的值
+        OrderInfo.objects.filter(order_id=new_id).update(create_time=create_time, update_time=update_time)
+        OrderGoods.objects.filter(order_id=old_id).update(order_id=new_id)
+        OrderInfo.objects.filter(order_id=old_id).delete()
+        mapping[old_id] = new_id
+    if mapping:
+        remap_redis(mapping)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('order', '0003_orderinfo_user_time_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(remap_legacy_ids, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='orderinfo',
+            name='order_id',
+            field=models.BigIntegerField(primary_key=True, serialize=False, verbose_name='订单id'),
+        ),
+    ]
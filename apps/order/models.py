@@ -1,7 +1,44 @@
+from datetime import datetime
+
 from django.db import models
+from django.db.models import F, Q, Prefetch, ExpressionWrapper
 from db.base_model import BaseModel
 
 
+class OrderInfoManager(models.Manager):
+    """ 订单模型管理类 """
+    CURSOR_FORMAT = '%Y%m%d%H%M%S%f'
+
+    def get_order_history(self, user):
+        """
+        获取用户的订单，按下单时间倒序
+        订单商品和商品SKU在取出当前页的订单后用一次查询批量获取，小计在sql中计算
+        """
+        order_skus = OrderGoods.objects.select_related('sku').annotate(
+            amount=ExpressionWrapper(F('count') * F('price'), output_field=models.DecimalField(max_digits=10, decimal_places=2)))
+        return self.filter(user=user, is_delete=False).order_by('-create_time', '-order_id').prefetch_related(
+            Prefetch('ordergoods_set', queryset=order_skus, to_attr='order_skus'))
+
+    def get_order_cursor(self, order):
+        """ 订单在历史记录中的位置，作为下一页的游标 """
+        return '%s_%s' % (order.create_time.strftime(self.CURSOR_FORMAT), order.order_id)
+
+    def get_orders_after(self, user, cursor, count):
+        """
+        根据游标获取下一页的订单(keyset分页)，不需要OFFSET跳过前面的订单
+        游标无效时返回None
+        """
+        try:
+            create_time, order_id = cursor.split('_', 1)
+            create_time = datetime.strptime(create_time, self.CURSOR_FORMAT)
+            order_id = int(order_id)
+        except ValueError:
+            return None
+        orders = self.get_order_history(user).filter(
+            Q(create_time__lt=create_time) | Q(create_time=create_time, order_id__lt=order_id))
+        return list(orders[:count])
+
+
 class OrderInfo(BaseModel):
     """ 订单模型类 """
     PAY_METHODS = {
@@ -47,7 +84,8 @@ class OrderInfo(BaseModel):
         (5, '已完成')
     )
 
-    order_id = models.CharField(max_length=128, primary_key=True, verbose_name='订单id')
+    # 雪花算法生成的id，按时间递增
+    order_id = models.BigIntegerField(primary_key=True, verbose_name='订单id')
     user = models.ForeignKey('user.User', verbose_name='用户', on_delete=models.CASCADE)
     addr = models.ForeignKey('user.Address', verbose_name='地址', on_delete=models.CASCADE)
     pay_method = models.SmallIntegerField(choices=PAY_METHOD_CHOICES, default=3, verbose_name='支付方式')
@@ -57,10 +95,16 @@ class OrderInfo(BaseModel):
     order_status = models.SmallIntegerField(choices=ORDER_STATUS_CHOICES, default=1, verbose_name='订单状态')
     trade_no = models.CharField(max_length=128, verbose_name='支付编号')
 
+    # 使用订单模型管理类
+    objects = OrderInfoManager()
+
     class Meta:
         db_table = 'df_order_info'
         verbose_name = '订单'
         verbose_name_plural = verbose_name
+        indexes = [
+            models.Index(fields=['user', '-create_time'], name='df_order_user_time_idx'),
+        ]
 
 
 class OrderGoods(BaseModel):
@@ -0,0 +1,141 @@
+import logging
+import time
+from datetime import datetime
+
+from django_redis import get_redis_connection
+
+from .models import OrderInfo, OrderGoods
+from .stock import StockReservation
+from .gateway import get_backend
+
+
+PAY_PENDING_KEY = 'pay_pending'  # 等待支付结果的订单 有序集合 score为下次查询的时间
+PAY_ATTEMPTS_KEY = 'pay_attempts'  # 订单已经查询的次数 {order_id: 次数}
+PAY_RESULT_KEY = 'pay_result_%s'  # 支付结果通知 列表 查询支付结果的请求在这个key上等待
+
+PAY_CHECK_BATCH = 100  # 每次最多查询的订单数
+PAY_CHECK_DELAY = 5  # 第一次重试的间隔(秒)，之后每次翻倍
+PAY_CHECK_MAX_DELAY = 300
+PAY_CHECK_MAX_ATTEMPTS = 12  # 大约半个小时后不再查询
+PAY_RESULT_TIMEOUT = 300
+PAY_REFUND_KEY = 'pay_refund'  # 超时取消后才付款、库存不足需要退款的订单 {order_id: 交易号}
+PAY_CLOSE_MARGIN = 120  # 支付宝关闭交易的时间比归还预扣库存提前的时间(秒)
+
+logger = logging.getLogger('django')
+
+
+def pay_timeout(order_id):
+    """ 订单还可以支付的时间(秒)，预扣的库存归还前支付宝要先关闭交易，已超时时返回0 """
+    deadline = StockReservation().deadline(order_id)
+    if deadline is None:
+        return 0
+    return max(int(deadline - time.time()) - PAY_CLOSE_MARGIN, 0)
+
+
+def add_pending(order_id, delay=0):
+    """ 加入等待查询支付结果的订单，已存在时提前到delay秒后查询 """
+    conn = get_redis_connection('default')
+    check_time = time.time() + delay
+    score = conn.zscore(PAY_PENDING_KEY, order_id)
+    if score is None or score > check_time:
+        conn.zadd(PAY_PENDING_KEY, check_time, order_id)
+
+
+def _finish(order_id, result):
+    """ 订单不再查询，并通知等待结果的请求 """
+    conn = get_redis_connection('default')
+    result_key = PAY_RESULT_KEY % order_id
+    pl = conn.pipeline()
+    pl.zrem(PAY_PENDING_KEY, order_id)
+    pl.hdel(PAY_ATTEMPTS_KEY, order_id)
+    pl.rpush(result_key, result)
+    pl.expire(result_key, PAY_RESULT_TIMEOUT)
+    pl.execute()
+
+
+def _restore_expired(order_id):
+    """ 订单超时取消(库存已归还)后才收到付款，重新预扣订单的库存，库存不足时返回False """
+    items = list(OrderGoods.objects.filter(order_id=order_id).values_list('sku_id', 'count'))
+    return bool(items) and StockReservation().reserve(order_id, items, expire=False) is None
+
+
+def mark_paid(order_id, trade_no):
+    """ 支付成功，更新订单状态为待评价，重复调用不会重复更新 """
+    values = {
+        'trade_no': trade_no,
+        'order_status': OrderInfo.ORDER_STATUS_ENUM['UNCOMMENT'],
+        'update_time': datetime.now(),
+    }
+    unpaid = OrderInfo.objects.filter(order_id=order_id, order_status=OrderInfo.ORDER_STATUS_ENUM['UNPAID'])
+    # 超时取消的订单(is_delete)库存已经归还，不能直接改为已支付
+    if not unpaid.filter(is_delete=False).update(**values) and unpaid.filter(is_delete=True).exists():
+        if not _restore_expired(order_id):
+            get_redis_connection('default').hset(PAY_REFUND_KEY, order_id, trade_no)
+            logger.warning('订单%s超时取消后才付款，库存不足，需要退款，交易号%s', order_id, trade_no)
+            _finish(order_id, 'fail')
+            return
+        unpaid.filter(is_delete=True).update(is_delete=False, **values)
+    # 已支付的订单不再归还预扣的库存
+    StockReservation().confirm(order_id)
+    _finish(order_id, 'success')
+
+
+def mark_failed(order_id):
+    """ 支付出错 """
+    _finish(order_id, 'fail')
+
+
+def check_payment(backend, order_id):
+    """
+    查询一个订单的支付结果
+    返回 'success' 'fail' 或 'wait'
+    """
+    result, trade_no = backend.query(order_id)
+    if result == 'success':
+        mark_paid(order_id, trade_no)
+    elif result == 'fail':
+        mark_failed(order_id)
+    return result
+
+
+def check_pending_payments(backend=None):
+    """ 批量查询已到查询时间的订单，还在等待付款的订单按指数退避稍后再查询 """
+    conn = get_redis_connection('default')
+    order_ids = conn.zrangebyscore(PAY_PENDING_KEY, 0, time.time(), start=0, num=PAY_CHECK_BATCH)
+    if not order_ids:
+        return 0
+
+    backend = backend or get_backend(3)  # 支付宝
+    for order_id in order_ids:
+        order_id = order_id.decode()
+        try:
+            result = check_payment(backend, order_id)
+        except backend.errors:
+            # 网络错误等，按等待处理
+            logger.warning('查询订单%s的支付结果失败', order_id, exc_info=True)
+            result = 'wait'
+        except Exception:
+            # 更新订单、归还库存等出错，记录错误，稍后重试
+            logger.exception('处理订单%s的支付结果出错', order_id)
+            result = 'wait'
+        if result != 'wait':
+            continue
+
+        attempts = conn.hincrby(PAY_ATTEMPTS_KEY, order_id, 1)
+        if attempts >= PAY_CHECK_MAX_ATTEMPTS:
+            # 超时未支付，不再查询
+            conn.zrem(PAY_PENDING_KEY, order_id)
+            conn.hdel(PAY_ATTEMPTS_KEY, order_id)
+            continue
+        delay = min(PAY_CHECK_DELAY * 2 ** (attempts - 1), PAY_CHECK_MAX_DELAY)
+        conn.zadd(PAY_PENDING_KEY, time.time() + delay, order_id)
+    return len(order_ids)
+
+
+def wait_result(order_id, timeout):
+    """ 等待支付结果通知，超时返回None """
+    conn = get_redis_connection('default')
+    res = conn.blpop(PAY_RESULT_KEY % order_id, timeout)
+    if res is None:
+        return None
+    return res[1].decode()
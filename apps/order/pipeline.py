@@ -0,0 +1,155 @@
+import json
+from decimal import Decimal
+
+from django.db import transaction
+from django_redis import get_redis_connection
+
+from goods.models import GoodsSKU
+from .models import OrderInfo, OrderGoods
+from .stock import StockReservation
+
+
+ORDER_QUEUE_KEY = 'order_queue'  # 等待写入mysql的订单 列表
+ORDER_STATE_KEY = 'order_state_%s'  # 订单的处理进度 {user_id, status, errmsg}
+ORDER_IDEM_KEY = 'order_idem_%s_%s'  # 客户端提交的订单key对应的订单id，防止重复下单
+ORDER_STATE_TIMEOUT = 24 * 3600
+ORDER_BATCH = 100  # 每次最多写入的订单数
+
+# 订单的处理进度
+STATE_QUEUED = 'queued'
+STATE_DONE = 'done'
+STATE_FAILED = 'failed'
+
+
+def claim_key(user_id, key, order_id):
+    """
+    记录客户端提交的订单key，返回这个key对应的订单id
+    同一个key已经提交过时返回之前的订单id
+    """
+    conn = get_redis_connection('default')
+    idem_key = ORDER_IDEM_KEY % (user_id, key)
+    if conn.set(idem_key, order_id, nx=True, ex=ORDER_STATE_TIMEOUT):
+        return order_id
+    return int(conn.get(idem_key))
+
+
+def release_key(user_id, key):
+    """ 订单没有创建成功，允许用同一个key重新提交 """
+    conn = get_redis_connection('default')
+    conn.delete(ORDER_IDEM_KEY % (user_id, key))
+
+
+def enqueue(order):
+    """
+    订单加入队列，由celery批量写入mysql
+    order: {order_id, user_id, addr_id, pay_method, transit_price, total_count, total_price, items: [[sku_id, count, price]],
+            order_key}
+    """
+    conn = get_redis_connection('default')
+    state_key = ORDER_STATE_KEY % order['order_id']
+    pl = conn.pipeline()
+    pl.hmset(state_key, {'user_id': order['user_id'], 'status': STATE_QUEUED})
+    pl.expire(state_key, ORDER_STATE_TIMEOUT)
+    pl.rpush(ORDER_QUEUE_KEY, json.dumps(order))
+    pl.execute()
+
+
+def get_state(order_id, user_id):
+    """ 获取订单的处理进度，不是该用户的订单时返回None """
+    conn = get_redis_connection('default')
+    state = conn.hgetall(ORDER_STATE_KEY % order_id)
+    if not state or int(state[b'user_id']) != user_id:
+        return None
+    return {
+        'status': state[b'status'].decode(),
+        'errmsg': state.get(b'errmsg', b'').decode(),
+    }
+
+
+def _set_state(conn, order_id, status, errmsg=''):
+    conn.hmset(ORDER_STATE_KEY % order_id, {'status': status, 'errmsg': errmsg})
+
+
+def _build(order):
+    """ 根据队列中的数据创建订单对象，不写入数据库 """
+    order_info = OrderInfo(
+        order_id=order['order_id'],
+        user_id=order['user_id'],
+        addr_id=order['addr_id'],
+        pay_method=order['pay_method'],
+        total_count=order['total_count'],
+        total_price=Decimal(order['total_price']),
+        transit_price=Decimal(order['transit_price']),
+    )
+    order_goods = [OrderGoods(
+        order_id=order['order_id'],
+        sku_id=sku_id,
+        count=count,
+        price=Decimal(price),
+    ) for sku_id, count, price in order['items']]
+    return order_info, order_goods
+
+
+def _save_one(order):
+    """ 单独写入一个订单，订单已存在(之前写入后进程中断)时视为成功 """
+    if OrderInfo.objects.filter(order_id=order['order_id']).exists():
+        return True
+    order_info, order_goods = _build(order)
+    try:
+        with transaction.atomic():
+            order_info.save(force_insert=True)
+            OrderGoods.objects.bulk_create(order_goods)
+    except Exception:
+        return False
+    return True
+
+
+def persist_batch(count=ORDER_BATCH):
+    """
+    从队列中取出一批订单，用bulk_create写入mysql，返回处理的订单数
+    写入成功后才从队列中删除，进程中断后重新处理时已写入的订单不会重复写入
+    同一时间只能有一个进程调用
+    """
+    conn = get_redis_connection('default')
+    raw_orders = conn.lrange(ORDER_QUEUE_KEY, 0, count - 1)
+    if not raw_orders:
+        return 0
+    orders = [json.loads(raw.decode()) for raw in raw_orders]
+
+    # 一次查询校验全部订单中的商品都存在
+    sku_ids = {sku_id for order in orders for sku_id, count, price in order['items']}
+    exist_ids = set(GoodsSKU.objects.filter(id__in=sku_ids).values_list('id', flat=True))
+    valid = [order for order in orders if all(item[0] in exist_ids for item in order['items'])]
+
+    try:
+        with transaction.atomic():
+            order_infos = []
+            order_goods = []
+            for order in valid:
+                order_info, goods = _build(order)
+                order_infos.append(order_info)
+                order_goods.extend(goods)
+            OrderInfo.objects.bulk_create(order_infos)
+            OrderGoods.objects.bulk_create(order_goods)
+        saved = valid
+    except Exception:
+        # 批量写入失败时逐个写入，找出有问题的订单
+        saved = [order for order in valid if _save_one(order)]
+
+    conn.ltrim(ORDER_QUEUE_KEY, len(orders), -1)
+
+    # 把预扣的库存合并写入mysql
+    reservation = StockReservation(conn)
+    reservation.persist_many([order['order_id'] for order in saved])
+
+    saved_ids = {order['order_id'] for order in saved}
+    for order in orders:
+        if order['order_id'] in saved_ids:
+            _set_state(conn, order['order_id'], STATE_DONE)
+        else:
+            reservation.release(order['order_id'])
+            _set_state(conn, order['order_id'], STATE_FAILED, '下单失败')
+            # 写入失败的订单释放订单key，客户端可以用同一个key重新提交
+            if order.get('order_key'):
+                conn.delete(ORDER_IDEM_KEY % (order['user_id'], order['order_key']))
+    return len(orders)
@@ -0,0 +1,353 @@
+import time
+
+from django.db import transaction
+from django_redis import get_redis_connection
+
+from goods.models import GoodsSKU
+
+
+# 未支付订单预扣库存的保留时间(秒)，超时后归还库存
+RESERVATION_TIMEOUT = 30 * 60
+
+STOCK_KEY = 'stock_%s'  # 商品的redis库存
+PENDING_KEY = 'stock_pending'  # 已在redis扣减但还未写入mysql的数量 {sku_id: count}
+RESERVATION_KEY = 'stock_reserve_%s'  # 订单预扣的商品 {sku_id: count}
+EXPIRE_KEY = 'stock_reserve_expire'  # 需要超时归还的订单 有序集合 score为过期时间
+STATUS_KEY = 'sku_status'  # 商品的状态 {sku_id: status}，和stock_<sku_id>一起作为商品可用性的索引，只保存存在的商品
+MISSING_KEY = 'sku_missing_%s'  # 不存在的商品，短时间内不再查询mysql
+MISSING_TIMEOUT = 60
+
+# KEYS: PENDING_KEY, RESERVATION_KEY, EXPIRE_KEY, 各商品的库存key
+# ARGV: 订单id, 过期时间(0表示不过期), 之后依次为sku_id, 数量
+# 先检查全部商品的库存，全部足够时再一起扣减，整个订单要么都扣减成功，要么都不扣减
+RESERVE_SCRIPT = """
+for i = 4, #KEYS do
+    local stock = redis.call('GET', KEYS[i])
+    if not stock then
+        return -(i - 3)
+    end
+    if tonumber(stock) < tonumber(ARGV[(i - 3) * 2 + 2]) then
+        return i - 3
+    end
+end
+for i = 4, #KEYS do
+    local sku_id = ARGV[(i - 3) * 2 + 1]
+    local count = ARGV[(i - 3) * 2 + 2]
+    redis.call('DECRBY', KEYS[i], count)
+    redis.call('HINCRBY', KEYS[1], sku_id, count)
+    redis.call('HINCRBY', KEYS[2], sku_id, count)
+end
+if tonumber(ARGV[2]) > 0 then
+    redis.call('ZADD', KEYS[3], ARGV[2], ARGV[1])
+end
+return 0
+"""
+
+# KEYS: 库存key, PENDING_KEY, STATUS_KEY, 不存在的标记  ARGV: sku_id, mysql中的库存, mysql库存的变化量, 状态(空表示不修改)
+# redis中已有库存时只加上mysql库存的变化量，不覆盖期间预扣的库存
+# 还没有库存时用mysql中的库存减去还未写入mysql的数量初始化，读取和写入在同一个脚本中，中间不会有预扣
+SYNC_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    if tonumber(ARGV[3]) ~= 0 then
+        redis.call('INCRBY', KEYS[1], ARGV[3])
+    end
+else
+    local pending = tonumber(redis.call('HGET', KEYS[2], ARGV[1]) or 0)
+    redis.call('SET', KEYS[1], tonumber(ARGV[2]) - pending)
+end
+if ARGV[4] ~= '' then
+    redis.call('HSET', KEYS[3], ARGV[1], ARGV[4])
+end
+redis.call('DEL', KEYS[4])
+return 1
+"""
+
+# KEYS: 库存key, PENDING_KEY  ARGV: sku_id, 读取时redis中的库存, 读取时还未写入mysql的数量, mysql中的库存
+# 对账修正库存: 读取之后有预扣、归还或写入mysql时不修改，返回0
+FIX_STOCK_SCRIPT = """
+local stock = redis.call('GET', KEYS[1])
+local pending = redis.call('HGET', KEYS[2], ARGV[1]) or '0'
+if stock ~= ARGV[2] or tonumber(pending) ~= tonumber(ARGV[3]) then
+    return 0
+end
+redis.call('SET', KEYS[1], tonumber(ARGV[4]) - tonumber(pending))
+return 1
+"""
+
+# KEYS: RESERVATION_KEY
+# 标记预扣记录已写入mysql，已标记过或记录已被归还时返回空
+PERSIST_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return nil
+end
+if redis.call('HSETNX', KEYS[1], '_persisted', 1) == 0 then
+    return nil
+end
+return redis.call('HGETALL', KEYS[1])
+"""
+
+# KEYS: PENDING_KEY, RESERVATION_KEY, EXPIRE_KEY  ARGV: 订单id, 库存key的前缀
+# 把预扣的库存加回redis并删除预扣记录，返回预扣记录供调用方归还mysql的库存
+RELEASE_SCRIPT = """
+local items = redis.call('HGETALL', KEYS[2])
+if #items == 0 then
+    return nil
+end
+local persisted = redis.call('HEXISTS', KEYS[2], '_persisted')
+for i = 1, #items, 2 do
+    if items[i] ~= '_persisted' then
+        redis.call('INCRBY', ARGV[2] .. items[i], items[i + 1])
+        if persisted == 0 then
+            redis.call('HINCRBY', KEYS[1], items[i], -items[i + 1])
+        end
+    end
+end
+redis.call('DEL', KEYS[2])
+redis.call('ZREM', KEYS[3], ARGV[1])
+return items
+"""
+
+
+class StockReservation(object):
+    """
+    redis库存预扣
+    商品库存在redis中保存一份(stock_<sku_id>)，下单时用lua脚本一次性原子扣减订单中全部商品的库存，
+    mysql中的库存和销量由celery异步写入，未支付的订单超时后归还库存
+    """
+    def __init__(self, conn=None):
+        self.conn = conn or get_redis_connection('default')
+        self._reserve = self.conn.register_script(RESERVE_SCRIPT)
+        self._persist = self.conn.register_script(PERSIST_SCRIPT)
+        self._release = self.conn.register_script(RELEASE_SCRIPT)
+        self._sync = self.conn.register_script(SYNC_SCRIPT)
+        self._fix_stock = self.conn.register_script(FIX_STOCK_SCRIPT)
+
+    def sync(self, sku_id, stock, delta=0, status=None):
+        """
+        同步mysql中商品库存和状态的修改
+        delta: 这次修改使mysql库存变化的数量，redis中已有库存时只加上这个数量
+        status: 修改后的状态，None表示状态没有修改
+        """
+        keys = [STOCK_KEY % sku_id, PENDING_KEY, STATUS_KEY, MISSING_KEY % sku_id]
+        self._sync(keys=keys, args=[sku_id, stock, delta, '' if status is None else status])
+
+    def remove(self, sku_id):
+        """ 商品已删除 """
+        pl = self.conn.pipeline()
+        pl.delete(STOCK_KEY % sku_id)
+        pl.hdel(STATUS_KEY, sku_id)
+        pl.set(MISSING_KEY % sku_id, 1, ex=MISSING_TIMEOUT)
+        pl.execute()
+
+    def _load(self, sku_id):
+        """ redis中没有库存时从mysql加载，已存在则不覆盖 """
+        try:
+            sku = GoodsSKU.objects.only('id', 'stock', 'status').get(pk=sku_id)
+        except GoodsSKU.DoesNotExist:
+            # 不存在的id可以由用户任意提交，不能写入STATUS_KEY，只短时间记录在单独的key中
+            self.conn.set(MISSING_KEY % sku_id, 1, ex=MISSING_TIMEOUT)
+            return False
+        self.sync(sku_id, sku.stock, status=sku.status)
+        return True
+
+    def check(self, sku_id):
+        """
+        获取商品的状态和可用库存 (status, stock)，商品不存在时返回None
+        先查redis，redis中没有时从mysql加载
+        """
+        for i in range(2):
+            pl = self.conn.pipeline(transaction=False)
+            pl.hget(STATUS_KEY, sku_id)
+            pl.get(STOCK_KEY % sku_id)
+            pl.exists(MISSING_KEY % sku_id)
+            status, stock, missing = pl.execute()
+            if missing:
+                return None
+            if status is not None and stock is not None:
+                return int(status), int(stock)
+            if i == 0 and not self._load(sku_id):
+                return None
+        return None
+
+    def reserve(self, order_id, items, expire=True):
+        """
+        预扣订单中全部商品的库存
+        items: [(sku_id, count), ...]
+        返回None表示成功，否则返回库存不足的sku_id
+        """
+        keys = [PENDING_KEY, RESERVATION_KEY % order_id, EXPIRE_KEY]
+        keys += [STOCK_KEY % sku_id for sku_id, count in items]
+        deadline = int(time.time()) + RESERVATION_TIMEOUT if expire else 0
+        args = [order_id, deadline]
+        for sku_id, count in items:
+            args += [sku_id, int(count)]
+
+        # redis中缺少某个商品的库存时先加载，最多尝试商品个数次
+        for i in range(len(items) + 1):
+            res = self._reserve(keys=keys, args=args)
+            if res == 0:
+                return None
+            if res > 0:
+                return items[res - 1][0]
+            sku_id = items[-res - 1][0]
+            if not self._load(sku_id):
+                return sku_id
+        return items[0][0]
+
+    def persist(self, order_id):
+        """ 把订单预扣的库存写入mysql，重复调用只会写入一次 """
+        self.persist_many([order_id])
+
+    def persist_many(self, order_ids):
+        """ 把多个订单预扣的库存合并后用一条UPDATE写入mysql """
+        pl = self.conn.pipeline(transaction=False)
+        for order_id in order_ids:
+            self._persist(keys=[RESERVATION_KEY % order_id], client=pl)
+        results = pl.execute()
+
+        counts = {}
+        for res in results:
+            if not res:
+                continue
+            items = dict(zip(res[::2], res[1::2]))
+            items.pop(b'_persisted', None)
+            for sku_id, count in items.items():
+                counts[int(sku_id)] = counts.get(int(sku_id), 0) + int(count)
+        if not counts:
+            return
+        GoodsSKU.objects.update_stock(counts)
+
+        pl = self.conn.pipeline(transaction=False)
+        for sku_id, count in counts.items():
+            pl.hincrby(PENDING_KEY, sku_id, -count)
+        # 不需要超时归还的订单写入后就可以删除预扣记录
+        for order_id in order_ids:
+            pl.zscore(EXPIRE_KEY, order_id)
+        scores = pl.execute()[len(counts):]
+        done_keys = [RESERVATION_KEY % order_id for order_id, score in zip(order_ids, scores) if score is None]
+        if done_keys:
+            self.conn.delete(*done_keys)
+
+    def confirm(self, order_id):
+        """ 订单已支付，预扣的库存不再归还 """
+        self.persist(order_id)
+        self.conn.zrem(EXPIRE_KEY, order_id)
+        self.conn.delete(RESERVATION_KEY % order_id)
+
+    def release(self, order_id):
+        """ 归还订单预扣的库存 """
+        keys = [PENDING_KEY, RESERVATION_KEY % order_id, EXPIRE_KEY]
+        res = self._release(keys=keys, args=[order_id, STOCK_KEY % ''])
+        if not res:
+            return
+        items = dict(zip(res[::2], res[1::2]))
+        # 已经写入mysql的，mysql中的库存和销量也要归还
+        if items.pop(b'_persisted', None) is not None:
+            GoodsSKU.objects.update_stock({sku_id: -int(count) for sku_id, count in items.items()})
+
+    def deadline(self, order_id):
+        """ 订单预扣的库存归还的时间(时间戳)，不需要归还或已归还时返回None """
+        score = self.conn.zscore(EXPIRE_KEY, order_id)
+        return None if score is None else int(score)
+
+    def expired(self):
+        """ 获取预扣已超时的订单id """
+        order_ids = self.conn.zrangebyscore(EXPIRE_KEY, 0, int(time.time()))
+        return [order_id.decode() for order_id in order_ids]
+
+    def diff(self, chunk_size=500):
+        """
+        对比redis中的商品索引和df_goods_sku，redis中还没有加载的商品不算不一致
+        返回不一致的记录 [(sku_id, 字段, redis中的值, mysql中的值)]，商品在mysql中已删除时mysql中的值为None
+        每批商品先查询mysql，紧接着读取这批商品在redis中的库存、状态和还未写入mysql的数量，
+        不使用扫描开始时的数据，扫描期间的下单不会被算作不一致
+        """
+        diffs = []
+        last_id = 0
+        while True:
+            chunk = list(GoodsSKU.objects.filter(id__gt=last_id).order_by('id').values_list(
+                'id', 'status', 'stock')[:chunk_size])
+            if not chunk:
+                break
+            last_id = chunk[-1][0]
+            sku_ids = [sku_id for sku_id, status, stock in chunk]
+            pl = self.conn.pipeline(transaction=False)
+            pl.mget([STOCK_KEY % sku_id for sku_id in sku_ids])
+            pl.hmget(STATUS_KEY, sku_ids)
+            pl.hmget(PENDING_KEY, sku_ids)
+            stocks, statuses, pending = pl.execute()
+            for (sku_id, status, stock), cached, cached_status, count in zip(chunk, stocks, statuses, pending):
+                if cached_status is not None and int(cached_status) != status:
+                    diffs.append((sku_id, 'status', int(cached_status), status))
+                expected = stock - int(count or 0)
+                if cached is not None and int(cached) != expected:
+                    diffs.append((sku_id, 'stock', int(cached), expected))
+
+        # redis中有但mysql中没有的商品，包括旧版本记录的不存在的商品(status为-1)，修正时删除
+        # 扫描期间新增的商品不在扫描结果中，再查询一次确认
+        statuses = {int(sku_id): int(status) for sku_id, status in self.conn.hgetall(STATUS_KEY).items()}
+        extra = set(statuses)
+        cached_ids = sorted(statuses)
+        for i in range(0, len(cached_ids), chunk_size):
+            extra -= set(GoodsSKU.objects.filter(id__in=cached_ids[i:i + chunk_size]).values_list('id', flat=True))
+        for sku_id in sorted(extra):
+            diffs.append((sku_id, 'status', statuses[sku_id], None))
+        return diffs
+
+    def fix_stock(self, sku_id):
+        """
+        以mysql为准修正一个商品的redis库存，返回是否修改
+        先读取redis中的库存和还未写入mysql的数量，再查询mysql，最后在lua脚本中确认redis没有变化才写入，
+        读取后有下单、归还或写入mysql时跳过，不会用过期的数据覆盖
+        """
+        pl = self.conn.pipeline(transaction=False)
+        pl.get(STOCK_KEY % sku_id)
+        pl.hget(PENDING_KEY, sku_id)
+        cached, pending = pl.execute()
+        if cached is None:
+            return False
+        stock = GoodsSKU.objects.filter(pk=sku_id).values_list('stock', flat=True).first()
+        if stock is None or int(cached) == stock - int(pending or 0):
+            return False
+        keys = [STOCK_KEY % sku_id, PENDING_KEY]
+        return bool(self._fix_stock(keys=keys, args=[sku_id, cached, int(pending or 0), stock]))
+
+    def reconcile(self):
+        """ 对账: 以mysql为准修正redis中的库存和状态，返回修正过的sku_id """
+        fixed = set()
+        for sku_id, field, cached, expected in self.diff():
+            if expected is None:
+                self.remove(sku_id)
+            elif field == 'status':
+                self.conn.hset(STATUS_KEY, sku_id, expected)
+            elif not self.fix_stock(sku_id):
+                continue
+            fixed.add(sku_id)
+        return sorted(fixed)
+
+
+def sku_loaded(instance, **kwargs):
+    """ 记录读取商品时的库存和状态，保存时只同步这次修改的变化量 """
+    instance._stock_loaded = (instance.__dict__.get('stock'), instance.__dict__.get('status'))
+
+
+def sku_saved(instance, created=False, **kwargs):
+    """
+    商品的库存或状态修改后同步redis，只修改名称、价格等时不访问redis
+    过期的表单保存了读取时的库存，变化量为0，不会覆盖期间预扣的库存
+    事务提交后再同步，回滚时redis不变
+    """
+    loaded_stock, loaded_status = getattr(instance, '_stock_loaded', (None, None))
+    sku_id, stock, status = instance.id, instance.stock, instance.status
+    instance._stock_loaded = (stock, status)
+    if not created and stock == loaded_stock and status == loaded_status:
+        return
+    # 读取时没有加载库存字段的，不知道变化量，只在redis中还没有库存时初始化
+    delta = stock - loaded_stock if not created and loaded_stock is not None else 0
+    status = None if not created and status == loaded_status else status
+    transaction.on_commit(lambda: StockReservation().sync(sku_id, stock, delta, status))
+
+
+def sku_deleted(instance, **kwargs):
+    """ 商品删除后从redis中移除 """
+    StockReservation().remove(instance.id)
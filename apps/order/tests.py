@@ -1,3 +1,384 @@
-from django.test import TestCase
+import multiprocessing
+import time
+from unittest import mock
+from urllib.parse import urlsplit, unquote
 
-# Create your tests here.
+from django.db import transaction
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from django.urls import reverse
+from django_redis import get_redis_connection
+from alipay import AliPay
+
+from cart.cart import Cart
+from goods.models import GoodsSKU
+from goods.testdata import create_skus, clear_caches
+from order import gateway
+from order.gateway import PayBackend, AlipayBackend, KeepAliveAliPay
+from order.models import OrderInfo, OrderGoods
+from order.pipeline import claim_key, enqueue, persist_batch, get_state, STATE_FAILED
+from order.payment import (check_pending_payments, add_pending, wait_result, PAY_PENDING_KEY, PAY_ATTEMPTS_KEY,
+                           PAY_CHECK_DELAY, PAY_CHECK_MAX_ATTEMPTS, PAY_REFUND_KEY)
+from order.stock import StockReservation, STOCK_KEY, PENDING_KEY
+from user.models import User, Address
+from utils.snowflake import Snowflake, next_id, MAX_WORKER, SEQUENCE_BITS
+from utils.testing import RedisTestMixin, count_queries
+
+
+TEST_WORKER_KEY = 'test_snowflake_worker'
+
+
+def _generate_ids(count):
+    return [next_id() for i in range(count)]
+
+
+def _worker_id(order_id):
+    return (order_id >> SEQUENCE_BITS) & MAX_WORKER
+
+
+class SnowflakeTest(RedisTestMixin, SimpleTestCase):
+    """ 雪花算法id生成器 """
+    def test_unique_across_processes(self):
+        # 多个进程同时生成id，不能重复，每个进程内按时间递增
+        processes = 8
+        with multiprocessing.get_context('fork').Pool(processes) as pool:
+            results = pool.map(_generate_ids, [20000] * processes, chunksize=1)
+        ids = [order_id for result in results for order_id in result]
+        self.assertEqual(len(ids), len(set(ids)))
+        for result in results:
+            self.assertEqual(result, sorted(result))
+        # 每个进程使用不同的机器号
+        self.assertEqual(len({_worker_id(result[0]) for result in results}), processes)
+        self.assertLess(max(ids), 2 ** 63)
+
+    def test_exhausted_workers_fail(self):
+        # 机器号都被占用时报错，不能和其他进程共用机器号
+        conn = get_redis_connection('default')
+        pl = conn.pipeline()
+        for i in range(MAX_WORKER + 1):
+            pl.set('%s_%d' % (TEST_WORKER_KEY, i), 'other', ex=60)
+        pl.execute()
+        with self.assertRaises(RuntimeError):
+            Snowflake(TEST_WORKER_KEY).next_id()
+
+    def test_lost_lease_reacquired(self):
+        # 租约过期后被其他进程占用时，续约失败，重新租用另一个机器号
+        conn = get_redis_connection('default')
+        snowflake = Snowflake(TEST_WORKER_KEY)
+        worker_id = _worker_id(snowflake.next_id())
+        conn.set('%s_%d' % (TEST_WORKER_KEY, worker_id), 'other', ex=60)
+        snowflake._renewed = 0
+        self.assertNotEqual(_worker_id(snowflake.next_id()), worker_id)
+
+
+class OrderPlaceViewQueryTest(RedisTestMixin, TestCase):
+    """ 提交订单页面的sql语句数和购买的商品数无关 """
+    def setUp(self):
+        super(OrderPlaceViewQueryTest, self).setUp()
+        self.user = User.objects.create_user('order_test', 'order_test@example.com', 'password')
+        Address.objects.create(user=self.user, receiver='order_test', addr='test', phone='13800000000',
+                               is_default=True)
+        self.client.force_login(self.user)
+        goods_type, self.skus = create_skus(20, prefix='order_test')
+        cart = Cart(self.user.id)
+        for sku in self.skus:
+            cart.add(sku.id, 2, sku.stock)
+
+    def place(self, count):
+        clear_caches()
+        return self.client.post(reverse('order:place'), {'sku_ids': [sku.id for sku in self.skus[:count]]})
+
+    def test_queries_constant(self):
+        queries = count_queries(self.place, 1)
+
+        with self.assertNumQueries(queries):
+            response = self.place(20)
+        self.assertEqual(len(response.context['skus']), 20)
+        self.assertEqual(response.context['total_count'], 40)
+
+
+class FakePayBackend(PayBackend):
+    """ 按预先设置的结果返回的支付接口，签名为'valid'时验证通过 """
+    app_id = 'test_app'
+
+    def __init__(self, *results):
+        self.results = list(results)
+        self.queried = []
+
+    def query(self, order_id):
+        self.queried.append(order_id)
+        result = self.results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def verify(self, data, signature):
+        return signature == 'valid'
+
+
+class PaymentTest(RedisTestMixin, TestCase):
+    """ 支付结果的查询和异步通知 """
+    def setUp(self):
+        super(PaymentTest, self).setUp()
+        self.user = User.objects.create_user('pay_test', 'pay_test@example.com', 'password')
+        addr = Address.objects.create(user=self.user, receiver='pay_test', addr='test', phone='13800000000')
+        goods_type, (self.sku,) = create_skus(1, prefix='pay_test', stock=10)
+        self.order_id = next_id()
+        self.assertIsNone(StockReservation().reserve(self.order_id, [(self.sku.id, 2)]))
+        OrderInfo.objects.create(order_id=self.order_id, user=self.user, addr=addr, pay_method=3, total_count=2,
+                                 total_price=self.sku.price * 2, transit_price=10)
+        OrderGoods.objects.create(order_id=self.order_id, sku=self.sku, count=2, price=self.sku.price)
+        add_pending(self.order_id)
+
+    def order(self):
+        return OrderInfo.objects.get(order_id=self.order_id)
+
+    def pending_delay(self):
+        score = get_redis_connection('default').zscore(PAY_PENDING_KEY, self.order_id)
+        return None if score is None else score - time.time()
+
+    def due(self):
+        # 让订单立即到达下次查询的时间
+        get_redis_connection('default').zadd(PAY_PENDING_KEY, 0, self.order_id)
+
+    def test_success(self):
+        backend = FakePayBackend(('success', 'trade_1'))
+        self.assertEqual(check_pending_payments(backend), 1)
+        order = self.order()
+        self.assertEqual(order.order_status, OrderInfo.ORDER_STATUS_ENUM['UNCOMMENT'])
+        self.assertEqual(order.trade_no, 'trade_1')
+        self.assertIsNone(self.pending_delay())
+        self.assertEqual(wait_result(self.order_id, 1), 'success')
+        # 已支付的订单不再超时归还库存
+        self.assertIsNone(StockReservation().deadline(self.order_id))
+        self.assertEqual(GoodsSKU.objects.get(pk=self.sku.id).stock, 8)
+
+    def test_wait_backoff(self):
+        backend = FakePayBackend(('wait', None), ConnectionError(), ('wait', None))
+        self.assertEqual(check_pending_payments(backend), 1)
+        self.assertAlmostEqual(self.pending_delay(), PAY_CHECK_DELAY, delta=1)
+        # 还没到查询时间时不查询
+        self.assertEqual(check_pending_payments(backend), 0)
+        # 网络错误按等待处理，每次间隔翻倍
+        self.due()
+        check_pending_payments(backend)
+        self.assertAlmostEqual(self.pending_delay(), PAY_CHECK_DELAY * 2, delta=1)
+        self.due()
+        check_pending_payments(backend)
+        self.assertAlmostEqual(self.pending_delay(), PAY_CHECK_DELAY * 4, delta=1)
+        self.assertEqual(len(backend.queried), 3)
+        self.assertEqual(self.order().order_status, OrderInfo.ORDER_STATUS_ENUM['UNPAID'])
+
+    def test_error_logged(self):
+        # 不是网络错误的异常也按等待处理，但要记录错误日志
+        with self.assertLogs('django', 'ERROR') as logs:
+            self.assertEqual(check_pending_payments(FakePayBackend(RuntimeError('bug'))), 1)
+        self.assertIn(str(self.order_id), logs.output[0])
+        self.assertAlmostEqual(self.pending_delay(), PAY_CHECK_DELAY, delta=1)
+
+    def test_give_up(self):
+        backend = FakePayBackend(*[('wait', None)] * PAY_CHECK_MAX_ATTEMPTS)
+        for i in range(PAY_CHECK_MAX_ATTEMPTS):
+            self.due()
+            self.assertEqual(check_pending_payments(backend), 1)
+        # 达到最大查询次数后不再查询，订单仍是待支付，由超时任务归还库存
+        self.assertIsNone(self.pending_delay())
+        self.assertIsNone(get_redis_connection('default').hget(PAY_ATTEMPTS_KEY, self.order_id))
+        self.assertEqual(check_pending_payments(backend), 0)
+        self.assertEqual(self.order().order_status, OrderInfo.ORDER_STATUS_ENUM['UNPAID'])
+
+    def test_fail(self):
+        check_pending_payments(FakePayBackend(('fail', None)))
+        self.assertIsNone(self.pending_delay())
+        self.assertEqual(wait_result(self.order_id, 1), 'fail')
+        self.assertEqual(self.order().order_status, OrderInfo.ORDER_STATUS_ENUM['UNPAID'])
+
+    def notify(self, signature, **fields):
+        order = self.order()
+        data = {'app_id': 'test_app', 'out_trade_no': str(self.order_id), 'trade_no': 'trade_2',
+                'trade_status': 'TRADE_SUCCESS', 'total_amount': str(order.total_price + order.transit_price),
+                'sign': signature}
+        data.update(fields)
+        with mock.patch.dict(gateway._backends, {'3': FakePayBackend()}):
+            return self.client.post(reverse('order:notify'), data)
+
+    def test_notify_invalid_signature(self):
+        self.assertEqual(self.notify('forged').content, b'fail')
+        self.assertEqual(self.order().order_status, OrderInfo.ORDER_STATUS_ENUM['UNPAID'])
+        self.assertIsNotNone(self.pending_delay())
+
+    def test_notify_mismatch(self):
+        # 签名正确，但不是本应用、金额不对或订单不存在
+        self.assertEqual(self.notify('valid', app_id='other_app').content, b'fail')
+        self.assertEqual(self.notify('valid', total_amount='0.01').content, b'fail')
+        self.assertEqual(self.notify('valid', total_amount='').content, b'fail')
+        self.assertEqual(self.notify('valid', out_trade_no=str(next_id())).content, b'fail')
+        self.assertEqual(self.notify('valid', out_trade_no='abc').content, b'fail')
+        self.assertEqual(self.order().order_status, OrderInfo.ORDER_STATUS_ENUM['UNPAID'])
+
+    def test_notify_valid_signature(self):
+        self.assertEqual(self.notify('valid').content, b'success')
+        order = self.order()
+        self.assertEqual(order.order_status, OrderInfo.ORDER_STATUS_ENUM['UNCOMMENT'])
+        self.assertEqual(order.trade_no, 'trade_2')
+        self.assertIsNone(self.pending_delay())
+
+    def cancel(self):
+        # 和超时任务一样先取消订单再归还库存
+        OrderInfo.objects.filter(order_id=self.order_id).update(is_delete=True)
+        StockReservation().release(self.order_id)
+
+    def test_paid_after_cancel_restored(self):
+        self.cancel()
+        check_pending_payments(FakePayBackend(('success', 'trade_3')))
+        order = self.order()
+        self.assertFalse(order.is_delete)
+        self.assertEqual(order.order_status, OrderInfo.ORDER_STATUS_ENUM['UNCOMMENT'])
+        self.assertEqual(StockReservation().check(self.sku.id), (1, 8))
+
+    def test_paid_after_cancel_refund(self):
+        self.cancel()
+        get_redis_connection('default').set(STOCK_KEY % self.sku.id, 1)
+        check_pending_payments(FakePayBackend(('success', 'trade_4')))
+        order = self.order()
+        self.assertTrue(order.is_delete)
+        self.assertEqual(order.order_status, OrderInfo.ORDER_STATUS_ENUM['UNPAID'])
+        self.assertEqual(get_redis_connection('default').hget(PAY_REFUND_KEY, self.order_id), b'trade_4')
+        self.assertEqual(wait_result(self.order_id, 1), 'fail')
+
+
+class KeepAliveAliPayTest(SimpleTestCase):
+    """ 复用连接查询支付宝订单，依赖SDK的内部成员 """
+    def setUp(self):
+        self.alipay = AlipayBackend().alipay
+        patcher = mock.patch.object(self.alipay, '_verify_and_return_sync_response',
+                                    return_value={'code': '40004'})
+        self.verify = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_sdk_members(self):
+        # 升级SDK后这个测试失败时，需要按新版本检查KeepAliveAliPay使用的内部成员
+        self.assertEqual([name for name in KeepAliveAliPay.SDK_MEMBERS if not hasattr(self.alipay, name)], [])
+        self.assertTrue(self.alipay.keep_alive)
+
+    @mock.patch('order.gateway.http.client.HTTPSConnection')
+    def test_reuse_connection(self, connection_class):
+        connection_class.return_value.getresponse.return_value.read.return_value = b'{}'
+        self.assertEqual(self.alipay.api_alipay_trade_query('1'), {'code': '40004'})
+        self.alipay.api_alipay_trade_query('2')
+        connection_class.assert_called_once_with(urlsplit(self.alipay._gateway).netloc, timeout=15)
+        method, path = connection_class.return_value.request.call_args[0]
+        self.assertEqual(method, 'GET')
+        self.assertIn('alipay.trade.query', unquote(path))
+        self.assertEqual(self.verify.call_args[0], ('{}', 'alipay_trade_query_response'))
+
+    @mock.patch('order.gateway.http.client.HTTPSConnection')
+    def test_reconnect_once(self, connection_class):
+        conn = connection_class.return_value
+        conn.getresponse.return_value.read.return_value = b'{}'
+        conn.request.side_effect = [ConnectionResetError(), None]
+        self.alipay.api_alipay_trade_query('1')
+        self.assertEqual(connection_class.call_count, 2)
+        conn.request.side_effect = ConnectionResetError()
+        with self.assertRaises(ConnectionResetError):
+            self.alipay.api_alipay_trade_query('2')
+
+    def test_fallback_without_sdk_members(self):
+        self.alipay.keep_alive = False
+        with mock.patch.object(AliPay, 'api_alipay_trade_query', return_value={'code': '10000'}) as query:
+            self.assertEqual(self.alipay.api_alipay_trade_query('1'), {'code': '10000'})
+        query.assert_called_once_with(out_trade_no='1', trade_no=None)
+
+
+class OrderKeyTest(RedisTestMixin, TestCase):
+    """ 订单没有创建成功时释放订单key，重复提交不会拿到不存在的订单id """
+    def setUp(self):
+        super(OrderKeyTest, self).setUp()
+        goods_type, (sku,) = create_skus(1, prefix='order_key_test', stock=10)
+        self.sku_id = sku.id
+        self.user = User.objects.create_user('order_key_test', 'order_key_test@test.com', 'pwd')
+
+    def test_release_on_persist_failure(self):
+        order_id = next_id()
+        self.assertEqual(claim_key(self.user.id, 'k1', order_id), order_id)
+        enqueue({
+            'order_id': order_id,
+            'user_id': self.user.id,
+            # 地址不存在，写入失败
+            'addr_id': 0,
+            'pay_method': 1,
+            'transit_price': '10',
+            'total_count': 1,
+            'total_price': '1',
+            'items': [[self.sku_id, 1, '1']],
+            'order_key': 'k1',
+        })
+        self.assertEqual(persist_batch(), 1)
+        self.assertEqual(get_state(order_id, self.user.id)['status'], STATE_FAILED)
+        new_id = next_id()
+        self.assertEqual(claim_key(self.user.id, 'k1', new_id), new_id)
+
+
+class StockSyncTest(RedisTestMixin, TransactionTestCase):
+    """ 商品保存后同步redis库存，不覆盖期间预扣的库存 """
+    def setUp(self):
+        super(StockSyncTest, self).setUp()
+        goods_type, (sku,) = create_skus(1, prefix='sync_test', stock=10)
+        self.sku_id = sku.id
+        self.reservation = StockReservation()
+
+    def test_stale_save_keeps_reservation(self):
+        # 后台打开修改页面后有用户下单，再保存过期的表单
+        sku = GoodsSKU.objects.get(pk=self.sku_id)
+        self.assertIsNone(self.reservation.reserve(next_id(), [(self.sku_id, 2)]))
+        sku.name = 'sync_test_renamed'
+        sku.save()
+        self.assertEqual(self.reservation.check(self.sku_id), (1, 8))
+
+    def test_stock_change_applies_delta(self):
+        sku = GoodsSKU.objects.get(pk=self.sku_id)
+        self.assertIsNone(self.reservation.reserve(next_id(), [(self.sku_id, 2)]))
+        sku.stock += 5
+        sku.save()
+        self.assertEqual(self.reservation.check(self.sku_id), (1, 13))
+        sku.status = 0
+        sku.save()
+        self.assertEqual(self.reservation.check(self.sku_id), (0, 13))
+
+    def test_rollback_not_synced(self):
+        self.reservation.check(self.sku_id)
+        try:
+            with transaction.atomic():
+                sku = GoodsSKU.objects.get(pk=self.sku_id)
+                sku.stock = 100
+                sku.save()
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(self.reservation.check(self.sku_id), (1, 10))
+
+
+class ReconcileTest(RedisTestMixin, TestCase):
+    """ 对账只在redis没有变化时修正库存 """
+    def setUp(self):
+        super(ReconcileTest, self).setUp()
+        goods_type, (sku,) = create_skus(1, prefix='reconcile_test', stock=10)
+        self.sku_id = sku.id
+        self.reservation = StockReservation()
+        self.assertIsNone(self.reservation.reserve(next_id(), [(self.sku_id, 2)]))
+        self.conn = get_redis_connection('default')
+
+    def test_fix_wrong_stock(self):
+        self.conn.set(STOCK_KEY % self.sku_id, 3)
+        self.assertEqual(self.reservation.reconcile(), [self.sku_id])
+        # 预扣的2件还没有写入mysql
+        self.assertEqual(self.reservation.check(self.sku_id), (1, 8))
+        self.assertEqual(self.reservation.reconcile(), [])
+
+    def test_skip_changed_since_read(self):
+        # 读取后又有订单预扣，按读取时的数据不能修改
+        keys = [STOCK_KEY % self.sku_id, PENDING_KEY]
+        self.assertIsNone(self.reservation.reserve(next_id(), [(self.sku_id, 1)]))
+        self.assertEqual(self.reservation._fix_stock(keys=keys, args=[self.sku_id, 8, 2, 10]), 0)
+        self.assertEqual(self.reservation._fix_stock(keys=keys, args=[self.sku_id, 7, 2, 10]), 0)
+        self.assertEqual(self.reservation.check(self.sku_id), (1, 7))
+        self.assertEqual(self.reservation._fix_stock(keys=keys, args=[self.sku_id, 7, 3, 10]), 1)
@@ -1,12 +1,15 @@
 from django.urls import path
-from .views import OrderPlaceView, OrderCommitView, OrderPayView, CheckPayView, CommentView
+from django.views.decorators.csrf import csrf_exempt
+from .views import OrderPlaceView, OrderCommitView, OrderStatusView, OrderPayView, CheckPayView, AlipayNotifyView, CommentView
 
 
 app_name = 'order'
 urlpatterns = [
     path('place/', OrderPlaceView.as_view(), name='place'),  # 提交订单页面显示
     path('commit/', OrderCommitView.as_view(), name='commit'),  # 订单创建
+    path('status/', OrderStatusView.as_view(), name='status'),  # 订单处理进度
     path('pay/', OrderPayView.as_view(), name='pay'),  # 订单支付
     path('check/', CheckPayView.as_view(), name='check'),  # 查询支付结果
+    path('notify/', csrf_exempt(AlipayNotifyView.as_view()), name='notify'),  # 支付宝异步通知
     path('comment/<int:order_id>/', CommentView.as_view(), name='comment'),  # 订单评论
 ]
@@ -1,18 +1,22 @@
-from datetime import datetime
-import os
+import uuid
 
 from django.shortcuts import render, redirect, reverse
 from django.views.generic import View
-from django.http import JsonResponse
-from django.db import transaction
-from django.conf import settings
+from django.http import JsonResponse, HttpResponse
 
+from utils.snowflake import next_id
 from goods.models import GoodsSKU
+from goods.utils import schedule_detail_pages
 from user.models import Address
 from .models import OrderInfo, OrderGoods
+from .stock import StockReservation
+from .gateway import get_backend
+from .payment import add_pending, mark_paid, wait_result, pay_timeout, PAY_CHECK_DELAY
+from .pipeline import claim_key, release_key, enqueue, get_state
+from cart.cart import Cart
+from celery_tasks.tasks import persist_orders
 
 from django_redis import get_redis_connection
-from alipay import AliPay
 
 class OrderPlaceView(View):
     """
@@ -21,29 +25,34 @@ class OrderPlaceView(View):
     """
     def post(self, request):
         user = request.user
+        # 未登录时先登录，登录后未登录时的购物车会合并到用户的购物车
+        if not user.is_authenticated:
+            return redirect(reverse('user:login') + '?next=' + reverse('cart:show'))
         # 获取参数sku_ids
         sku_ids = request.POST.getlist('sku_ids', '')
         if not sku_ids:
             return redirect(reverse('cart:show'))
-        conn = get_redis_connection('default')
-        cart_key = 'cart_%d' % user.id
+        cart = Cart(user.id)
         skus = []
         # 保存商品的总件数和总价格
         total_price = 0
         total_count = 0
+        # 一次查询获取用户要购买的商品信息，使用最新的价格
+        skus_li = GoodsSKU.objects.get_skus(sku_ids, request=request, fresh=True)
+        if len(skus_li) != len(sku_ids):
+            return redirect(reverse('cart:show'))
+        # 一次获取全部商品的数量
+        counts = cart.counts([sku.id for sku in skus_li])
+        if None in counts:
+            return redirect(reverse('cart:show'))
         # 遍历skus获取用户要购买的商品信息
-        for id in sku_ids:
-            try:
-                sku = GoodsSKU.objects.get(pk=id)
-            except GoodsSKU.DoesNotExist as e:
-                return redirect(reverse('cart:show'))
-            count = conn.hget(cart_key, id)
-            amount = sku.price * int(count)
-            sku.count = count.decode()
+        for sku, count in zip(skus_li, counts):
+            amount = sku.price * count
+            sku.count = count
             sku.amount = amount
             skus.append(sku)
             total_price += int(amount)
-            total_count += int(count)
+            total_count += count
 
         # 运费
         transit_price = 10
@@ -57,6 +66,7 @@ class OrderPlaceView(View):
         # 组织上下文
         sku_ids = ','.join(sku_ids)
         context = {
+            'order_key': uuid.uuid4().hex,  # 防止重复提交订单
             'skus': skus,
             'total_count': total_count,
             'total_price': total_price,
@@ -71,12 +81,11 @@ class OrderPlaceView(View):
 class OrderCommitView(View):
     """
     todo: 订单创建
-    前端传递的参数:地址id(addr_id) 支付方式(pay_method) 用户要购买的商品id字符串(sku_ids)
-    mysql事务: 一组sql操作，要么都成功，要么都失败
-    高并发:秒杀
+    前端传递的参数:地址id(addr_id) 支付方式(pay_method) 用户要购买的商品id字符串(sku_ids) 订单key(order_key)
+    高并发:秒杀，库存在redis中用lua脚本原子预扣，订单放入队列后由celery批量写入mysql
+    同一个order_key只会创建一个订单，重复提交返回同一个订单id
     支付宝支付
     """
-    @transaction.atomic  # django事务
     def post(self, request):
         user = request.user
         if not user.is_authenticated:
@@ -86,9 +95,10 @@ class OrderCommitView(View):
         addr_id = request.POST.get('addr_id', '')
         pay_method = request.POST.get('pay_method', '')
         sku_ids = request.POST.get('sku_ids', '')
+        order_key = request.POST.get('order_key', '')
 
         # 参数效验
-        if not all([addr_id, pay_method, sku_ids]):
+        if not all([addr_id, pay_method, sku_ids, order_key]):
             return JsonResponse({'res': 1, 'errmsg': '参数不完整'})
 
         # 效验支付方式
@@ -103,9 +113,23 @@ class OrderCommitView(View):
 
         # todo: 创建订单核心业务
         # 组织参数
-        # 订单ID：20180606181630+用户id
-        order_id = datetime.now().strftime('%Y%m%d%H%M%S') + str(user.id)
+        # 订单ID：雪花算法生成，同一用户同一秒内多次下单也不会重复
+        order_id = next_id()
 
+        # 重复提交时返回之前的订单
+        claimed_id = claim_key(user.id, order_key, order_id)
+        if claimed_id != order_id:
+            return JsonResponse({'res': 5, 'order_id': str(claimed_id), 'message': '创建成功'})
+
+        try:
+            return self.create_order(user, addr, pay_method, sku_ids, order_key, order_id, request)
+        except Exception:
+            # 出错时释放订单key，重复提交不会拿到一个不存在的订单id，可以用同一个key重新提交
+            release_key(user.id, order_key)
+            raise
+
+    def create_order(self, user, addr, pay_method, sku_ids, order_key, order_id, request):
+        """ 已经占用订单key后预扣库存并把订单放入队列 """
         # 运费
         transit_price = 10
 
@@ -113,86 +137,72 @@ class OrderCommitView(View):
         total_count = 0
         total_price = 0
 
-        # 设置事务保存点
-        save_id = transaction.savepoint()
+        conn = get_redis_connection('default')
+        cart = Cart(user.id, conn)
+
+        # 从redis中获取用户所要购买的商品的数量
+        sku_ids = sku_ids.split(',')
+        counts = cart.counts(sku_ids)
+        if None in counts:
+            release_key(user.id, order_key)
+            return JsonResponse({'res': 4, 'errmsg': '商品不存在'})
+
+        skus = GoodsSKU.objects.get_skus(sku_ids, request=request, fresh=True)
+        if len(skus) != len(sku_ids):
+            release_key(user.id, order_key)
+            return JsonResponse({'res': 4, 'errmsg': '商品不存在'})
+
+        # todo: 累加计算商品的总数量和总价格
+        items = []
+        for sku, count in zip(skus, counts):
+            items.append([sku.id, count, str(sku.price)])
+            total_count += count
+            total_price += sku.price * count
+
+        # todo: 在redis中原子预扣全部商品的库存，代替mysql的乐观锁重试
+        # 货到付款的订单不需要超时归还库存
+        reservation = StockReservation(conn)
+        if reservation.reserve(order_id, [(sku_id, count) for sku_id, count, price in items], expire=pay_method != '1') is not None:
+            release_key(user.id, order_key)
+            return JsonResponse({'res': 6, 'errmsg': '商品库存不足'})
+
+        # todo: 订单放入队列，由celery批量写入df_order_info和df_order_goods
+        enqueue({
+            'order_id': order_id,
+            'user_id': user.id,
+            'addr_id': addr.id,
+            'pay_method': int(pay_method),
+            'transit_price': str(transit_price),
+            'total_count': total_count,
+            'total_price': str(total_price),
+            'items': items,
+            'order_key': order_key,
+        })
+        persist_orders.delay()
 
-        try:
-            # todo: 向df_order_info表中添加一条记录
-            order = OrderInfo.objects.create(
-                order_id=order_id,
-                user = user,
-                addr = addr,
-                pay_method=pay_method,
-                total_count=total_count,
-                total_price=total_price,
-                transit_price=transit_price,
-            )
+        # 清除用户购物车中对应的记录
+        cart.delete(*sku_ids)
 
-            # todo: 用户的订单中有几个商品，需要向df_order_goods表中加入几条记录
-            conn = get_redis_connection('default')
-            cart_key = 'cart_%d' % user.id
-
-            sku_ids = sku_ids.split(',')
-            for sku_id in sku_ids:
-                # 乐观锁，尝试三次
-                for i in range(3):
-                    try:
-                        sku = GoodsSKU.objects.get(pk=sku_id)
-                    except GoodsSKU.DoesNotExist:
-                        transaction.savepoint_rollback(save_id)
-                        return JsonResponse({'res': 4, 'errmsg': '商品不存在'})
-                    # 从redis中获取用户所要购买的商品的数量
-                    count = conn.hget(cart_key, sku_id)
-
-                    # 判断商品的库存
-                    if int(count) > sku.stock:
-                        transaction.savepoint_rollback(save_id)
-                        return JsonResponse({'res': 6, 'errmsg': '商品库存不足'})
-
-                    # todo: 更新商品的库存和销量
-                    origin_stock = sku.stock
-                    new_stock = origin_stock - int(count)
-                    new_sales = sku.sales + int(count)
-                    sku.save()
-
-                    # 返回受影响的行数，能查到说明库存没变，可以更新，查不到说明原库存已经变化，不能直接更新，要重新循环一次
-                    res = GoodsSKU.objects.filter(id=sku.id, stock=origin_stock).update(stock=new_stock, sales=new_sales)
-                    if res == 0:
-                        if i == 2:
-                            # 尝试的第三次
-                            transaction.savepoint_rollback(save_id)
-                            return JsonResponse({'res': 7, 'errmsg': '下单失败2'})
-                        continue
-
-                    # todo: 向df_order_goods表中添加一条记录
-                    OrderGoods.objects.create(
-                        order=order,
-                        sku=sku,
-                        count=count,
-                        price=sku.price
-                    )
-
-                    # todo: 累加计算商品的总数量和总价格
-                    amount = sku.price * int(count)
-                    total_count += int(count)
-                    total_price += amount
-                    break
-
-            # todo: 更新订单信息表中的商品的总数量和总价格
-            order.total_count = total_count
-            order.total_price = total_price
-            order.save()
-        except Exception as e:
-            transaction.savepoint_rollback(save_id)
-            return JsonResponse({'res': 7, 'errmsg': '下单失败'})
-
-        # 提交事务
-        transaction.savepoint_commit(save_id)
+        # 订单id超过了js能精确表示的整数范围(2^53)，以字符串返回
+        return JsonResponse({'res': 5, 'order_id': str(order_id), 'message': '创建成功'})
 
-        # 清除用户购物车中对应的记录
-        conn.hdel(cart_key, *sku_ids)
 
-        return JsonResponse({'res': 5, 'message': '创建成功'})
+class OrderStatusView(View):
+    """
+    /order/status
+    查询订单的处理进度
+    前端传递的参数:订单id(order_id)
+    """
+    def get(self, request):
+        user = request.user
+        if not user.is_authenticated:
+            return JsonResponse({'res': 0, 'errmsg': '用户未登录'})
+
+        order_id = request.GET.get('order_id', '')
+        state = get_state(order_id, user.id)
+        if state is None:
+            return JsonResponse({'res': 1, 'errmsg': '无效的订单id'})
+        return JsonResponse({'res': 2, 'status': state['status'], 'errmsg': state['errmsg']})
 
 
 class OrderPayView(View):
@@ -218,36 +228,25 @@ class OrderPayView(View):
                 order_id = order_id,
                 user = user,
                 pay_method = 3,
-                order_status = 1
+                order_status = 1,
+                is_delete = False
             )
         except OrderInfo.DoesNotExist:
             return JsonResponse({'res':2, 'errmsg':'订单错误'})
 
-        # 业务处理:使用python sdk调用支付宝的支付接口
-        # 初始化
-        alipay = AliPay(
-            appid = "2016092300580591",
-            app_notify_url = None,  # 默认回调url
-            app_private_key_string = settings.APP_PRIVATE_KEY_STRING,  # 应用的私匙
-            # 支付宝的公钥，验证支付宝回传消息使用，不是你自己的公钥,
-            alipay_public_key_string = settings.ALIPAY_PUBLIC_KEY_STRING,
-            sign_type = "RSA2",  # RSA 或者 RSA2
-            debug = True,  # 默认False
-        )
-
-        # 调用支付接口
-        # 电脑网站支付，需要跳转到https://openapi.alipay.com/gateway.do? + order_string
-        total_pay = order.total_price + order.transit_price  # Decimal
-        order_string = alipay.api_alipay_trade_page_pay(
-            out_trade_no = order_id,  # 订单id
-            total_amount = str(total_pay),  # 支付总金额
-            subject = '天天生鲜%s' % order_id,
-            return_url = None,
-            notify_url = None # 可选, 不填则使用默认notify url
-        )
+        # 预扣的库存归还前支付宝要先关闭交易，不能在订单取消后才付款
+        timeout = pay_timeout(order_id)
+        if timeout < 60:
+            return JsonResponse({'res': 2, 'errmsg': '订单已超时'})
+
+        # 业务处理:调用支付接口，支付接口对象每个进程只创建一次
+        backend = get_backend(order.pay_method)
+        pay_url = backend.pay_url(order, timeout)
+
+        # 后台开始查询支付结果
+        add_pending(order_id, PAY_CHECK_DELAY)
 
         # 返回应答
-        pay_url = 'https://openapi.alipaydev.com/gateway.do?' + order_string
         return JsonResponse({'res': 3, 'pay_url': pay_url})
 
 
@@ -255,7 +254,10 @@ class CheckPayView(View):
     """
     /order/check
     查看订单支付的结果
+    支付结果由celery在后台查询或由支付宝通知，这里最多等待PAY_WAIT秒，还没有结果时返回等待，由前端再次请求
     """
+    PAY_WAIT = 3
+
     def post(self, request):
         user = request.user
         if not user.is_authenticated:
@@ -272,67 +274,50 @@ class CheckPayView(View):
             order = OrderInfo.objects.get(
                 order_id=order_id,
                 user=user,
-                pay_method=3,
-                order_status=1
+                pay_method=3
             )
         except OrderInfo.DoesNotExist:
             return JsonResponse({'res': 2, 'errmsg': '订单错误'})
-        # 业务处理:使用python sdk调用支付宝的支付接口
-        # 初始化
-        alipay = AliPay(
-            appid="2016092300580591",
-            app_notify_url=None,  # 默认回调url
-            app_private_key_string=settings.APP_PRIVATE_KEY_STRING,  # 应用的私匙
-            # 支付宝的公钥，验证支付宝回传消息使用，不是你自己的公钥,
-            alipay_public_key_string=settings.ALIPAY_PUBLIC_KEY_STRING,
-            sign_type="RSA2",  # RSA 或者 RSA2
-            debug=True,  # 默认False
-        )
-        # 调用支付宝的交易查询接口
-        while True:
-            response = alipay.api_alipay_trade_query(order_id)
-            # response = {
-            #         "trade_no": "2017032121001004070200176844", # 支付宝交易号
-            #         "code": "10000", # 接口调用是否成功
-            #         "invoice_amount": "20.00",
-            #         "open_id": "20880072506750308812798160715407",
-            #         "fund_bill_list": [
-            #             {
-            #                 "amount": "20.00",
-            #                 "fund_channel": "ALIPAYACCOUNT"
-            #             }
-            #         ],
-            #         "buyer_logon_id": "csq***@sandbox.com",
-            #         "send_pay_date": "2017-03-21 13:29:17",
-            #         "receipt_amount": "20.00",
-            #         "out_trade_no": "out_trade_no15",
-            #         "buyer_pay_amount": "20.00",
-            #         "buyer_user_id": "2088102169481075",
-            #         "msg": "Success",
-            #         "point_amount": "0.00",
-            #         "trade_status": "TRADE_SUCCESS", # 支付结果
-            #         "total_amount": "20.00"
-            # }
-            code = response.get('code')
-            if code == '10000' and response.get('trade_status') == 'TRADE_SUCCESS':
-                # 支付成功
-                # 获取支付宝交易号
-                trade_no = response.get('trade_no')
-                # 更新订单状态
-                order.trade_no = trade_no
-                order.order_status = 4  # 待评价
-                order.save()
-                return JsonResponse({'res': 3, 'message': '支付成功'})
-            elif code == '40004' or (code == '10000' and response.get('trade_status') == 'WAIT_BUYER_PAY'):
-                # 等待买家付款
-                # 业务处理失败，可能一会就会成功
-                import time
-                time.sleep(5)
-                continue
-            else:
-                # 支付出错
-                print(code)
-                return JsonResponse({'res': 4, 'errmsg': '支付失败'})
+
+        if order.order_status != OrderInfo.ORDER_STATUS_ENUM['UNPAID']:
+            # 已经支付
+            return JsonResponse({'res': 3, 'message': '支付成功'})
+
+        # 让后台尽快查询，并等待结果通知
+        add_pending(order_id)
+        result = wait_result(order_id, self.PAY_WAIT)
+        if result == 'success':
+            return JsonResponse({'res': 3, 'message': '支付成功'})
+        elif result == 'fail':
+            return JsonResponse({'res': 4, 'errmsg': '支付失败'})
+        # 等待买家付款
+        return JsonResponse({'res': 5, 'errmsg': '等待支付'})
+
+
+class AlipayNotifyView(View):
+    """
+    /order/notify
+    支付宝异步通知支付结果
+    """
+    def post(self, request):
+        data = request.POST.dict()
+        signature = data.pop('sign', None)
+        backend = get_backend(3)
+        if not signature or not backend.verify(data, signature):
+            return HttpResponse('fail')
+
+        # 签名正确还要检查是本应用的订单，且金额和订单一致
+        try:
+            order = OrderInfo.objects.get(order_id=int(data.get('out_trade_no', '')))
+        except (ValueError, OrderInfo.DoesNotExist):
+            return HttpResponse('fail')
+        if not backend.check_notify(data, order):
+            return HttpResponse('fail')
+
+        if data.get('trade_status') in ('TRADE_SUCCESS', 'TRADE_FINISHED'):
+            mark_paid(order.order_id, data.get('trade_no'))
+        # 告诉支付宝已收到通知
+        return HttpResponse('success')
 
 class CommentView(View):
     """
@@ -398,4 +383,7 @@ class CommentView(View):
         order.order_status = 5  # 已完成
         order.save()
 
+        # 评论修改后重新生成商品的静态详情页
+        schedule_detail_pages(OrderGoods.objects.filter(order=order).values_list('sku_id', flat=True))
+
         return redirect(reverse("user:order", kwargs={"page": 1}))
\ No newline at end of file
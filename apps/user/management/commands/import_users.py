@@ -0,0 +1,33 @@
+import csv
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from user.registration import import_users, IMPORT_BATCH
+
+
+class Command(BaseCommand):
+    help = '从csv文件批量导入用户，列为 username,email,password[,is_active]，password默认是django格式的哈希'
+
+    def add_arguments(self, parser):
+        parser.add_argument('csv_file', help='csv文件，第一行为列名')
+        parser.add_argument('--batch-size', type=int, default=IMPORT_BATCH, help='每次写入的用户数')
+        parser.add_argument('--plain', action='store_true', help='password列是明文，导入时计算哈希(很慢)')
+
+    def handle(self, *args, **options):
+        start = time.time()
+        try:
+            with open(options['csv_file'], encoding='utf-8', newline='') as f:
+                reader = csv.DictReader(f)
+                missing = {'username', 'email', 'password'} - set(reader.fieldnames or ())
+                if missing:
+                    raise CommandError('csv文件缺少列: %s' % ', '.join(sorted(missing)))
+                imported, skipped = import_users(reader, options['batch_size'], hashed=not options['plain'])
+        except OSError as e:
+            raise CommandError(e)
+
+        # 行号不含列名所在的第一行
+        for line, reason in skipped:
+            self.stderr.write('第%d行: %s' % (line, reason))
+        self.stdout.write(self.style.SUCCESS('导入了%d个用户，跳过%d个，用时%.1f秒' % (
+            imported, len(skipped), time.time() - start)))
@@ -0,0 +1,86 @@
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from django.contrib.auth import authenticate
+from django.core.management.base import BaseCommand
+from django_redis import get_redis_connection
+
+from user.models import User
+from user.throttle import LoginGuard, authenticate_user, LOGIN_IP_KEY, LOGIN_USER_KEY, UNKNOWN_USER_KEY
+from utils.benchmark import percentile
+
+
+class Command(BaseCommand):
+    help = '模拟撞库攻击，对比有无登录限流时工作线程被密码哈希占用的时间和正常用户的登录延迟'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--attempts', type=int, default=400, help='攻击的登录次数')
+        parser.add_argument('--ips', type=int, default=4, help='攻击使用的ip数')
+        parser.add_argument('--legit', type=int, default=20, help='攻击期间正常用户的登录次数')
+        parser.add_argument('--workers', type=int, default=8, help='工作线程数，对应uwsgi的processes*threads')
+
+    def handle(self, *args, **options):
+        prefix = 'bench_%s' % uuid.uuid4().hex[:8]
+        victim = '%s_victim' % prefix
+        member = '%s_member' % prefix
+        password = uuid.uuid4().hex
+        User.objects.create_user(username=victim, email='%s@example.com' % victim, password=password)
+        User.objects.create_user(username=member, email='%s@example.com' % member, password=password)
+
+        # 一半猜测已有用户的密码，一半尝试不存在的用户名，正常用户的登录均匀混在攻击中
+        requests = []
+        step = max(1, options['attempts'] // max(1, options['legit']))
+        for i in range(options['attempts']):
+            ip = '10.255.0.%d' % (i % options['ips'])
+            username = victim if i % 2 else '%s_%d' % (prefix, i)
+            requests.append((False, ip, username, uuid.uuid4().hex))
+            if i % step == 0 and i // step < options['legit']:
+                requests.append((True, '10.254.0.%d' % (i // step), member, password))
+
+        ips = {ip for legit, ip, username, pwd in requests}
+        usernames = {username for legit, ip, username, pwd in requests}
+        try:
+            self.clean(ips, usernames)
+            plain = self.run(requests, options['workers'],
+                             lambda ip, username, pwd: authenticate(username=username, password=pwd))
+            guard = LoginGuard()
+            guarded = self.run(requests, options['workers'],
+                               lambda ip, username, pwd: authenticate_user(ip, username, pwd, guard)[0])
+        finally:
+            self.clean(ips, usernames)
+            User.objects.filter(username__in=[victim, member]).delete()
+
+        self.report('无限流', plain)
+        self.report('有限流', guarded)
+
+    def clean(self, ips, usernames):
+        conn = get_redis_connection('default')
+        keys = [LOGIN_IP_KEY % ip for ip in ips]
+        keys += [key % username for username in usernames for key in (LOGIN_USER_KEY, UNKNOWN_USER_KEY)]
+        conn.delete(*keys)
+
+    def run(self, requests, workers, login):
+        """ 所有请求同时到达，返回 (总用时, 工作线程占用的总时间, 正常用户的延迟, 正常用户登录成功数) """
+        def attempt(legit, ip, username, pwd):
+            start = time.perf_counter()
+            user = login(ip, username, pwd)
+            end = time.perf_counter()
+            return legit, user is not None, end - start, end - begin
+
+        begin = time.perf_counter()
+        with ThreadPoolExecutor(workers) as pool:
+            results = list(pool.map(lambda request: attempt(*request), requests))
+        total = time.perf_counter() - begin
+        busy = sum(cost for legit, ok, cost, latency in results)
+        latencies = [latency * 1000 for legit, ok, cost, latency in results if legit]
+        succeeded = sum(1 for legit, ok, cost, latency in results if legit and ok)
+        return total, busy, latencies, succeeded
+
+    def report(self, name, result):
+        total, busy, latencies, succeeded = result
+        latencies = latencies or [0]
+        self.stdout.write('%s 总用时%.2fs 线程占用%.2fs 正常登录%d/%d 延迟p50=%.0fms p95=%.0fms max=%.0fms' % (
+            name, total, busy, succeeded, len(result[2]),
+            percentile(latencies, 50), percentile(latencies, 95), max(latencies),
+        ))
@@ -0,0 +1,85 @@
+import time
+import uuid
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from django.contrib.sessions.backends.cache import SessionStore
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from goods.testdata import create_skus, delete_skus
+from order.models import OrderInfo, OrderGoods
+from user.models import User, Address
+from user.views import OrderView
+from utils.benchmark import summarize
+from utils.snowflake import next_id
+
+
+ORDERS_PER_HOUR = 100  # 生成的订单每小时100单，同一小时内的订单按订单id排序
+
+
+class Command(BaseCommand):
+    help = '生成有大量订单的用户，测试用户中心订单页第一页、中间页和最后一页的延迟和sql语句数'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--orders', type=int, default=10000, help='用户的订单数')
+        parser.add_argument('--repeat', type=int, default=20, help='每一页请求的次数')
+
+    def handle(self, *args, **options):
+        name = 'bench_%s' % uuid.uuid4().hex[:8]
+        user = User.objects.create_user(username=name, email='%s@example.com' % name, password=uuid.uuid4().hex)
+        goods_type, skus = create_skus(3, prefix='order_bench')
+        try:
+            addr = Address.objects.create(user=user, receiver=name, addr='benchmark', phone='13800000000',
+                                          is_default=True)
+            self.create_orders(user, addr, skus, options['orders'])
+            view = OrderView.as_view()
+            num_pages = (options['orders'] + 2) // 3
+            for page in sorted({1, num_pages // 2 or 1, num_pages}):
+                self.measure(view, user, page, options['repeat'])
+        finally:
+            OrderGoods.objects.filter(order__user=user).delete()
+            OrderInfo.objects.filter(user=user).delete()
+            user.delete()
+            delete_skus(goods_type)
+
+    def create_orders(self, user, addr, skus, count):
+        start = time.perf_counter()
+        orders = []
+        order_skus = []
+        for i in range(count):
+            order_id = next_id()
+            items = skus[:i % len(skus) + 1]
+            orders.append(OrderInfo(order_id=order_id, user=user, addr=addr, pay_method=3,
+                                    total_count=len(items), total_price=sum(sku.price for sku in items),
+                                    transit_price=Decimal(10), order_status=i % 5 + 1, trade_no=''))
+            order_skus += [OrderGoods(order_id=order_id, sku=sku, count=1, price=sku.price) for sku in items]
+        OrderInfo.objects.bulk_create(orders, batch_size=1000)
+        OrderGoods.objects.bulk_create(order_skus, batch_size=1000)
+        # bulk_create时下单时间都是当前时间，按订单id改成越早的订单时间越早
+        now = datetime.now()
+        hours = (count + ORDERS_PER_HOUR - 1) // ORDERS_PER_HOUR
+        for hour in range(hours):
+            batch = orders[hour * ORDERS_PER_HOUR:(hour + 1) * ORDERS_PER_HOUR]
+            OrderInfo.objects.filter(order_id__in=[order.order_id for order in batch]).update(
+                create_time=now - timedelta(hours=hours - hour))
+        self.stdout.write('生成%d个订单，用时%.1fs' % (count, time.perf_counter() - start))
+
+    def measure(self, view, user, page, repeat):
+        factory = RequestFactory()
+        latencies = []
+        queries = 0
+        for i in range(repeat):
+            request = factory.get(reverse('user:order', kwargs={'page': page}))
+            request.user = user
+            request.session = SessionStore()
+            with CaptureQueriesContext(connection) as context:
+                start = time.perf_counter()
+                response = view(request, page=page)
+                latencies.append((time.perf_counter() - start) * 1000)
+            queries = len(context.captured_queries)
+        self.stdout.write('第%d页 status=%d sql语句%d条 %s' % (page, response.status_code, queries,
+                                                          summarize(latencies)))
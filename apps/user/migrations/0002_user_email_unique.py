@@ -0,0 +1,35 @@
+from django.db import migrations, models
+import user.models
+
+
+def blank_email_to_null(apps, schema_editor):
+    # 没有邮箱的用户改为NULL，唯一索引允许多个NULL
+    User = apps.get_model('user', 'User')
+    User.objects.filter(email='').update(email=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterModelManagers(
+            name='user',
+            managers=[
+                ('objects', user.models.UserManager()),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='user',
+            name='email',
+            field=models.EmailField(blank=True, max_length=254, null=True, verbose_name='邮箱'),
+        ),
+        migrations.RunPython(blank_email_to_null, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='user',
+            name='email',
+            field=models.EmailField(blank=True, max_length=254, null=True, unique=True, verbose_name='邮箱'),
+        ),
+    ]
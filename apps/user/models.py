@@ -1,10 +1,24 @@
 from django.db import models
-from django.contrib.auth.models import AbstractUser
+from django.contrib.auth.models import AbstractUser, UserManager as BaseUserManager
 from db.base_model import BaseModel
 
 
+class UserManager(BaseUserManager):
+    """ 用户模型管理类 """
+    @classmethod
+    def normalize_email(cls, email):
+        """ 没有邮箱时返回None，create_user、createsuperuser和后台表单(clean)都通过这里规范邮箱 """
+        return super(UserManager, cls).normalize_email(email) or None
+
+
 class User(AbstractUser, BaseModel):
     """ 自定义用户模型类 """
+    # 邮箱唯一，注册时由唯一索引保证不重复
+    # 没有邮箱(createsuperuser、后台添加的用户)时保存为NULL，唯一索引允许多个NULL
+    email = models.EmailField(unique=True, null=True, blank=True, verbose_name='邮箱')
+
+    objects = UserManager()
+
     class Meta:
         db_table = 'df_user'
         verbose_name = '用户'
@@ -0,0 +1,117 @@
+from django.contrib.auth.hashers import make_password, identify_hasher
+from django.db import IntegrityError
+from django.db.models import Q
+
+from user.models import User
+from user.throttle import LoginGuard
+
+
+IMPORT_BATCH = 1000  # 批量导入时每次写入的用户数
+
+
+def find_conflict(username, email):
+    """ 一次查询检查用户名和邮箱是否已被使用，返回错误信息，都未被使用时返回None """
+    # 没有邮箱(NULL)时只检查用户名，email=None会匹配所有没有邮箱的用户
+    condition = Q(username=username) | Q(email=email) if email else Q(username=username)
+    taken = list(User.objects.filter(condition).values_list('username', 'email')[:2])
+    # mysql默认的排序规则不区分大小写
+    if any(name.lower() == username.lower() for name, _ in taken):
+        return '用户名已存在'
+    if taken:
+        return '邮箱已存在'
+    return None
+
+
+def build_user(username, email, password, is_active=False, hashed=False):
+    """ 生成用户对象，不写数据库，hashed为True时password是已经计算好的哈希 """
+    user = User(
+        username=User.normalize_username(username),
+        email=User.objects.normalize_email(email),
+        is_active=is_active,
+    )
+    user.password = password if hashed else make_password(password)
+    return user
+
+
+def register_user(username, email, password):
+    """
+    注册未激活的用户，返回 (用户, 错误信息)
+    检查是一次查询，写入是一条insert，并发注册时由用户名和邮箱的唯一索引保证不重复
+    """
+    # 先检查是否已被使用，再计算密码哈希
+    username = User.normalize_username(username)
+    email = User.objects.normalize_email(email)
+    errmsg = find_conflict(username, email)
+    if errmsg:
+        return None, errmsg
+    user = build_user(username, email, password)
+    try:
+        user.save(force_insert=True)
+    except IntegrityError:
+        # 检查之后被其他请求注册了
+        return None, find_conflict(user.username, user.email) or '用户名已存在'
+    # 注册前尝试登录过这个用户名时，清除用户名不存在的记录
+    LoginGuard().forget_unknown(user.username)
+    return user, None
+
+
+def import_users(rows, batch_size=IMPORT_BATCH, hashed=True):
+    """
+    批量导入用户，rows为 {username, email, password, is_active} 的可迭代对象
+    hashed为True时password必须是django格式的哈希，不再计算
+    已存在或文件中重复的用户名、邮箱跳过，返回 (导入数, 跳过的 (行号, 原因))
+    """
+    imported = 0
+    skipped = []
+    seen_names = set()
+    seen_emails = set()
+    batch = []
+
+    def flush():
+        # 一次查询找出这一批中已存在的用户名和邮箱
+        usernames = [user.username for line, user in batch]
+        emails = [user.email for line, user in batch]
+        exist_names = set()
+        exist_emails = set()
+        for name, email in User.objects.filter(Q(username__in=usernames) | Q(email__in=emails)).values_list(
+                'username', 'email'):
+            exist_names.add(name.lower())
+            if email:
+                exist_emails.add(email.lower())
+        users = []
+        for line, user in batch:
+            if user.username.lower() in exist_names or user.email.lower() in exist_emails:
+                skipped.append((line, '用户名或邮箱已存在'))
+            else:
+                users.append(user)
+        User.objects.bulk_create(users, batch_size=batch_size)
+        LoginGuard().forget_unknown(*[user.username for user in users])
+        del batch[:]
+        return len(users)
+
+    for line, row in enumerate(rows, 1):
+        username = (row.get('username') or '').strip()
+        email = (row.get('email') or '').strip()
+        password = row.get('password') or ''
+        if not all([username, email, password]):
+            skipped.append((line, '数据不完整'))
+            continue
+        if hashed:
+            try:
+                identify_hasher(password)
+            except ValueError:
+                skipped.append((line, '密码不是django格式的哈希'))
+                continue
+        is_active = (row.get('is_active') or '1').strip().lower() not in ('0', 'false', 'no')
+        user = build_user(username, email, password, is_active=is_active, hashed=hashed)
+        if user.username.lower() in seen_names or user.email.lower() in seen_emails:
+            skipped.append((line, '文件中的用户名或邮箱重复'))
+            continue
+        seen_names.add(user.username.lower())
+        seen_emails.add(user.email.lower())
+        batch.append((line, user))
+        if len(batch) >= batch_size:
+            imported += flush()
+    if batch:
+        imported += flush()
+    return imported, skipped
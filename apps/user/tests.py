@@ -1,3 +1,90 @@
+from unittest import mock
+
+from django.contrib.auth.signals import user_login_failed
 from django.test import TestCase
+from django.urls import reverse
+
+from goods.history import History, HISTORY_SIZE
+from goods.testdata import create_skus, clear_caches
+from user.models import User
+from user.throttle import authenticate_user
+from utils.testing import RedisTestMixin, count_queries
+
+
+class UserInfoViewQueryTest(RedisTestMixin, TestCase):
+    """ 用户中心信息页的sql语句数和浏览记录数无关 """
+    def setUp(self):
+        super(UserInfoViewQueryTest, self).setUp()
+        self.user = User.objects.create_user('user_test', 'user_test@example.com', 'password')
+        self.client.force_login(self.user)
+        goods_type, self.skus = create_skus(HISTORY_SIZE, prefix='user_test')
+
+    def view(self, count):
+        history = History(self.user.id)
+        for sku in self.skus[:count]:
+            history.add(sku.id)
+        clear_caches()
+
+    def test_queries_constant(self):
+        self.view(1)
+        queries = count_queries(self.client.get, reverse('user:user'))
+
+        self.view(HISTORY_SIZE)
+        with self.assertNumQueries(queries):
+            response = self.client.get(reverse('user:user'))
+        # 只显示最近浏览的5条
+        self.assertEqual(len(response.context['goods_li']), 5)
+
+
+class AuthenticateUserTest(RedisTestMixin, TestCase):
+    """ 登录限流后仍然通过authenticate()验证 """
+    def setUp(self):
+        super(AuthenticateUserTest, self).setUp()
+        self.user = User.objects.create_user('login_test', 'login_test@example.com', 'password')
+
+    def test_success(self):
+        user, errmsg = authenticate_user('10.0.0.1', 'login_test', 'password')
+        self.assertEqual(user, self.user)
+        self.assertIsNone(errmsg)
+        self.assertTrue(hasattr(user, 'backend'))
+
+    def test_failed_signal(self):
+        failed = []
+
+        def receiver(credentials, **kwargs):
+            failed.append(credentials['username'])
+        user_login_failed.connect(receiver)
+        try:
+            user, errmsg = authenticate_user('10.0.0.1', 'login_test', 'wrong')
+        finally:
+            user_login_failed.disconnect(receiver)
+        self.assertIsNone(user)
+        self.assertEqual(failed, ['login_test'])
+
+    def test_inactive(self):
+        self.user.is_active = False
+        self.user.save()
+        user, errmsg = authenticate_user('10.0.0.1', 'login_test', 'password')
+        self.assertFalse(user.is_active)
+        self.assertEqual(authenticate_user('10.0.0.1', 'login_test', 'wrong'), (None, '用户名或密码错误'))
+
+    def test_unknown_user_not_hashed(self):
+        self.assertEqual(authenticate_user('10.0.0.1', 'nobody', 'password')[0], None)
+        with mock.patch('user.throttle.authenticate') as auth:
+            self.assertEqual(authenticate_user('10.0.0.1', 'nobody', 'password')[0], None)
+        auth.assert_not_called()
+
+
+class UserEmailTest(TestCase):
+    """ 邮箱唯一，没有邮箱的用户保存为NULL """
+    def test_users_without_email(self):
+        first = User.objects.create_user('no_email_1', '', 'password')
+        second = User.objects.create_superuser('no_email_2', '', 'password')
+        self.assertIsNone(first.email)
+        self.assertIsNone(second.email)
 
-# Create your tests here.
+    def test_clean_blank_email(self):
+        # 后台表单保存前调用clean()
+        user = User(username='form_user', email='')
+        user.clean()
+        self.assertIsNone(user.email)
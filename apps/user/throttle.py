@@ -0,0 +1,116 @@
+import time
+
+from django.contrib.auth import authenticate
+from django_redis import get_redis_connection
+
+from user.models import User
+
+
+LOGIN_IP_KEY = 'login_ip_%s'  # 每个ip的令牌桶 {tokens: 剩余令牌, ts: 上次更新的时间}
+LOGIN_USER_KEY = 'login_user_%s'  # 每个用户名的令牌桶
+UNKNOWN_USER_KEY = 'login_unknown_%s'  # 不存在的用户名，在这段时间内不再查询数据库
+
+LOGIN_IP_CAPACITY = 20  # 每个ip最多连续尝试的次数
+LOGIN_IP_RATE = 20 / 60.0  # 每个ip每秒补充的令牌数，即每分钟20次
+LOGIN_USER_CAPACITY = 5  # 每个用户名最多连续尝试的次数
+LOGIN_USER_RATE = 5 / 300.0  # 每个用户名每5分钟5次
+UNKNOWN_USER_TIMEOUT = 300
+
+# 检查登录尝试的结果
+ALLOWED = 0
+IP_LIMITED = 1
+USER_LIMITED = 2
+UNKNOWN_USER = 3
+
+# 令牌桶: 按上次更新后经过的时间补充令牌，有令牌时取走一个
+TAKE_TOKEN = """
+local function take(key, capacity, rate, now)
+    local bucket = redis.call('HMGET', key, 'tokens', 'ts')
+    local tokens = tonumber(bucket[1]) or capacity
+    local ts = tonumber(bucket[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+    local allowed = tokens >= 1
+    if allowed then
+        tokens = tokens - 1
+    end
+    redis.call('HMSET', key, 'tokens', tokens, 'ts', now)
+    redis.call('EXPIRE', key, math.ceil(capacity / rate))
+    return allowed
+end
+"""
+
+# KEYS: ip的令牌桶, 用户名的令牌桶, 不存在的用户名
+# ARGV: 当前时间, ip桶容量, ip补充速度, 用户名桶容量, 用户名补充速度
+# ip没有令牌时不再消耗用户名的令牌，不存在的用户名只消耗ip的令牌
+CHECK_SCRIPT = TAKE_TOKEN + """
+local now = tonumber(ARGV[1])
+if not take(KEYS[1], tonumber(ARGV[2]), tonumber(ARGV[3]), now) then
+    return 1
+end
+if redis.call('EXISTS', KEYS[3]) == 1 then
+    return 3
+end
+if not take(KEYS[2], tonumber(ARGV[4]), tonumber(ARGV[5]), now) then
+    return 2
+end
+return 0
+"""
+
+
+def get_client_ip(request):
+    # 通过nginx的uwsgi_pass转发，REMOTE_ADDR就是客户端的ip
+    return request.META.get('REMOTE_ADDR', '')
+
+
+class LoginGuard(object):
+    """
+    登录限流
+    计算密码哈希前用一次lua脚本调用检查ip和用户名的令牌桶，以及用户名是否已知不存在
+    """
+    def __init__(self, conn=None):
+        self.conn = conn or get_redis_connection('default')
+        self._check = self.conn.register_script(CHECK_SCRIPT)
+
+    def check(self, ip, username):
+        """ 返回ALLOWED、IP_LIMITED、USER_LIMITED或UNKNOWN_USER """
+        keys = [LOGIN_IP_KEY % ip, LOGIN_USER_KEY % username, UNKNOWN_USER_KEY % username]
+        args = [time.time(), LOGIN_IP_CAPACITY, LOGIN_IP_RATE, LOGIN_USER_CAPACITY, LOGIN_USER_RATE]
+        return self._check(keys=keys, args=args)
+
+    def mark_unknown(self, username):
+        self.conn.set(UNKNOWN_USER_KEY % username, 1, ex=UNKNOWN_USER_TIMEOUT)
+
+    def forget_unknown(self, *usernames):
+        """ 注册新用户后删除不存在的记录 """
+        if usernames:
+            self.conn.delete(*[UNKNOWN_USER_KEY % username for username in usernames])
+
+    def reset(self, username):
+        """ 登录成功后恢复用户名的令牌 """
+        self.conn.delete(LOGIN_USER_KEY % username)
+
+
+def authenticate_user(ip, username, password, guard=None, request=None):
+    """
+    限流后验证用户名和密码，返回 (用户, 错误信息)
+    被限流或用户名已知不存在时不计算密码哈希，其他情况交给authenticate()，
+    使用配置的AUTHENTICATION_BACKENDS，失败时发送user_login_failed信号
+    未激活的用户密码正确时也返回用户，由调用方提示未激活
+    """
+    guard = guard or LoginGuard()
+    result = guard.check(ip, username)
+    if result in (IP_LIMITED, USER_LIMITED):
+        return None, '登录尝试过于频繁，请稍后再试'
+    if result == UNKNOWN_USER:
+        return None, '用户名或密码错误'
+    user = authenticate(request, username=username, password=password)
+    if user is not None:
+        guard.reset(username)
+        return user, None
+    # 验证失败时再区分用户名不存在和未激活，登录成功时不多查询
+    user = User.objects.filter(username=username).first()
+    if user is None:
+        guard.mark_unknown(username)
+    elif not user.is_active and user.check_password(password):
+        return user, None
+    return None, '用户名或密码错误'
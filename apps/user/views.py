@@ -3,14 +3,16 @@ import re
 from django.shortcuts import render, redirect, reverse
 from django.views.generic import View
 from django.conf import settings
-from django.contrib.auth import authenticate, login, logout
+from django.contrib.auth import login, logout
 from django.http import HttpResponse
 from django.core.paginator import Paginator
 
 from .models import User, Address
-from order.models import OrderInfo, OrderGoods
-from goods.models import GoodsSKU
-from django_redis import get_redis_connection
+from .throttle import authenticate_user, get_client_ip
+from .registration import register_user
+from order.models import OrderInfo
+from goods.history import History
+from cart.cart import Cart, get_cart
 from utils.mixin import LoginRequiredMixin
 from celery_tasks.tasks import send_register_active_email
 from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
@@ -39,24 +41,11 @@ class RegisterView(View):
             return render(request, 'register.html', {'errmsg': '邮箱格式不正确'})
         if allow != 'on':
             return render(request, 'register.html', {'errmsg': '请同意协议'})
-        # 效验用户是否已存在
-        try:
-            user = User.objects.get(username=username)
-        except User.DoesNotExist:
-            user = None
-        if user:
-            return render(request, 'register.html', {'errmsg': '用户名已存在'})
-        try:
-            user = User.objects.get(email=email)
-        except User.DoesNotExist:
-            user = None
-        if user:
-            return render(request, 'register.html', {'errmsg': '邮箱已存在'})
+        # 一次查询效验用户名和邮箱是否已存在，一条insert写入未激活的用户
+        user, errmsg = register_user(username, email, password)
+        if errmsg:
+            return render(request, 'register.html', {'errmsg': errmsg})
 
-        # 进行业务处理
-        user = User.objects.create_user(username=username, email=email, password=password)
-        user.is_active = 0
-        user.save()
         # 生成加密对象，第一个参数是加密类型，可以使用settings中的SECRET_KEY，第二个参数为过期时间，单位s
         serializer = Serializer(settings.SECRET_KEY, 3600)
         info = {'confirm': user.id}  # 加密的内容为用户id的字典
@@ -110,10 +99,16 @@ class LoginView(View):
         password = request.POST.get('pwd', '')
         if not all([username, password]):
             return render(request, 'login.html', {'errmsg': '数据不完整'})
-        user = authenticate(username=username, password=password)
+        # 先检查限流，再验证密码
+        user, errmsg = authenticate_user(get_client_ip(request), username, password, request=request)
         if user:
             if user.is_active:
+                # login会更换session key，先取出未登录时的购物车
+                guest_cart = get_cart(request)
                 login(request, user)
+                if guest_cart is not None:
+                    # 一次redis调用把未登录时的购物车合并到用户的购物车
+                    Cart(user.id).merge(guest_cart)
                 next_url = request.GET.get('next', reverse('goods:index'))
                 response = redirect(next_url)
                 remember = request.POST.get('remember', '')
@@ -125,7 +120,7 @@ class LoginView(View):
             else:
                 return render(request, 'login.html', {'errmsg': '用户未激活'})
         else:
-            return render(request, 'login.html', {'errmsg': '用户名或密码错误'})
+            return render(request, 'login.html', {'errmsg': errmsg})
 
 
 class LogoutView(View):
@@ -146,15 +141,8 @@ class UserInfoView(LoginRequiredMixin, View):
     def get(self, request):
         user = request.user
         address = Address.objects.get_default_address(user=user)
-        # 从redis获取最近5条浏览记录
-        con = get_redis_connection('default')
-        history_key = 'history_%d' % user.id  # 利用用户id获取key值
-        sku_ids = con.lrange(history_key, 0, 4)  # 获取对应的5个商品id
-        goods_li = []
-        # 按顺序获取五条商品记录
-        for sku_id in sku_ids:
-            goods = GoodsSKU.objects.get(pk=sku_id)
-            goods_li.append(goods)
+        # 从redis获取最近5条浏览记录，一次查询按顺序获取商品
+        goods_li = History.skus(History(user.id).sku_ids(5), 5, request=request)
         return render(request, 'user_center_info.html', {
             'page': 'user',
             'address': address,
@@ -169,26 +157,9 @@ class OrderView(LoginRequiredMixin, View):
     """
     def get(self, request, page):
         '''显示'''
-        # 获取用户的订单信息
+        # 获取用户的订单信息，分页后只查询当前页订单的商品信息
         user = request.user
-        orders = OrderInfo.objects.filter(user=user).order_by('-create_time')
-
-        # 遍历获取订单商品的信息
-        for order in orders:
-            # 根据order_id查询订单商品信息
-            order_skus = OrderGoods.objects.filter(order_id=order.order_id)
-
-            # 遍历order_skus计算商品的小计
-            for order_sku in order_skus:
-                # 计算小计
-                amount = order_sku.count * order_sku.price
-                # 动态给order_sku增加属性amount,保存订单商品的小计
-                order_sku.amount = amount
-
-            # 动态给order增加属性，保存订单状态标题
-            # order.status_name = OrderInfo.ORDER_STATUS[order.order_status]
-            # 动态给order增加属性，保存订单商品的信息
-            order.order_skus = order_skus
+        orders = OrderInfo.objects.get_order_history(user)
 
         # 分页
         paginator = Paginator(orders, 3)
@@ -205,6 +176,18 @@ class OrderView(LoginRequiredMixin, View):
         # 获取第page页的Page实例对象
         order_page = paginator.page(page)
 
+        # 从上一页翻过来时带有游标，按游标获取当前页的订单，避免OFFSET越翻越慢
+        cursor = request.GET.get('cursor', '')
+        if cursor:
+            order_list = OrderInfo.objects.get_orders_after(user, cursor, paginator.per_page)
+            if order_list is not None:
+                order_page.object_list = order_list
+
+        # 下一页的游标
+        next_cursor = ''
+        if order_page.has_next():
+            next_cursor = OrderInfo.objects.get_order_cursor(list(order_page)[-1])
+
         # todo: 进行页码的控制，页面上最多显示5个页码
         # 1.总页数小于5页，页面上显示所有页码
         # 2.如果当前页是前3页，显示1-5页
@@ -223,6 +206,7 @@ class OrderView(LoginRequiredMixin, View):
         # 组织上下文
         context = {'order_page': order_page,
                    'pages': pages,
+                   'next_cursor': next_cursor,
                    'page': 'order'}
 
         # 使用模板
@@ -1,17 +1,60 @@
 # 在任务处理者一端加这几句
 import django
 import os
+from datetime import datetime
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "dailyfresh.settings")
 django.setup()
 
 from django.core.mail import send_mail
+from django.core.exceptions import ObjectDoesNotExist
 from django.conf import settings
 from celery import Celery
-from django.template import loader
-from goods.models import GoodsType, IndexGoodsBanner, IndexPromotionBanner, IndexTypeGoodsBanner
+from utils import static_page
+from django.contrib.auth.models import AnonymousUser
+from django_redis import get_redis_connection
+from goods.models import GoodsSKU
+from goods.utils import get_index_page_data, refresh_index_page_data, get_detail_page_data
+from goods.utils import HOT_DETAIL_KEY, HOT_DETAIL_COUNT
+from order.models import OrderInfo
+from order.stock import StockReservation
+from order.payment import check_pending_payments
+from order.pipeline import persist_batch
+from goods.search import update_batch as update_search_batch, refresh_suggestions
 
 app = Celery('celery_tasks.tasks', broker='redis://:test123456@192.168.204.129:6379/8')
 
+# 定时任务 celery -A celery_tasks.tasks beat
+app.conf.beat_schedule = {
+    'release-expired-stock': {
+        'task': 'celery_tasks.tasks.release_expired_stock',
+        'schedule': 60,
+    },
+    'reconcile-stock': {
+        'task': 'celery_tasks.tasks.reconcile_stock',
+        'schedule': 3600,
+    },
+    'persist-orders': {
+        'task': 'celery_tasks.tasks.persist_orders',
+        'schedule': 10,
+    },
+    'check-pending-payments': {
+        'task': 'celery_tasks.tasks.check_pending_payments_task',
+        'schedule': 5,
+    },
+    'update-search-index': {
+        'task': 'celery_tasks.tasks.update_search_index',
+        'schedule': 10,
+    },
+    'refresh-search-suggest': {
+        'task': 'celery_tasks.tasks.refresh_search_suggest',
+        'schedule': 3600,
+    },
+    'generate-hot-detail-html': {
+        'task': 'celery_tasks.tasks.generate_hot_detail_html',
+        'schedule': 3600,
+    },
+}
+
 
 @app.task
 def send_register_active_email(to_email, username, token):
@@ -26,32 +69,119 @@ def send_register_active_email(to_email, username, token):
 @app.task
 def generate_static_index_html():
     # 产生首页静态页面
-    types = GoodsType.objects.all()  # 获取商品的种类信息
-    goods_banners = IndexGoodsBanner.objects.all().order_by('index')  # 获取首页轮播商品信息
-    promotion_banners = IndexPromotionBanner.objects.all().order_by('index')  # 获取首页促销活动信息
-
-    # 获取首页分类商品展示信息
-    for type in types:
-        image_banners = IndexTypeGoodsBanner.objects.filter(
-            type=type, display_type=1).order_by('index')
-        title_banners = IndexTypeGoodsBanner.objects.filter(
-            type=type, display_type=0).order_by('index')
-        type.image_banners = image_banners
-        type.title_banners = title_banners
-
-    context = {
-        'types': types,
-        'goods_banners': goods_banners,
-        'promotion_banners': promotion_banners}
-
-    # 使用模板
-    # 1.加载模板文件，返回模板对象
-    temp = loader.get_template('static_index.html')
-    # 2.渲染模板
-    static_index_html = temp.render(context)
-
-    # 生成首页对应静态文件
-    save_path = os.path.join(settings.BASE_DIR, 'static/static_index.html')
-    with open(save_path, 'w') as f:
-        f.write(static_index_html)
+    # 开始生成后的修改会重新投递任务
+    static_page.clear_schedule('index')
+    context = get_index_page_data()
+
+    # 渲染模板，内容有变化时原子地替换static/static_index.html并保存历史版本
+    static_page.render('static_index.html', context, 'static_index.html')
+
+
+@app.task
+def generate_static_detail_html(sku_id):
+    # 产生商品的静态详情页static/detail/<sku_id>.html
+    static_page.clear_schedule('detail_%s' % sku_id)
+    try:
+        context = get_detail_page_data(sku_id)
+    except ObjectDoesNotExist:
+        # 商品或关联的spu已被删除
+        return
+    # 不使用请求渲染，用户相关的信息由页面通过ajax获取
+    context.update(user=AnonymousUser(), MEDIA_URL=settings.MEDIA_URL)
+    static_page.render('static_detail.html', context, 'detail/%s.html' % sku_id)
+
+
+@app.task
+def generate_hot_detail_html(count=HOT_DETAIL_COUNT):
+    # 为销量最高的商品生成静态详情页，内容没有变化的页面不会重新写入
+    sku_ids = list(GoodsSKU.objects.filter(status=1).order_by('-sales').values_list('id', flat=True)[:count])
+    conn = get_redis_connection('default')
+    old_ids = {int(sku_id) for sku_id in conn.smembers(HOT_DETAIL_KEY)}
+
+    pl = conn.pipeline()
+    pl.delete(HOT_DETAIL_KEY)
+    if sku_ids:
+        pl.sadd(HOT_DETAIL_KEY, *sku_ids)
+    pl.execute()
+
+    for sku_id in sku_ids:
+        generate_static_detail_html(sku_id)
+
+    # 不再是热销商品的页面删除，由动态详情页处理
+    for sku_id in old_ids - set(sku_ids):
+        static_page.remove('detail/%s.html' % sku_id)
+
+
+@app.task
+def refresh_index_page_cache():
+    # 重新生成首页缓存数据
+    refresh_index_page_data()
+
+
+@app.task
+def persist_orders():
+    # 把队列中的订单批量写入mysql，同一时间只有一个进程在写入
+    conn = get_redis_connection('default')
+    if not conn.set('lock_persist_orders', 1, nx=True, ex=60):
+        return
+    try:
+        while persist_batch():
+            conn.expire('lock_persist_orders', 60)
+    finally:
+        conn.delete('lock_persist_orders')
+
+
+@app.task
+def release_expired_stock():
+    # 归还超时未支付订单预扣的库存
+    reservation = StockReservation()
+    for order_id in reservation.expired():
+        if not OrderInfo.objects.filter(order_id=order_id).exists():
+            # 订单没有创建成功
+            reservation.release(order_id)
+            continue
+
+        # 先用条件更新把超时未支付的订单标记删除，和支付成功的更新(mark_paid)互斥
+        cancelled = OrderInfo.objects.filter(
+            order_id=order_id,
+            order_status=OrderInfo.ORDER_STATUS_ENUM['UNPAID'],
+            is_delete=False,
+        ).update(is_delete=True, update_time=datetime.now())
+        unpaid = OrderInfo.objects.filter(order_id=order_id, order_status=OrderInfo.ORDER_STATUS_ENUM['UNPAID'])
+        if cancelled or unpaid.exists():
+            # 超时未支付，包括上次标记删除后还没归还库存的
+            reservation.release(order_id)
+        else:
+            # 订单已支付
+            reservation.confirm(order_id)
+
+
+@app.task
+def reconcile_stock():
+    # 以mysql为准修正redis中的库存
+    StockReservation().reconcile()
 
+
+@app.task
+def check_pending_payments_task():
+    # 批量查询等待支付结果的订单
+    check_pending_payments()
+
+
+@app.task
+def update_search_index():
+    # 批量更新队列中商品的全文检索索引，同一时间只有一个进程在写入
+    conn = get_redis_connection('default')
+    if not conn.set('lock_update_search_index', 1, nx=True, ex=300):
+        return
+    try:
+        while update_search_batch():
+            conn.expire('lock_update_search_index', 300)
+    finally:
+        conn.delete('lock_update_search_index')
+
+
+@app.task
+def refresh_search_suggest():
+    # 按最新的销量重建搜索提示
+    refresh_suggestions()
@@ -159,19 +159,26 @@ HAYSTACK_CONNECTIONS = {
     'default': {
         # 使用whoosh引擎
         # 'ENGINE': 'haystack.backends.whoosh_backend.WhooshEngine',
-        'ENGINE': 'haystack.backends.whoosh_cn_backend.WhooshEngine',
+        # 'ENGINE': 'haystack.backends.whoosh_cn_backend.WhooshEngine',
+        # 'PATH': os.path.join(BASE_DIR, 'whoosh_index'),
+        # 使用jieba分词、BM25排序的段式索引，支持按种类、价格区间、状态分面
+        'ENGINE': 'utils.search_backend.SegmentEngine',
         # 索引文件路径
-        'PATH': os.path.join(BASE_DIR, 'whoosh_index'),
+        'PATH': os.path.join(BASE_DIR, 'search_index'),
     }
 }
 
-# 当添加、修改、删除数据时，自动生成索引
-HAYSTACK_SIGNAL_PROCESSOR = 'haystack.signals.RealtimeSignalProcessor'
+# 当添加、修改、删除数据时，把商品放入队列，由celery批量更新索引
+HAYSTACK_SIGNAL_PROCESSOR = 'goods.search.QueuedSignalProcessor'
 
 # 指定搜索结果每页显示的条数
 HAYSTACK_SEARCH_RESULTS_PER_PAGE = 2
 
 
+# 支付宝异步通知支付结果的地址，需要能从公网访问，例如 http://域名/order/notify/
+ALIPAY_NOTIFY_URL = None
+
+
 # logging
 LOGGING = {
     'version': 1,
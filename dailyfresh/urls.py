@@ -24,8 +24,7 @@ urlpatterns = [
     path('user/', include('user.urls')),  # 用户模块
     path('cart/', include('cart.urls')),  # 购物车模块
     path('order/', include('order.urls')),  # 订单模块
-    path('', include('goods.urls')),  # 商品模块
-    path('search/', include('haystack.urls')),  # 全文检索
+    path('', include('goods.urls')),  # 商品模块，包括全文检索
     re_path('media/(?P<path>.*)', serve, {'document_root': settings.MEDIA_ROOT}),  # 上传文件访问url
     re_path('static/(?P<path>.*)', serve, {'document_root': settings.STATIC_ROOT}),  # 静态文件访问url
 ]
@@ -0,0 +1,13 @@
+def percentile(values, p):
+    """ values的第p百分位数 """
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def summarize(latencies):
+    """ 延迟(毫秒)的统计: 次数、平均值和各百分位数 """
+    latencies = latencies or [0]
+    return 'n=%d avg=%.2fms p50=%.2fms p95=%.2fms p99=%.2fms max=%.2fms' % (
+        len(latencies), sum(latencies) / len(latencies),
+        percentile(latencies, 50), percentile(latencies, 95), percentile(latencies, 99), max(latencies),
+    )
@@ -0,0 +1,95 @@
+import math
+import random
+import time
+import uuid
+
+from django.core.cache import cache
+
+
+def _build(key, builder, soft_ttl, hard_ttl):
+    """ 生成数据并写入缓存，同时记录生成耗时用于提前过期的计算 """
+    start = time.time()
+    value = builder()
+    delta = time.time() - start
+    entry = {
+        'value': value,
+        'expires': time.time() + soft_ttl,
+        'delta': delta,
+    }
+    cache.set(key, entry, hard_ttl)
+    return value
+
+
+def _acquire(lock_key, timeout):
+    """ 获取分布式锁，成功时返回锁的标识 """
+    token = uuid.uuid4().hex
+    if cache.add(lock_key, token, timeout):
+        return token
+    return None
+
+
+def _release(lock_key, token):
+    if cache.get(lock_key) == token:
+        cache.delete(lock_key)
+
+
+def cache_aside(key, builder, soft_ttl=3600, hard_ttl=None, beta=1.0, lock_timeout=10):
+    """
+    带防击穿的缓存读取
+    soft_ttl: 数据过了soft_ttl后仍然可以返回旧数据，由拿到锁的一个进程重新生成
+    hard_ttl: 缓存真正的过期时间，默认是soft_ttl的两倍
+    beta: 提前过期的系数，越大越倾向于在soft_ttl之前提前重新生成，0表示不提前
+    同一时间只有拿到锁的进程会执行builder，其他进程返回旧数据或等待新数据
+    """
+    if hard_ttl is None:
+        hard_ttl = soft_ttl * 2
+    lock_key = 'lock_%s' % key
+
+    entry = cache.get(key)
+    if entry is not None:
+        # 概率提前过期: 生成越慢、越接近过期时间，越可能提前重新生成
+        now = time.time() - entry['delta'] * beta * math.log(1 - random.random())
+        if now < entry['expires']:
+            return entry['value']
+        # 数据已旧，拿到锁的进程重新生成，其他进程直接返回旧数据
+        token = _acquire(lock_key, lock_timeout)
+        if token is None:
+            return entry['value']
+        try:
+            return _build(key, builder, soft_ttl, hard_ttl)
+        finally:
+            _release(lock_key, token)
+
+    # 缓存中没有数据
+    token = _acquire(lock_key, lock_timeout)
+    if token is not None:
+        try:
+            return _build(key, builder, soft_ttl, hard_ttl)
+        finally:
+            _release(lock_key, token)
+
+    # 其他进程正在生成，等待新数据
+    deadline = time.time() + lock_timeout
+    while time.time() < deadline:
+        time.sleep(0.05)
+        entry = cache.get(key)
+        if entry is not None:
+            return entry['value']
+    return builder()
+
+
+def cache_refresh(key, builder, soft_ttl=3600, hard_ttl=None, lock_timeout=10):
+    """ 主动重新生成缓存数据，数据修改后在后台调用，代替直接删除缓存 """
+    if hard_ttl is None:
+        hard_ttl = soft_ttl * 2
+    lock_key = 'lock_%s' % key
+    deadline = time.time() + lock_timeout
+    token = _acquire(lock_key, lock_timeout)
+    while token is None and time.time() < deadline:
+        time.sleep(0.05)
+        token = _acquire(lock_key, lock_timeout)
+    try:
+        return _build(key, builder, soft_ttl, hard_ttl)
+    finally:
+        if token is not None:
+            _release(lock_key, token)
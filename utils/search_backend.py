@@ -0,0 +1,183 @@
+import re
+
+from django_redis import get_redis_connection
+from haystack import connections
+from haystack.backends import BaseEngine, BaseSearchBackend, BaseSearchQuery, log_query
+from haystack.inputs import Clean, PythonData
+from haystack.models import SearchResult
+from haystack.utils import get_identifier
+
+from utils.segment_index import get_index, tokenize, to_cents, FILTER_FIELDS
+
+
+# 查询语句中的过滤条件 @字段__比较方式:值
+FILTER_RE = re.compile(r'^@(\w+?)__(\w+):(.*)$')
+# narrow()传入的过滤条件 字段:值 或 字段_exact:"值"
+NARROW_RE = re.compile(r'^(\w+):"?([^"]*)"?$')
+# 用户输入中有特殊含义的字符
+RESERVED_RE = re.compile(r'[@():"*]')
+
+GENERATION_KEY = 'search_generation'  # 索引的版本号，索引每次修改后加1，搜索结果的缓存随之失效
+
+
+def get_generation():
+    conn = get_redis_connection('default')
+    return int(conn.get(GENERATION_KEY) or 0)
+
+
+def bump_generation():
+    conn = get_redis_connection('default')
+    return conn.incr(GENERATION_KEY)
+
+
+def _filter_value(field, op, value):
+    """ 把过滤条件的值转成索引中保存的形式，值不合法时返回None """
+    convert = to_cents if field == 'price' else int
+    try:
+        if op == 'in':
+            return {convert(item) for item in value.split(',') if item}
+        return convert(value)
+    except (ValueError, ArithmeticError):
+        return None
+
+
+def _field_name(field):
+    # 分面字段的名字带有_exact后缀
+    return field[:-len('_exact')] if field.endswith('_exact') else field
+
+
+def parse_query(query_string):
+    """ 把SegmentSearchQuery生成的查询语句拆分成 (查询词, 排除的词, 过滤条件, 是否匹配全部) """
+    words = []
+    excluded = []
+    filters = []
+    match_all = False
+    for token in query_string.replace('(', ' ').replace(')', ' ').split():
+        if token in ('AND', 'OR', 'NOT'):
+            continue
+        if token == '*':
+            match_all = True
+            continue
+        match = FILTER_RE.match(token)
+        if match:
+            field, op, value = match.groups()
+            field = _field_name(field)
+            value = _filter_value(field, op, value) if field in FILTER_FIELDS else None
+            if value is not None:
+                filters.append((field, op, value))
+        elif token.startswith('-') and len(token) > 1:
+            excluded.append(token[1:])
+        else:
+            words.append(token)
+    terms = tokenize(' '.join(words))
+    excluded = tokenize(' '.join(excluded))
+    return terms, excluded, filters, match_all or (not terms and bool(filters))
+
+
+class SegmentSearchBackend(BaseSearchBackend):
+    """
+    基于utils.segment_index的搜索引擎
+    PATH: 索引目录
+    """
+    def __init__(self, connection_alias, **connection_options):
+        super(SegmentSearchBackend, self).__init__(connection_alias, **connection_options)
+        self.index = get_index(connection_options['PATH'])
+
+    @staticmethod
+    def prepare(index, obj):
+        """ 把模型对象转成索引文档 (sku_id, 分词结果, type_id, 价格, status) """
+        data = index.full_prepare(obj)
+        return (
+            obj.pk,
+            tokenize(data[index.get_content_field()]),
+            data.get('type_id') or 0,
+            data.get('price') or 0,
+            data.get('status', 1),
+        )
+
+    def commit(self, **kwargs):
+        """ 修改索引(参数同SegmentIndex.commit)，并更新索引的版本号 """
+        self.index.commit(**kwargs)
+        bump_generation()
+
+    def update(self, index, iterable, commit=True):
+        docs = [self.prepare(index, obj) for obj in iterable]
+        if docs:
+            self.commit(docs=docs)
+
+    def remove(self, obj_or_string, commit=True):
+        pk = get_identifier(obj_or_string).split('.')[-1]
+        self.commit(deleted=[int(pk)])
+
+    def clear(self, models=None, commit=True):
+        self.commit(replace=True)
+
+    def _model(self):
+        model = connections[self.connection_alias].get_unified_index().get_indexed_models()[0]
+        return model._meta.app_label, model._meta.model_name
+
+    @log_query
+    def search(self, query_string, **kwargs):
+        if not query_string or not query_string.strip():
+            return {'results': [], 'hits': 0}
+
+        terms, excluded, filters, match_all = parse_query(query_string)
+        for narrow in kwargs.get('narrow_queries') or ():
+            match = NARROW_RE.match(narrow.strip())
+            field = _field_name(match.group(1)) if match else None
+            value = _filter_value(field, 'exact', match.group(2)) if field in FILTER_FIELDS else None
+            if value is not None:
+                filters.append((field, 'exact', value))
+
+        facets = kwargs.get('facets') or {}
+        facet_fields = {_field_name(field): field for field in facets}
+        start = kwargs.get('start_offset') or 0
+        end = kwargs.get('end_offset')
+        hits, page, facet_counts = self.index.reader().search(
+            terms, excluded, filters,
+            facets=[field for field in facet_fields if field in FILTER_FIELDS],
+            sort_by=kwargs.get('sort_by'),
+            start=start, end=end,
+            match_all=match_all,
+        )
+
+        result_class = kwargs.get('result_class') or SearchResult
+        app_label, model_name = self._model()
+        results = [result_class(app_label, model_name, sku_id, score) for sku_id, score in page]
+        return {
+            'results': results,
+            'hits': hits,
+            'facets': {'fields': {facet_fields[field]: counts for field, counts in facet_counts.items()}},
+            'spelling_suggestion': None,
+        }
+
+
+class SegmentSearchQuery(BaseSearchQuery):
+    def clean(self, query_fragment):
+        # 去掉用户输入中的特殊字符，避免被当成过滤条件
+        return RESERVED_RE.sub(' ', query_fragment)
+
+    def build_exact_query(self, query_string):
+        return query_string
+
+    def build_not_query(self, query_string):
+        return ' '.join('-' + word for word in query_string.split())
+
+    def build_query_fragment(self, field, filter_type, value):
+        if not hasattr(value, 'input_type_name'):
+            if hasattr(value, 'values_list'):
+                value = list(value)
+            value = Clean(value) if isinstance(value, str) else PythonData(value)
+        prepared = value.prepare(self)
+
+        if field == 'content':
+            return str(prepared)
+        if isinstance(prepared, (list, tuple, set)):
+            prepared = ','.join(str(item) for item in prepared)
+        field = connections[self._using].get_unified_index().get_index_fieldname(field)
+        return '@%s__%s:%s' % (field, filter_type, str(prepared).replace(' ', ''))
+
+
+class SegmentEngine(BaseEngine):
+    backend = SegmentSearchBackend
+    query = SegmentSearchQuery
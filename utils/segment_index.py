@@ -0,0 +1,415 @@
+import json
+import math
+import mmap
+import os
+import re
+import shutil
+import struct
+import threading
+import time
+import uuid
+from decimal import Decimal
+
+import jieba
+
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+
+
+# 倒排索引由若干个只读的段组成，每个段一个目录:
+#   docs.bin      文档表，每个文档一条定长记录
+#   postings.bin  倒排表，每个词的文档按顺序连续存放
+#   terms.json    词典 {词: [在倒排表中的起始位置, 文档数]}
+#   meta.json     {docs: 文档数, length: 全部文档的总词数}
+# manifest_<版本>.json记录一个版本由哪些段组成以及每个段中已删除的文档，CURRENT保存当前版本的manifest文件名
+# 修改索引时写入新的段和manifest，最后替换CURRENT，查询进程发现CURRENT变化后重新加载
+DOC = struct.Struct('<qiiqb')  # sku_id, 文档长度, type_id, 价格(分), status
+POSTING = struct.Struct('<iH')  # 文档序号, 词频
+SKU_ID, LENGTH, TYPE_ID, PRICE, STATUS = range(5)
+
+CURRENT = 'CURRENT'
+SEGMENTS_DIR = 'segments'
+MAX_SEGMENTS = 8  # 段数超过后合并成一个段
+
+# BM25参数
+K1 = 1.2
+B = 0.75
+
+# 价格区间的分面(元)，None表示不限
+PRICE_RANGES = ((0, 10), (10, 20), (20, 50), (50, 100), (100, None))
+
+FILTER_FIELDS = {'type_id': TYPE_ID, 'status': STATUS, 'price': PRICE}
+
+_word_re = re.compile(r'\w', re.U)
+
+
+def tokenize(text):
+    """ 用jieba的搜索引擎模式分词，去掉标点和空白，英文转成小写 """
+    return [word.lower() for word in jieba.cut_for_search(text) if _word_re.search(word)]
+
+
+def to_cents(price):
+    return int(Decimal(str(price)) * 100)
+
+
+def price_label(low, high):
+    return '%s-%s' % (low, '' if high is None else high)
+
+
+def write_segment(path, docs):
+    """
+    把文档写成一个段
+    docs: [(sku_id, 分词结果, type_id, 价格, status)]
+    """
+    rows = []
+    postings = {}
+    for doc_no, (sku_id, tokens, type_id, price, status) in enumerate(docs):
+        counts = {}
+        for token in tokens:
+            counts[token] = counts.get(token, 0) + 1
+        for term, count in counts.items():
+            postings.setdefault(term, []).append((doc_no, min(count, 0xffff)))
+        rows.append((int(sku_id), len(tokens), int(type_id or 0), to_cents(price or 0), int(status)))
+    _write_segment(path, rows, postings)
+
+
+def _write_segment(path, rows, postings):
+    # 先写到临时目录，写完后改名，不会出现写了一半的段
+    tmp = path + '.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    with open(os.path.join(tmp, 'docs.bin'), 'wb') as f:
+        for row in rows:
+            f.write(DOC.pack(*row))
+    terms = {}
+    offset = 0
+    with open(os.path.join(tmp, 'postings.bin'), 'wb') as f:
+        for term in sorted(postings):
+            items = postings[term]
+            terms[term] = [offset, len(items)]
+            f.write(b''.join(POSTING.pack(*item) for item in items))
+            offset += len(items)
+    with open(os.path.join(tmp, 'terms.json'), 'w', encoding='utf-8') as f:
+        json.dump(terms, f, ensure_ascii=False)
+    with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+        json.dump({'docs': len(rows), 'length': sum(row[LENGTH] for row in rows)}, f)
+    os.rename(tmp, path)
+
+
+class Segment(object):
+    """ 只读的段，文档表和倒排表通过mmap访问，多个进程共享操作系统的页缓存 """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        with open(os.path.join(path, 'terms.json'), encoding='utf-8') as f:
+            self.terms = json.load(f)
+        self.count = meta['docs']
+        self.length = meta['length']
+        self._docs = self._map('docs.bin')
+        self._postings = self._map('postings.bin')
+        self._ids = None
+
+    def _map(self, name):
+        with open(os.path.join(self.path, name), 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return memoryview(b'')
+            return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def doc(self, doc_no):
+        return DOC.unpack_from(self._docs, doc_no * DOC.size)
+
+    def docs(self):
+        return DOC.iter_unpack(self._docs)
+
+    def doc_freq(self, term):
+        entry = self.terms.get(term)
+        return entry[1] if entry else 0
+
+    def postings(self, term):
+        """ 包含这个词的文档 [(文档序号, 词频)] """
+        entry = self.terms.get(term)
+        if entry is None:
+            return ()
+        start = entry[0] * POSTING.size
+        return POSTING.iter_unpack(self._postings[start:start + entry[1] * POSTING.size])
+
+    def ids(self):
+        """ {sku_id: 文档序号} """
+        if self._ids is None:
+            self._ids = {row[SKU_ID]: doc_no for doc_no, row in enumerate(self.docs())}
+        return self._ids
+
+
+class IndexReader(object):
+    """ 一个版本的索引，由若干个段和各段中已删除的文档组成 """
+    def __init__(self, segments):
+        # [(段, 已删除的文档序号)]
+        self.segments = segments
+        self.doc_count = sum(segment.count - len(deleted) for segment, deleted in segments)
+        total = sum(segment.count for segment, deleted in segments)
+        self.avg_length = sum(segment.length for segment, deleted in segments) / total if total else 0
+
+    def _score(self, terms):
+        """ 用BM25计算包含查询词的文档的得分 {(段序号, 文档序号): 得分} """
+        scores = {}
+        for term in set(terms):
+            df = sum(segment.doc_freq(term) for segment, deleted in self.segments)
+            if not df:
+                continue
+            idf = math.log(1 + (self.doc_count - df + 0.5) / (df + 0.5))
+            for i, (segment, deleted) in enumerate(self.segments):
+                for doc_no, tf in segment.postings(term):
+                    if doc_no in deleted:
+                        continue
+                    norm = K1 * (1 - B + B * segment.doc(doc_no)[LENGTH] / self.avg_length)
+                    key = (i, doc_no)
+                    scores[key] = scores.get(key, 0) + idf * tf * (K1 + 1) / (tf + norm)
+        return scores
+
+    def _all(self):
+        return {(i, doc_no): 0 for i, (segment, deleted) in enumerate(self.segments)
+                for doc_no in range(segment.count) if doc_no not in deleted}
+
+    @staticmethod
+    def _match(row, filters):
+        for index, op, value in filters:
+            field = row[index]
+            if op in ('exact', 'content') and field != value:
+                return False
+            if op == 'in' and field not in value:
+                return False
+            if (op == 'gt' and field <= value) or (op == 'gte' and field < value):
+                return False
+            if (op == 'lt' and field >= value) or (op == 'lte' and field > value):
+                return False
+        return True
+
+    @staticmethod
+    def _facet(rows, field):
+        if field == 'price':
+            counts = []
+            for low, high in PRICE_RANGES:
+                count = sum(1 for row in rows
+                            if row[PRICE] >= low * 100 and (high is None or row[PRICE] < high * 100))
+                counts.append((price_label(low, high), count))
+            return counts
+        index = FILTER_FIELDS[field]
+        counts = {}
+        for row in rows:
+            counts[row[index]] = counts.get(row[index], 0) + 1
+        return sorted(counts.items(), key=lambda item: -item[1])
+
+    def search(self, terms, excluded=(), filters=(), facets=(), sort_by=None, start=0, end=None, match_all=False):
+        """
+        terms: 查询词 excluded: 结果中不能包含的词
+        filters: [(字段, 比较方式, 值)]，字段为type_id、status、price，比较方式为exact、in、gt、gte、lt、lte
+        facets: 需要统计分面的字段
+        sort_by: 排序字段列表，如['-price']，默认按得分排序
+        返回 (命中数, [(sku_id, 得分)], {字段: [(值, 数量)]})
+        """
+        scores = self._all() if match_all else self._score(terms)
+        if excluded:
+            for key in self._score(excluded):
+                scores.pop(key, None)
+
+        filters = [(FILTER_FIELDS[field], op, value) for field, op, value in filters]
+        hits = []
+        for (i, doc_no), score in scores.items():
+            row = self.segments[i][0].doc(doc_no)
+            if self._match(row, filters):
+                hits.append((score, row))
+
+        facet_counts = {}
+        if facets:
+            rows = [row for score, row in hits]
+            for field in facets:
+                facet_counts[field] = self._facet(rows, field)
+
+        hits.sort(key=lambda hit: (-hit[0], hit[1][SKU_ID]))
+        for field in reversed(sort_by or ()):
+            reverse = field.startswith('-')
+            field = field.lstrip('-')
+            if field == 'score':
+                hits.sort(key=lambda hit: hit[0], reverse=reverse)
+            elif field in ('id', 'pk'):
+                hits.sort(key=lambda hit: hit[1][SKU_ID], reverse=reverse)
+            elif field in FILTER_FIELDS:
+                hits.sort(key=lambda hit: hit[1][FILTER_FIELDS[field]], reverse=reverse)
+
+        page = [(row[SKU_ID], score) for score, row in hits[start:end]]
+        return len(hits), page, facet_counts
+
+
+class SegmentIndex(object):
+    """
+    段式倒排索引
+    查询进程只读mmap的段，修改时写入新的段，再原子地替换CURRENT切换到新版本
+    """
+    def __init__(self, path):
+        self.path = path
+        self.segments_path = os.path.join(path, SEGMENTS_DIR)
+        self._lock = threading.Lock()
+        self._reader = None
+        self._version = None
+
+    def _current_path(self):
+        return os.path.join(self.path, CURRENT)
+
+    def _current(self):
+        try:
+            with open(self._current_path()) as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def _load_manifest(self, name):
+        if name is None:
+            return []
+        with open(os.path.join(self.path, name)) as f:
+            return json.load(f)['segments']
+
+    def reader(self):
+        """ 当前版本的索引，CURRENT被替换后重新加载，同一版本在进程内共享 """
+        try:
+            stat = os.stat(self._current_path())
+            version = (stat.st_ino, stat.st_mtime_ns)
+        except FileNotFoundError:
+            version = None
+        if self._reader is None or version != self._version:
+            with self._lock:
+                if self._reader is None or version != self._version:
+                    segments = []
+                    for entry in self._load_manifest(self._current()):
+                        segment = Segment(os.path.join(self.segments_path, entry['name']))
+                        ids = segment.ids() if entry['deleted'] else {}
+                        deleted = {ids[sku_id] for sku_id in entry['deleted'] if sku_id in ids}
+                        segments.append((segment, deleted))
+                    self._reader = IndexReader(segments)
+                    self._version = version
+        return self._reader
+
+    def new_segment_path(self):
+        """ 新段的目录，由调用方写入后通过commit加入索引 """
+        os.makedirs(self.segments_path, exist_ok=True)
+        name = '%d_%s' % (time.time() * 1000, uuid.uuid4().hex[:8])
+        return os.path.join(self.segments_path, name)
+
+    def _acquire(self):
+        os.makedirs(self.path, exist_ok=True)
+        f = open(os.path.join(self.path, 'LOCK'), 'w')
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        return f
+
+    def commit(self, docs=None, segments=(), deleted=(), replace=False, merge=False):
+        """
+        修改索引并切换到新版本，多个进程同时修改时依次进行
+        docs: 新增或修改的文档，写成一个新段，同一个sku_id在旧段中的文档会被删除
+        segments: 已经用write_segment写好的段目录，会被移动到索引的段目录下
+        deleted: 需要删除的sku_id
+        replace: 丢弃原来的全部段
+        merge: 把全部段合并成一个
+        """
+        lock = self._acquire()
+        try:
+            names = []
+            for path in segments:
+                target = self.new_segment_path()
+                os.rename(path, target)
+                names.append(os.path.basename(target))
+            segments = names
+            if docs:
+                path = self.new_segment_path()
+                write_segment(path, docs)
+                segments.append(os.path.basename(path))
+
+            entries = [] if replace else self._load_manifest(self._current())
+            deleted = set(deleted)
+            for name in segments:
+                deleted.update(Segment(os.path.join(self.segments_path, name)).ids())
+            kept = []
+            for entry in entries:
+                segment = Segment(os.path.join(self.segments_path, entry['name']))
+                entry['deleted'] = sorted(set(entry['deleted']) | (deleted & set(segment.ids())))
+                if len(entry['deleted']) < segment.count:
+                    kept.append(entry)
+            entries = kept + [{'name': name, 'deleted': []} for name in segments]
+
+            if merge or len(entries) > MAX_SEGMENTS:
+                entries = [self._merge(entries)] if entries else []
+            self._publish(entries)
+        finally:
+            lock.close()
+
+    def _merge(self, entries):
+        """ 把多个段中未删除的文档合并成一个新段 """
+        rows = []
+        postings = {}
+        for entry in entries:
+            segment = Segment(os.path.join(self.segments_path, entry['name']))
+            deleted = set(entry['deleted'])
+            remap = {}
+            for doc_no, row in enumerate(segment.docs()):
+                if row[SKU_ID] not in deleted:
+                    remap[doc_no] = len(rows)
+                    rows.append(row)
+            for term in segment.terms:
+                for doc_no, tf in segment.postings(term):
+                    if doc_no in remap:
+                        postings.setdefault(term, []).append((remap[doc_no], tf))
+        path = self.new_segment_path()
+        _write_segment(path, rows, postings)
+        return {'name': os.path.basename(path), 'deleted': []}
+
+    def _publish(self, entries):
+        previous = self._current()
+        name = 'manifest_%d_%s.json' % (time.time() * 1000, uuid.uuid4().hex[:8])
+        with open(os.path.join(self.path, name), 'w') as f:
+            json.dump({'segments': entries}, f)
+        tmp = self._current_path() + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(name)
+        os.replace(tmp, self._current_path())
+        self._clean([name, previous])
+
+    def _clean(self, manifests):
+        """ 删除当前和上一个版本都没有用到的段和manifest，上一个版本可能还在被其他进程加载 """
+        manifests = [name for name in manifests if name]
+        used = set()
+        for name in manifests:
+            used.update(entry['name'] for entry in self._load_manifest(name))
+        for name in os.listdir(self.path):
+            if name.startswith('manifest_') and name not in manifests:
+                self._remove(os.path.join(self.path, name))
+        for name in os.listdir(self.segments_path) if os.path.isdir(self.segments_path) else ():
+            if name not in used and not name.endswith('.tmp'):
+                self._remove(os.path.join(self.segments_path, name))
+
+    @staticmethod
+    def _remove(path):
+        # windows下被mmap的文件不能删除，下次再删
+        try:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_index(path):
+    """ 每个进程中同一个目录的索引只打开一次 """
+    index = _indexes.get(path)
+    if index is None:
+        with _indexes_lock:
+            index = _indexes.get(path)
+            if index is None:
+                index = _indexes[path] = SegmentIndex(path)
+    return index
@@ -0,0 +1,116 @@
+import os
+import threading
+import time
+import uuid
+
+from django_redis import get_redis_connection
+
+
+# 64位id: 41位毫秒时间戳 + 10位机器号 + 12位序号
+EPOCH = 1514736000000  # 2018-01-01 00:00:00 (UTC+8)
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+MAX_WORKER = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+WORKER_KEY = 'snowflake_worker'  # 分配机器号的计数器，机器号的租约为 snowflake_worker_<机器号>
+LEASE_TIMEOUT = 60  # 机器号租约的有效期(秒)，进程退出后租约过期，机器号可以重新分配
+LEASE_RENEW = 20  # 距上次续约超过这个时间(秒)后，生成id前先续约
+
+# KEYS: 计数器  ARGV: 租约key的前缀, 进程的标识, 有效期, 最大机器号
+# 从计数器的位置开始找一个没有被占用的机器号，全部被占用时返回-1
+ACQUIRE_SCRIPT = """
+local max = tonumber(ARGV[4])
+local start = redis.call('INCR', KEYS[1])
+for i = 0, max do
+    local worker_id = (start + i) % (max + 1)
+    if redis.call('SET', ARGV[1] .. worker_id, ARGV[2], 'NX', 'EX', ARGV[3]) then
+        return worker_id
+    end
+end
+return -1
+"""
+
+# KEYS: 租约  ARGV: 进程的标识, 有效期
+# 租约还属于这个进程时续约，已过期或被其他进程占用时返回0
+RENEW_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+    return 1
+end
+return 0
+"""
+
+
+class Snowflake(object):
+    """
+    雪花算法id生成器
+    id按时间递增，同一毫秒内用序号区分，不同进程(uwsgi进程、celery进程)使用不同的机器号
+    机器号是redis中有有效期的租约，同一时间只属于一个进程，生成id时只在每LEASE_RENEW秒续约一次
+    """
+    def __init__(self, key=WORKER_KEY):
+        self.key = key
+        self._lock = threading.Lock()
+        self._pid = None
+        self._worker_id = None
+        self._token = None
+        self._renewed = 0
+        self._last_ms = -1
+        self._sequence = 0
+
+    def _acquire(self, conn):
+        self._token = uuid.uuid4().hex
+        worker_id = conn.register_script(ACQUIRE_SCRIPT)(
+            keys=[self.key], args=[self.key + '_', self._token, LEASE_TIMEOUT, MAX_WORKER])
+        if worker_id < 0:
+            # 不能重复使用其他进程的机器号，否则会生成重复的id
+            raise RuntimeError('没有空闲的雪花算法机器号，%d个机器号都已被占用' % (MAX_WORKER + 1))
+        return worker_id
+
+    def _get_worker_id(self):
+        """
+        每个进程第一次生成id时从redis租用一个机器号，fork出的子进程会重新租用
+        租约快到期时续约，租约已经丢失(进程长时间没有生成id)时重新租用
+        """
+        pid = os.getpid()
+        now = time.time()
+        if self._pid == pid and now - self._renewed < LEASE_RENEW:
+            return self._worker_id
+        conn = get_redis_connection('default')
+        if self._pid != pid:
+            self._worker_id = self._acquire(conn)
+            self._pid = pid
+            self._last_ms = -1
+            self._sequence = 0
+        elif not conn.register_script(RENEW_SCRIPT)(
+                keys=['%s_%d' % (self.key, self._worker_id)], args=[self._token, LEASE_TIMEOUT]):
+            self._worker_id = self._acquire(conn)
+        self._renewed = now
+        return self._worker_id
+
+    def next_id(self):
+        with self._lock:
+            worker_id = self._get_worker_id()
+            now = int(time.time() * 1000)
+            if now < self._last_ms:
+                # 时钟回拨，等待时间追上
+                time.sleep((self._last_ms - now) / 1000)
+                now = self._last_ms
+            if now == self._last_ms:
+                self._sequence = (self._sequence + 1) & MAX_SEQUENCE
+                if self._sequence == 0:
+                    # 这一毫秒的序号用完，等到下一毫秒
+                    while now <= self._last_ms:
+                        now = int(time.time() * 1000)
+            else:
+                self._sequence = 0
+            self._last_ms = now
+            return ((now - EPOCH) << (WORKER_BITS + SEQUENCE_BITS)) | (worker_id << SEQUENCE_BITS) | self._sequence
+
+
+_snowflake = Snowflake()
+
+
+def next_id():
+    """ 生成一个全局唯一、按时间递增的id """
+    return _snowflake.next_id()
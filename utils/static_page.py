@@ -0,0 +1,105 @@
+import hashlib
+import os
+import tempfile
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.template import loader
+
+
+STATIC_DIR = os.path.join(settings.BASE_DIR, 'static')
+# 历史版本保存目录，不对外提供访问
+VERSION_DIR = os.path.join(settings.BASE_DIR, 'static_versions')
+# 每个页面保留的历史版本数
+KEEP_VERSIONS = 5
+
+
+def _digest(content):
+    return hashlib.sha1(content.encode()).hexdigest()
+
+
+def _write_atomic(path, content):
+    """ 先写入同目录下的临时文件再重命名，nginx不会读到写了一半的文件 """
+    dirname = os.path.dirname(path)
+    os.makedirs(dirname, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix='.tmp_')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+def get_versions(name):
+    """ 页面的历史版本文件，新的在前 """
+    version_dir = os.path.join(VERSION_DIR, name)
+    if not os.path.isdir(version_dir):
+        return []
+    versions = sorted(os.listdir(version_dir), reverse=True)
+    return [os.path.join(version_dir, version) for version in versions]
+
+
+def publish(name, content, keep=KEEP_VERSIONS):
+    """
+    发布静态页面static/<name>
+    内容没有变化时不写入，返回是否发布了新内容
+    """
+    path = os.path.join(STATIC_DIR, name)
+    if os.path.exists(path):
+        with open(path) as f:
+            if _digest(f.read()) == _digest(content):
+                return False
+
+    # 保存历史版本，文件名为时间戳+内容摘要
+    version = '%d_%s.html' % (time.time() * 1000000, _digest(content)[:8])
+    _write_atomic(os.path.join(VERSION_DIR, name, version), content)
+    for old in get_versions(name)[keep:]:
+        os.remove(old)
+
+    _write_atomic(path, content)
+    return True
+
+
+def render(template_name, context, name):
+    """ 渲染模板并发布为静态页面，首页、列表页、详情页都可以使用 """
+    temp = loader.get_template(template_name)
+    return publish(name, temp.render(context))
+
+
+def remove(name):
+    """ 删除已发布的静态页面，历史版本保留 """
+    path = os.path.join(STATIC_DIR, name)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def rollback(name, steps=1):
+    """ 回滚到前几个历史版本，返回回滚到的版本文件 """
+    versions = get_versions(name)
+    if len(versions) <= steps:
+        return None
+    with open(versions[steps]) as f:
+        content = f.read()
+    _write_atomic(os.path.join(STATIC_DIR, name), content)
+    return versions[steps]
+
+
+def schedule(task, key, args=(), countdown=5):
+    """
+    合并短时间内的多次生成请求
+    countdown秒内只投递一次任务，任务开始执行时需要调用clear_schedule，之后的修改会再投递新任务
+    在事务中调用时等事务提交后再投递，任务不会读到修改前的数据
+    """
+    def send():
+        if cache.add('static_pending_%s' % key, 1, countdown * 10):
+            task.apply_async(args=args, countdown=countdown)
+    transaction.on_commit(send)
+
+
+def clear_schedule(key):
+    cache.delete('static_pending_%s' % key)
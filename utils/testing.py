@@ -0,0 +1,49 @@
+import copy
+
+from django.conf import settings
+from django.db import connection
+from django.test.utils import override_settings, CaptureQueriesContext
+from django_redis import get_redis_connection
+
+
+TEST_REDIS_DB = 15  # 测试使用的redis库，每个测试前后清空，不影响开发环境的缓存和session(库9)
+
+
+def _test_caches():
+    """ 把默认缓存的redis库换成TEST_REDIS_DB """
+    caches = copy.deepcopy(settings.CACHES)
+    location = caches['default']['LOCATION']
+    caches['default']['LOCATION'] = '%s/%d' % (location.rsplit('/', 1)[0], TEST_REDIS_DB)
+    return caches
+
+
+def count_queries(func, *args, **kwargs):
+    """ 调用func，返回执行的sql语句数 """
+    with CaptureQueriesContext(connection) as context:
+        func(*args, **kwargs)
+    return len(context.captured_queries)
+
+
+class RedisTestMixin(object):
+    """
+    测试中的缓存、session、库存和各种计数都使用单独的redis库
+    和TestCase、SimpleTestCase一起使用，放在它们前面
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls._redis_override = override_settings(CACHES=_test_caches())
+        cls._redis_override.enable()
+        super(RedisTestMixin, cls).setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super(RedisTestMixin, cls).tearDownClass()
+        cls._redis_override.disable()
+
+    def setUp(self):
+        super(RedisTestMixin, self).setUp()
+        get_redis_connection('default').flushdb()
+
+    def tearDown(self):
+        get_redis_connection('default').flushdb()
+        super(RedisTestMixin, self).tearDown()